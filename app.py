@@ -6,21 +6,42 @@ import sys
 import os
 import datetime
 import json
+import csv
+import hmac
+import secrets
+import threading
+import time
+import logging
+from collections import OrderedDict, deque
+import io
+import tempfile
+import itertools
 import hashlib
+import math
 import shutil
 from typing import Optional, List, Dict, Tuple
 import sqlite3
 from functools import wraps
+import click
 from flask import (
     Flask, request, redirect, url_for, render_template_string,
-    flash, jsonify, session, send_file, abort
+    flash, jsonify, session, send_file, abort, Response, stream_with_context,
+    g, has_request_context
 )
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.utils import secure_filename
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import A4
-from reportlab.lib.units import mm
-from reportlab.lib.utils import ImageReader
+
+try:
+    import orjson  # optional: faster JSON for the REST API
+except ImportError:
+    orjson = None
 import textwrap
+import re
+import socket
+import gzip
+from contextlib import contextmanager
+
+_import_started = time.perf_counter()
 
 # ===================== CONFIGURATION =====================
 if getattr(sys, 'frozen', False):
@@ -28,19 +49,32 @@ if getattr(sys, 'frozen', False):
 else:
     ROOT = Path(__file__).parent if '__file__' in dir() else Path.cwd()
 
-BASE_DATA = ROOT / "data"
+# SMART_INVOICE_DATA points the app at another data folder (benchmarks, load tests)
+BASE_DATA = Path(os.environ.get("SMART_INVOICE_DATA") or ROOT / "data")
 DB_DIR = BASE_DATA / "db"
 UPLOADS_DIR = BASE_DATA / "uploads"
 BACKUP_DIR = BASE_DATA / "backups"
 EXPORT_DIR = BASE_DATA / "exports"
 
-for folder in (DB_DIR, UPLOADS_DIR, BACKUP_DIR, EXPORT_DIR):
-    folder.mkdir(parents=True, exist_ok=True)
-
 DB_FILE = DB_DIR / "business.db"
+DB_TIMEOUT = 30  # seconds to wait for the write lock before giving up
+
+# The head office lives in business.db; every other branch in its own
+# branch_<code>.db, so branches never wait on each other's write lock
+MAIN_BRANCH = "main"
+BRANCH_CODE_RE = re.compile(r"^[a-z0-9][a-z0-9_-]{0,31}$")
 app = Flask(__name__)
 app.secret_key = "your-secret-key-change-this-in-production-2024"
 
+# Behind reverse proxies remote_addr is the nearest proxy's; with
+# TRUSTED_PROXIES=n the client address is taken from the last n
+# X-Forwarded-For hops instead (render.yaml sets 1). Off by default: served
+# directly, a client could send any X-Forwarded-For and dodge the per-IP
+# login throttle.
+TRUSTED_PROXIES = int(os.environ.get("TRUSTED_PROXIES", 0))
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
+
 # ===================== HTML TEMPLATES (INLINE) =====================
 # Base template components
 HTML_HEAD = """
@@ -51,6 +85,8 @@ HTML_HEAD = """
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>{title}</title>
     <link href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css" rel="stylesheet">
+    <link rel="manifest" href="/static/manifest.json">
+    <meta name="theme-color" content="#1e3a8a">
     <style>
         :root {
             --primary: #3b82f6;
@@ -433,6 +469,12 @@ HTML_SIDEBAR = """
             <a href="{url_ledger}" class="nav-item {active_ledger}">
                 <i class="fas fa-book"></i> Ledger
             </a>
+            <a href="{url_expenses}" class="nav-item {active_expenses}">
+                <i class="fas fa-receipt"></i> Expenses
+            </a>
+            <a href="{url_reports}" class="nav-item {active_reports}">
+                <i class="fas fa-chart-bar"></i> Reports
+            </a>
             
             {admin_menu}
         </nav>
@@ -444,6 +486,7 @@ HTML_SIDEBAR = """
                 <h3 style="font-weight: 600;">{page_title}</h3>
             </div>
             <div class="user-menu">
+                <span class="badge badge-info" title="Branch"><i class="fas fa-store"></i> {branch}</span>
                 <span style="color: var(--text-muted);">{full_name}</span>
                 <div class="user-avatar">{avatar}</div>
                 <a href="{url_logout}" class="btn btn-secondary btn-sm">
@@ -492,30 +535,220 @@ HTML_LOGIN = """
 """
 
 HTML_FOOTER = """
+<script>
+    if ('serviceWorker' in navigator) {
+        navigator.serviceWorker.register('/service-worker.js');
+    }
+</script>
 </body>
 </html>
 """
 
+# ===================== PASSWORD HASHING =====================
+# scrypt cost; raise SCRYPT_N on faster hardware, lower it if logins queue up
+SCRYPT_N = int(os.environ.get("SCRYPT_N", 2 ** 14))
+SCRYPT_R = int(os.environ.get("SCRYPT_R", 8))
+SCRYPT_P = int(os.environ.get("SCRYPT_P", 1))
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                          maxmem=256 * n * r + 1024 * 1024, dklen=32)
+
+def hash_password(password):
+    """Salted scrypt hash stored as scrypt$n$r$p$salt$hash."""
+    salt = secrets.token_bytes(16)
+    digest = _scrypt(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${salt.hex()}${digest.hex()}"
+
+def verify_password(stored, password):
+    """Return (matches, needs_rehash). Accepts legacy unsalted SHA-256 hashes."""
+    if not stored:
+        return False, False
+    if not stored.startswith("scrypt$"):
+        legacy = hashlib.sha256(password.encode()).hexdigest()
+        return hmac.compare_digest(legacy, stored), True
+    try:
+        _, n, r, p, salt, digest = stored.split("$")
+        n, r, p = int(n), int(r), int(p)
+        matches = hmac.compare_digest(_scrypt(password, bytes.fromhex(salt), n, r, p).hex(), digest)
+    except ValueError:
+        return False, False
+    return matches, (n, r, p) != (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+
+_dummy_password_hash = None
+
+def dummy_password_hash():
+    """Verified against for unknown usernames so they cost the same as wrong
+    passwords. Built on first use: scrypt is too slow to run at import."""
+    global _dummy_password_hash
+    if _dummy_password_hash is None:
+        _dummy_password_hash = hash_password(secrets.token_hex(8))
+    return _dummy_password_hash
+
+class LoginThrottle:
+    """Per-worker sliding-window count of failed logins per key (IP, username).
+    
+    Checked before any database or KDF work so a brute-force burst is turned
+    away for the price of a dict lookup. Keys are kept in LRU order and the
+    least recently used are evicted once max_keys is reached.
+    """
+    
+    def __init__(self, limits, max_keys=10000):
+        self.limits = limits  # kind -> (max failures, window seconds)
+        self.max_keys = max_keys
+        self.failures = OrderedDict()
+        self.lock = threading.Lock()
+    
+    def _prune(self, key, now):
+        window = self.limits[key[0]][1]
+        stamps = self.failures.get(key)
+        while stamps and stamps[0] <= now - window:
+            stamps.popleft()
+        if stamps is not None and not stamps:
+            del self.failures[key]
+        return stamps
+    
+    def retry_after(self, **keys):
+        """Seconds until the caller may try again, 0 if not throttled."""
+        now = time.monotonic()
+        wait = 0
+        with self.lock:
+            for kind, value in keys.items():
+                stamps = self._prune((kind, value), now)
+                max_failures, window = self.limits[kind]
+                if stamps and len(stamps) >= max_failures:
+                    wait = max(wait, stamps[0] + window - now)
+        return int(wait) + 1 if wait else 0
+    
+    def fail(self, **keys):
+        now = time.monotonic()
+        with self.lock:
+            for kind, value in keys.items():
+                key = (kind, value)
+                self._prune(key, now)
+                self.failures.setdefault(key, deque()).append(now)
+                self.failures.move_to_end(key)
+            while len(self.failures) > self.max_keys:
+                self.failures.popitem(last=False)
+    
+    def reset(self, **keys):
+        with self.lock:
+            for kind, value in keys.items():
+                self.failures.pop((kind, value), None)
+
+login_throttle = LoginThrottle({
+    "user": (int(os.environ.get("LOGIN_MAX_FAILURES_USER", 5)), 300),
+    "ip": (int(os.environ.get("LOGIN_MAX_FAILURES_IP", 20)), 300),
+})
+
 # ===================== DATABASE SCHEMA =====================
-def init_db():
-    conn = sqlite3.connect(DB_FILE)
+def ensure_column(c, table, column, definition):
+    """Add a column to an existing table if an older database lacks it."""
+    c.execute(f"PRAGMA table_info({table})")
+    if column not in [row[1] for row in c.fetchall()]:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+def bump_monthly_pnl(c, date, revenue=0, tax=0, cogs=0, expenses=0):
+    """Add amounts to a month's P&L rollup inside the caller's transaction."""
+    month = (date or datetime.date.today().isoformat())[:7]
+    c.execute("""
+        INSERT INTO monthly_pnl (month, revenue, tax, cogs, expenses, updated_at)
+        VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT(month) DO UPDATE SET
+            revenue = revenue + excluded.revenue,
+            tax = tax + excluded.tax,
+            cogs = cogs + excluded.cogs,
+            expenses = expenses + excluded.expenses,
+            updated_at = excluded.updated_at
+    """, (month, revenue, tax, cogs, expenses))
+
+def rebuild_monthly_pnl(c):
+    """Recompute the whole P&L rollup from invoices, items and expenses."""
+    c.execute("DELETE FROM monthly_pnl")
+    c.execute("""
+        INSERT INTO monthly_pnl (month, revenue, tax, cogs, expenses)
+        SELECT month, SUM(revenue), SUM(tax), SUM(cogs), SUM(expenses) FROM (
+            SELECT substr(date, 1, 7) as month, SUM(subtotal - discount) as revenue,
+                   SUM(tax_amount) as tax, 0 as cogs, 0 as expenses
+            FROM invoices WHERE date IS NOT NULL GROUP BY month
+            UNION ALL
+            SELECT substr(i.date, 1, 7), 0, 0,
+                   SUM(it.qty * COALESCE(it.unit_cost, p.purchase_price, 0)), 0
+            FROM invoice_items it
+            JOIN invoices i ON i.id = it.invoice_id
+            LEFT JOIN products p ON p.id = it.product_id
+            WHERE i.date IS NOT NULL GROUP BY 1
+            UNION ALL
+            SELECT substr(date, 1, 7), 0, 0, 0, SUM(amount)
+            FROM expenses WHERE date IS NOT NULL GROUP BY 1
+        )
+        GROUP BY month
+    """)
+
+def bump_monthly_product_sales(c, invoice_id, date):
+    """Add an invoice's quantities to the per-month, per-product sales counters."""
+    c.execute("""
+        INSERT INTO monthly_product_sales (month, product_id, qty, amount)
+        SELECT ?, product_id, SUM(qty), SUM(total)
+        FROM invoice_items
+        WHERE invoice_id = ? AND product_id IS NOT NULL AND product_id != ''
+        GROUP BY product_id
+        ON CONFLICT(month, product_id) DO UPDATE SET
+            qty = qty + excluded.qty,
+            amount = amount + excluded.amount
+    """, ((date or datetime.date.today().isoformat())[:7], invoice_id))
+
+def rebuild_monthly_product_sales(c):
+    """Recompute the sales counters from invoice_items."""
+    c.execute("DELETE FROM monthly_product_sales")
+    c.execute("""
+        INSERT INTO monthly_product_sales (month, product_id, qty, amount)
+        SELECT substr(i.date, 1, 7), it.product_id, SUM(it.qty), SUM(it.total)
+        FROM invoice_items it
+        JOIN invoices i ON i.id = it.invoice_id
+        WHERE i.date IS NOT NULL AND it.product_id IS NOT NULL AND it.product_id != ''
+        GROUP BY 1, 2
+    """)
+
+# Columns each delta-sync client receives per entity (see /api/changes)
+CHANGE_FEED_COLUMNS = {
+    "customers": ("id", "name", "phone", "address", "email", "credit_limit", "balance"),
+    "products": ("id", "name", "unit_price", "stock", "min_stock", "unit", "category", "barcode"),
+    "invoices": ("id", "inv_no", "date", "customer_id", "customer_name", "total", "paid",
+                 "balance", "status", "payment_method"),
+    "transactions": ("id", "date", "customer_id", "invoice_id", "type", "amount", "balance", "description"),
+}
+
+# Opening balance for products that have stock but no journal rows yet
+OPENING_STOCK_SQL = """
+    INSERT INTO stock_movements (product_id, date, type, qty, note)
+    SELECT id, date('now'), 'opening', stock, 'Opening balance'
+    FROM products
+    WHERE stock != 0 AND id NOT IN (SELECT product_id FROM stock_movements)
+"""
+
+def init_db(db_file=DB_FILE, shared=True):
+    """Create or upgrade one database. shared=True for business.db, which also
+    holds users, sessions and the branch list; branch databases get the rest."""
+    conn = sqlite3.connect(db_file)
     c = conn.cursor()
     
     # Users table (Multi-login system)
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        username TEXT UNIQUE NOT NULL,
-        password_hash TEXT NOT NULL,
-        full_name TEXT,
-        role TEXT DEFAULT 'salesman',
-        phone TEXT,
-        email TEXT,
-        is_active INTEGER DEFAULT 1,
-        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-        last_login TEXT
-    )
-    """)
+    if shared:
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            full_name TEXT,
+            role TEXT DEFAULT 'salesman',
+            phone TEXT,
+            email TEXT,
+            is_active INTEGER DEFAULT 1,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            last_login TEXT
+        )
+        """)
     
     # Settings
     c.execute("""
@@ -648,18 +881,276 @@ def init_db():
     )
     """)
     
-    conn.commit()
+    # Stock Movements (append-only journal; products.stock is its running sum)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS stock_movements (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        product_id INTEGER NOT NULL,
+        date TEXT,
+        type TEXT NOT NULL,
+        qty REAL NOT NULL,
+        invoice_id INTEGER,
+        note TEXT,
+        created_by INTEGER,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (product_id) REFERENCES products(id),
+        FOREIGN KEY (invoice_id) REFERENCES invoices(id),
+        FOREIGN KEY (created_by) REFERENCES users(id)
+    )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_stock_movements_product_date ON stock_movements(product_id, date)")
     
-    # Create default admin if not exists
-    c.execute("SELECT id FROM users WHERE role='admin' LIMIT 1")
-    if not c.fetchone():
-        admin_pass = hashlib.sha256("admin123".encode()).hexdigest()
+    # Stock Snapshots (closing stock per product at period ends)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS stock_snapshots (
+        product_id INTEGER NOT NULL,
+        date TEXT NOT NULL,
+        qty REAL NOT NULL,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (product_id, date),
+        FOREIGN KEY (product_id) REFERENCES products(id)
+    )
+    """)
+    
+    # Back-orders (invoice quantities that could not be filled from stock)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS backorders (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        invoice_id INTEGER,
+        product_id INTEGER,
+        product_name TEXT,
+        qty REAL,
+        status TEXT DEFAULT 'open',
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (invoice_id) REFERENCES invoices(id) ON DELETE CASCADE,
+        FOREIGN KEY (product_id) REFERENCES products(id)
+    )
+    """)
+    
+    c.execute(OPENING_STOCK_SQL)
+    
+    # Indexes for date-range reports and per-invoice item lookups
+    c.execute("CREATE INDEX IF NOT EXISTS idx_invoices_date ON invoices(date)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_invoice_items_invoice ON invoice_items(invoice_id)")
+    # Render-cache key: bumped by any change to the invoice or its lines (the
+    # rendered customer details are the ones copied onto the invoice)
+    ensure_column(c, "invoices", "version", "INTEGER DEFAULT 0")
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_invoices_version
+        AFTER UPDATE ON invoices WHEN NEW.version IS OLD.version BEGIN
+            UPDATE invoices SET version = COALESCE(OLD.version, 0) + 1 WHERE id = NEW.id;
+        END
+    """)
+    # unit_cost is left out: create_invoice() fills it in right after the insert
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_invoice_items_update_version
+        AFTER UPDATE OF product_name, qty, unit_price, total ON invoice_items BEGIN
+            UPDATE invoices SET version = version + 1 WHERE id = NEW.invoice_id;
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_invoice_items_delete_version
+        AFTER DELETE ON invoice_items BEGIN
+            UPDATE invoices SET version = version + 1 WHERE id = OLD.invoice_id;
+        END
+    """)
+    
+    # Per-customer lookups (ledger page, /api/v1 filters) walk these newest-first by id
+    c.execute("CREATE INDEX IF NOT EXISTS idx_invoices_customer ON invoices(customer_id, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_transactions_customer ON transactions(customer_id, id)")
+    # Payments per invoice (legacy reconcile, running balances)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_transactions_invoice ON transactions(invoice_id, type)")
+    
+    # Open invoices only, covering the receivables aging query
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_invoices_open ON invoices(customer_id, date, balance)
+        WHERE balance > 0
+    """)
+    
+    # Sequences (counters that must not race, e.g. invoice numbers)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS sequences (
+        key TEXT PRIMARY KEY,
+        value INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    
+    # Legacy CSV migration progress (rows committed per source file)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS migration_checkpoints (
+        source TEXT PRIMARY KEY,
+        rows_done INTEGER DEFAULT 0,
+        updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    # Rows that failed, retried on the next run even though they are checkpointed past
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS migration_errors (
+        source TEXT NOT NULL,
+        line INTEGER NOT NULL,
+        error TEXT,
+        PRIMARY KEY (source, line)
+    )
+    """)
+    
+    # Where an invoice came from ('app' or 'legacy' CSV import)
+    ensure_column(c, "invoices", "source", "TEXT DEFAULT 'app'")
+    
+    # Cost price captured at the time of sale (for COGS)
+    ensure_column(c, "invoice_items", "unit_cost", "REAL")
+    
+    # Monthly P&L rollup, kept current by invoice and expense writes
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS monthly_pnl (
+        month TEXT PRIMARY KEY,
+        revenue REAL DEFAULT 0,
+        tax REAL DEFAULT 0,
+        cogs REAL DEFAULT 0,
+        expenses REAL DEFAULT 0,
+        updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_expenses_date ON expenses(date)")
+    c.execute("SELECT COUNT(*) FROM monthly_pnl")
+    if not c.fetchone()[0]:
+        rebuild_monthly_pnl(c)
+    
+    if shared:
+        # Server-side login sessions (the cookie only carries the session id)
         c.execute("""
-            INSERT INTO users (username, password_hash, full_name, role, is_active)
-            VALUES (?, ?, ?, ?, ?)
-        """, ("admin", admin_pass, "System Administrator", "admin", 1))
+        CREATE TABLE IF NOT EXISTS user_sessions (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            auth_version INTEGER DEFAULT 0,
+            ip_address TEXT,
+            user_agent TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            last_seen TEXT,
+            expires_at TEXT NOT NULL,
+            revoked INTEGER DEFAULT 0,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+        """)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_user_sessions_user ON user_sessions(user_id)")
+        
+        # Bumped whenever a user's access changes; older sessions stop working
+        ensure_column(c, "users", "auth_version", "INTEGER DEFAULT 0")
         
-        # Default settings
+        # Branches; each one except the head office has its own database file
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS branches (
+            code TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        """)
+        c.execute("INSERT OR IGNORE INTO branches (code, name) VALUES (?, ?)", (MAIN_BRANCH, "Head Office"))
+        ensure_column(c, "users", "branch", f"TEXT DEFAULT '{MAIN_BRANCH}'")
+        
+        # Background job queue, shared by every branch and worker process
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            branch TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            priority INTEGER DEFAULT 0,
+            status TEXT DEFAULT 'queued',
+            attempts INTEGER DEFAULT 0,
+            max_attempts INTEGER DEFAULT 3,
+            run_after TEXT NOT NULL,
+            locked_by TEXT,
+            result TEXT,
+            error TEXT,
+            created_by INTEGER,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            started_at TEXT,
+            finished_at TEXT
+        )
+        """)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_jobs_queue ON jobs(status, priority DESC, run_after)")
+        # Refreshed while a job runs, so only a dead worker's job outlives its lease
+        ensure_column(c, "jobs", "heartbeat_at", "TEXT")
+    
+    # Monthly sales targets per product
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS sales_targets (
+        month TEXT NOT NULL,
+        product_id INTEGER NOT NULL,
+        qty REAL NOT NULL,
+        PRIMARY KEY (month, product_id),
+        FOREIGN KEY (product_id) REFERENCES products(id)
+    )
+    """)
+    
+    # Quantity sold per month and product, kept current by invoice writes
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS monthly_product_sales (
+        month TEXT NOT NULL,
+        product_id INTEGER NOT NULL,
+        qty REAL DEFAULT 0,
+        amount REAL DEFAULT 0,
+        PRIMARY KEY (month, product_id),
+        FOREIGN KEY (product_id) REFERENCES products(id)
+    )
+    """)
+    c.execute("SELECT COUNT(*) FROM monthly_product_sales")
+    if not c.fetchone()[0]:
+        rebuild_monthly_product_sales(c)
+    
+    # Offline invoices already ingested, keyed by the client's idempotency UUID
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS sync_receipts (
+        client_uuid TEXT PRIMARY KEY,
+        invoice_id INTEGER NOT NULL,
+        inv_no TEXT NOT NULL,
+        device_id TEXT,
+        user_id INTEGER,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (invoice_id) REFERENCES invoices(id)
+    )
+    """)
+    
+    # Change feed for delta sync: one row per changed record, moved to a new
+    # seq on every write (delete + insert), so the log stays one row per record
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS change_log (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        entity TEXT NOT NULL,
+        entity_id INTEGER NOT NULL,
+        op TEXT NOT NULL,
+        changed_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_change_log_entity ON change_log(entity, entity_id)")
+    for table in CHANGE_FEED_COLUMNS:
+        for event, ref, op in (("INSERT", "NEW", "upsert"), ("UPDATE", "NEW", "upsert"),
+                               ("DELETE", "OLD", "delete")):
+            # Not INSERT OR REPLACE: inside an upsert's DO UPDATE the outer
+            # statement's conflict policy wins and the REPLACE fails instead
+            c.execute(f"DROP TRIGGER IF EXISTS trg_{table}_{event.lower()}_changes")
+            c.execute(f"""
+                CREATE TRIGGER trg_{table}_{event.lower()}_changes
+                AFTER {event} ON {table} BEGIN
+                    DELETE FROM change_log WHERE entity = '{table}' AND entity_id = {ref}.id;
+                    INSERT INTO change_log (entity, entity_id, op)
+                    VALUES ('{table}', {ref}.id, '{op}');
+                END
+            """)
+        # Rows that predate the feed, so a client starting at seq 0 gets everything
+        c.execute(f"""
+            INSERT OR IGNORE INTO change_log (entity, entity_id, op)
+            SELECT '{table}', id, 'upsert' FROM {table}
+        """)
+    
+    conn.commit()
+    
+    # WAL lets readers carry on while an invoice holds the write lock
+    c.execute("PRAGMA journal_mode=WAL")
+    
+    # Default settings
+    c.execute("SELECT COUNT(*) FROM settings")
+    if not c.fetchone()[0]:
         defaults = [
             ("company_name", "Your Business Name"),
             ("company_address", "Your Business Address"),
@@ -668,31 +1159,473 @@ def init_db():
             ("tax_rate", "16"),
             ("currency", "PKR"),
             ("invoice_prefix", "INV-"),
+            ("stock_policy", "reject"),
             ("theme", "light")
         ]
         c.executemany("INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)", defaults)
-        
         conn.commit()
-        print("✅ Default admin created: username='admin', password='admin123'")
+    
+    # Create default admin if not exists
+    if shared:
+        c.execute("SELECT id FROM users WHERE role='admin' LIMIT 1")
+        if not c.fetchone():
+            admin_pass = hash_password("admin123")
+            c.execute("""
+                INSERT INTO users (username, password_hash, full_name, role, is_active)
+                VALUES (?, ?, ?, ?, ?)
+            """, ("admin", admin_pass, "System Administrator", "admin", 1))
+            conn.commit()
+            print("✅ Default admin created: username='admin', password='admin123'")
     
     conn.close()
-    print("✅ Database initialized successfully")
+    print(f"✅ Database initialized successfully ({Path(db_file).name})")
+
+# ===================== APPLICATION STARTUP =====================
+# Bump whenever init_db() gains a table, column or index: each database runs
+# the migrations once, recorded in PRAGMA user_version
+SCHEMA_VERSION = 11
+
+_app_ready = False
+_app_ready_lock = threading.Lock()
+
+@contextmanager
+def file_lock(path):
+    """Exclusive lock on a file, held across processes (gunicorn workers)."""
+    with open(path, "a+b") as f:
+        if os.name == "nt":
+            import msvcrt
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == "nt":
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+def schema_version(db_file=DB_FILE):
+    conn = sqlite3.connect(db_file, timeout=DB_TIMEOUT)
+    try:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+    finally:
+        conn.close()
+
+def migrate_db(db_file=DB_FILE, shared=True):
+    """Bring a database up to SCHEMA_VERSION. Only the first worker to get
+    the lock does the DDL; the others find the version already current."""
+    if schema_version(db_file) >= SCHEMA_VERSION:
+        return False
+    with file_lock(DB_DIR / "migrate.lock"):
+        if schema_version(db_file) >= SCHEMA_VERSION:
+            return False
+        init_db(db_file, shared)
+        conn = sqlite3.connect(db_file, timeout=DB_TIMEOUT)
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        conn.commit()
+        conn.close()
+        return True
 
-init_db()
+def create_app():
+    """Application factory: data folders and migrations, once per process.
+    Importing the module does neither, so tools and worker boots stay cheap;
+    get_db() calls this too, so `gunicorn app:app` and the CLI still work."""
+    global _app_ready
+    if _app_ready:
+        return app
+    with _app_ready_lock:
+        if _app_ready:
+            return app
+        started = time.perf_counter()
+        for folder in (DB_DIR, UPLOADS_DIR, BACKUP_DIR, EXPORT_DIR):
+            folder.mkdir(parents=True, exist_ok=True)
+        dirs_done = time.perf_counter()
+        migrated = migrate_db()
+        for branch in list_branches():
+            migrate_branch_db(branch)
+        done = time.perf_counter()
+        timings = {
+            "import": _import_finished - _import_started,
+            "directories": dirs_done - started,
+            "migrations": done - dirs_done,
+        }
+        for phase, seconds in timings.items():
+            STARTUP_SECONDS.inc((phase,), seconds)
+        app.config["STARTUP_TIMING"] = timings
+        start_read_snapshot_thread()
+        print(f"⏱  Startup (pid {os.getpid()}): import {timings['import'] * 1000:.0f} ms, "
+              f"migrations {timings['migrations'] * 1000:.0f} ms "
+              f"({'applied v%d' % SCHEMA_VERSION if migrated else 'up to date'})")
+        _app_ready = True
+    return app
 
 # ===================== HELPER FUNCTIONS =====================
-def get_db():
-    conn = sqlite3.connect(DB_FILE)
+def record_query(conn, sql, parameters, seconds, many=False):
+    """Attach a statement's timing to the current request, if there is one."""
+    if has_request_context():
+        trace = g.get('sql_trace')
+        if trace is not None:
+            trace.append((sql, seconds))
+        profile = g.get('profile')
+        if profile is not None:
+            profile_query(profile, conn, sql, parameters, seconds, many)
+
+class TracedCursor(sqlite3.Cursor):
+    """Cursor that times every execute/executemany for request metrics."""
+    
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_query(self.connection, sql, parameters, time.perf_counter() - start)
+    
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record_query(self.connection, sql, None, time.perf_counter() - start, many=True)
+
+class TracedConnection(sqlite3.Connection):
+    # The C-level Connection.execute()/executemany() create a plain cursor and
+    # never reach cursor(), so route them through it explicitly
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+    
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+    
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+# ---- Branches ----
+_migrated_branches = {MAIN_BRANCH}
+_migrated_branches_lock = threading.Lock()
+
+def branch_db_file(branch):
+    return DB_FILE if branch == MAIN_BRANCH else DB_DIR / f"branch_{branch}.db"
+
+# Set by the job runner, so background work sees the branch it was queued from
+_branch_context = threading.local()
+
+def current_branch():
+    """The branch this request works on: picked at login (admins can switch),
+    the queuing request's branch for a background job, or
+    SMART_INVOICE_BRANCH for command-line tools."""
+    if has_request_context():
+        return session.get('branch') or MAIN_BRANCH
+    return getattr(_branch_context, "branch", None) or os.environ.get("SMART_INVOICE_BRANCH", MAIN_BRANCH)
+
+def list_branches():
+    """Branch codes other than the head office."""
+    conn = sqlite3.connect(DB_FILE, timeout=DB_TIMEOUT)
+    try:
+        rows = conn.execute("SELECT code FROM branches WHERE code != ? ORDER BY code", (MAIN_BRANCH,))
+        return [row[0] for row in rows]
+    finally:
+        conn.close()
+
+def migrate_branch_db(branch):
+    """Create or upgrade a branch database, once per process."""
+    if branch in _migrated_branches:
+        return
+    with _migrated_branches_lock:
+        if branch not in _migrated_branches:
+            migrate_db(branch_db_file(branch), shared=False)
+            _migrated_branches.add(branch)
+
+def attach_users(conn, read_only=False):
+    """On a branch connection, attach business.db so joins on users work
+    unchanged (unqualified names fall through to attached databases).
+    
+    Not done by get_db() itself: BEGIN IMMEDIATE takes the write lock of every
+    attached database, which would make all branches queue on business.db
+    again. Call it after the connection's last write.
+    """
+    if current_branch() == MAIN_BRANCH:
+        return
+    target = DB_FILE.resolve().as_uri() + "?mode=ro" if read_only else str(DB_FILE)
+    conn.execute("ATTACH DATABASE ? AS hq", (target,))
+
+def get_db(branch=None):
+    if not _app_ready:
+        create_app()
+    branch = branch or current_branch()
+    if branch != MAIN_BRANCH:
+        migrate_branch_db(branch)
+    conn = sqlite3.connect(branch_db_file(branch), timeout=DB_TIMEOUT, factory=TracedConnection)
     conn.row_factory = sqlite3.Row
     return conn
 
-def hash_password(password):
-    return hashlib.sha256(password.encode()).hexdigest()
+def get_main_db():
+    """Connection to business.db (users, sessions, branches) whatever the branch."""
+    return get_db(MAIN_BRANCH)
+
+# ---- Read snapshot ----
+# Listings, reports and exports read a copy of the database refreshed every
+# READ_SNAPSHOT_INTERVAL seconds (0 turns it off), so long scans never hold a
+# read transaction on business.db: checkout writes and WAL checkpoints carry on.
+READ_SNAPSHOT_INTERVAL = int(os.environ.get("READ_SNAPSHOT_INTERVAL", 30))
+SNAPSHOT_BACKUP_PAGES = 4096  # pages per backup step; the source is unlocked between steps
+
+def read_snapshot_file(branch=MAIN_BRANCH):
+    return DB_DIR / f"{branch_db_file(branch).stem}-read.db"
+
+def read_snapshot_mtime(branch=MAIN_BRANCH):
+    try:
+        return os.stat(read_snapshot_file(branch)).st_mtime
+    except FileNotFoundError:
+        return 0
+
+def database_signature(db_file):
+    """mtime and size of a database and its WAL: every commit changes the WAL,
+    every checkpoint the database, so an equal signature means no writes."""
+    signature = []
+    for path in (Path(db_file), Path(f"{db_file}-wal")):
+        try:
+            st = os.stat(path)
+            signature += [st.st_mtime_ns, st.st_size]
+        except FileNotFoundError:
+            signature += [0, 0]
+    return signature
+
+def refresh_read_snapshot(force=False, branch=MAIN_BRANCH):
+    """Copy a branch database into its snapshot with the SQLite backup API when
+    the snapshot is older than the interval and the database has changed
+    since the last copy. Readers keep the old file open: the new copy is
+    written aside and renamed over it."""
+    if not force and time.time() - read_snapshot_mtime(branch) < READ_SNAPSHOT_INTERVAL:
+        return False
+    with file_lock(DB_DIR / "snapshot.lock"):
+        # Another worker may have refreshed it while we waited
+        if not force and time.time() - read_snapshot_mtime(branch) < READ_SNAPSHOT_INTERVAL:
+            return False
+        # The snapshot is dated from before the check or copy, so a write
+        # landing during either still sends its author to the live database
+        checked = time.time()
+        snapshot = read_snapshot_file(branch)
+        signature_file = snapshot.with_suffix(".sig")
+        signature = database_signature(branch_db_file(branch))
+        if not force and snapshot.exists():
+            try:
+                unchanged = json.loads(signature_file.read_text()) == signature
+            except (FileNotFoundError, ValueError):
+                unchanged = False
+            if unchanged:
+                os.utime(snapshot, (checked, checked))
+                return False
+        
+        started = time.perf_counter()
+        fd, tmp = tempfile.mkstemp(dir=DB_DIR, prefix=".snapshot-", suffix=".db")
+        os.close(fd)
+        try:
+            src = sqlite3.connect(branch_db_file(branch), timeout=DB_TIMEOUT)
+            dst = sqlite3.connect(tmp)
+            try:
+                # In steps, so no single read transaction spans the whole copy
+                # and WAL checkpoints can progress in between
+                src.backup(dst, pages=SNAPSHOT_BACKUP_PAGES)
+                # A plain rollback-journal file, so it can be opened immutable
+                dst.execute("PRAGMA journal_mode=DELETE")
+            finally:
+                dst.close()
+                src.close()
+            os.replace(tmp, snapshot)
+            os.utime(snapshot, (checked, checked))
+            signature_file.write_text(json.dumps(signature))
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+        SNAPSHOT_REFRESH_SECONDS.observe(time.perf_counter() - started)
+    return True
+
+def _read_snapshot_loop():
+    while True:
+        try:
+            for branch in [MAIN_BRANCH] + list_branches():
+                refresh_read_snapshot(branch=branch)
+        except Exception as e:
+            print(f"⚠️  Read snapshot refresh failed: {e}")
+        time.sleep(max(READ_SNAPSHOT_INTERVAL / 2, 1))
+
+def start_read_snapshot_thread():
+    if READ_SNAPSHOT_INTERVAL:
+        threading.Thread(target=_read_snapshot_loop, name="read-snapshot", daemon=True).start()
+
+def get_read_db(last_write=None):
+    """Connection for listings and reports.
+    
+    The snapshot when it exists, is not badly overdue and is newer than this
+    user's last write (so people always see what they just saved); otherwise
+    the live database, opened read-only. Outside a request (background jobs)
+    pass the queuing user's last_write, as the session is not available.
+    """
+    branch = current_branch()
+    if last_write is None and has_request_context():
+        last_write = session.get('last_write', 0)
+    snapshot_at = read_snapshot_mtime(branch) if READ_SNAPSHOT_INTERVAL else 0
+    fresh = time.time() - snapshot_at < READ_SNAPSHOT_INTERVAL * 3
+    if fresh and (last_write or 0) >= snapshot_at:
+        fresh = False
+    if fresh:
+        # immutable: the file is only ever replaced, never written, so skip locking
+        uri = read_snapshot_file(branch).resolve().as_uri() + "?mode=ro&immutable=1"
+    else:
+        if not _app_ready:
+            create_app()
+        if branch != MAIN_BRANCH:
+            migrate_branch_db(branch)
+        uri = branch_db_file(branch).resolve().as_uri() + "?mode=ro"
+    conn = sqlite3.connect(uri, uri=True, timeout=DB_TIMEOUT, factory=TracedConnection)
+    conn.row_factory = sqlite3.Row
+    attach_users(conn, read_only=True)
+    return conn
+
+@app.after_request
+def remember_last_write(response):
+    # Routes the writer's next reads to the live database until the snapshot catches up
+    if request.method not in ("GET", "HEAD", "OPTIONS") and response.status_code < 400 \
+            and session.get('user_id'):
+        session['last_write'] = time.time()
+    return response
+
+def read_stamp(name):
+    """Change stamp shared by all workers: a file's mtime, so checking it is a stat, not a query."""
+    try:
+        return os.stat(DB_DIR / f"{name}.stamp").st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+def bump_stamp(name):
+    path = DB_DIR / f"{name}.stamp"
+    path.touch()
+    now = time.time_ns()
+    os.utime(path, ns=(now, now))
+
+def date_arg(name, default):
+    """?name= as a YYYY-MM-DD string, or default if it is missing or not a date."""
+    try:
+        return datetime.date.fromisoformat(request.args.get(name, '')).isoformat()
+    except ValueError:
+        return default
+
+def month_arg(name='month'):
+    """?month= (or a form field) as YYYY-MM, or the current month if it is missing or not a month."""
+    try:
+        return datetime.date.fromisoformat(f"{request.values.get(name, '')}-01").strftime('%Y-%m')
+    except ValueError:
+        return datetime.date.today().strftime('%Y-%m')
+
+# ===================== SESSIONS =====================
+SESSION_LIFETIME = datetime.timedelta(days=7)
+AUTH_CACHE_TTL = 60  # seconds a worker trusts its cached session lookup
+AUTH_CACHE_MAX = 10000
+SESSION_TOUCH_INTERVAL = datetime.timedelta(minutes=5)  # how stale last_seen may get before a write
+
+_auth_cache = {}  # session id -> (checked_at, user dict or None)
+_auth_cache_stamp = [0]
+_auth_cache_lock = threading.Lock()
+
+def start_user_session(c, user):
+    """Create a server-side session row; the caller commits."""
+    sid = secrets.token_urlsafe(32)
+    now = datetime.datetime.utcnow()
+    c.execute("DELETE FROM user_sessions WHERE expires_at < ?", (now.isoformat(),))
+    c.execute("""
+        INSERT INTO user_sessions (id, user_id, auth_version, ip_address, user_agent, last_seen, expires_at)
+        VALUES (?, ?, (SELECT auth_version FROM users WHERE id = ?), ?, ?, ?, ?)
+    """, (sid, user['id'], user['id'], request.remote_addr, request.user_agent.string[:200],
+          now.isoformat(), (now + SESSION_LIFETIME).isoformat()))
+    return sid
+
+def revoke_user_sessions(conn, user_id=None, sid=None):
+    """Invalidate sessions in the database and commit.
+    
+    Revoking a user's sessions empties every worker's cache. A single session
+    (logout) only leaves this worker's cache: the browser has dropped its
+    cookie, and other workers stop trusting their copy within AUTH_CACHE_TTL.
+    """
+    c = conn.cursor()
+    if user_id is not None:
+        c.execute("UPDATE users SET auth_version = auth_version + 1 WHERE id = ?", (user_id,))
+        c.execute("UPDATE user_sessions SET revoked = 1 WHERE user_id = ?", (user_id,))
+    if sid is not None:
+        c.execute("UPDATE user_sessions SET revoked = 1 WHERE id = ?", (sid,))
+    conn.commit()
+    # Only after the commit, or another worker could re-cache the old state
+    if user_id is not None:
+        bump_stamp("auth")
+    if sid is not None:
+        with _auth_cache_lock:
+            _auth_cache.pop(sid, None)
+
+def _lookup_session(sid):
+    conn = get_main_db()
+    c = conn.cursor()
+    now = datetime.datetime.utcnow().isoformat()
+    c.execute("""
+        SELECT u.id, u.username, u.full_name, u.role, s.last_seen
+        FROM user_sessions s
+        JOIN users u ON u.id = s.user_id
+        WHERE s.id = ? AND s.revoked = 0 AND s.expires_at > ?
+          AND s.auth_version = u.auth_version AND u.is_active = 1
+    """, (sid, now))
+    row = c.fetchone()
+    # last_seen is informational: refresh it every few minutes, not on every
+    # lookup, so reads do not queue for the write lock
+    touch_before = (datetime.datetime.utcnow() - SESSION_TOUCH_INTERVAL).isoformat()
+    if row and (row['last_seen'] or '') < touch_before:
+        c.execute("UPDATE user_sessions SET last_seen = ? WHERE id = ?", (now, sid))
+        conn.commit()
+    conn.close()
+    if not row:
+        return None
+    user = dict(row)
+    del user['last_seen']
+    return user
+
+def current_user():
+    """The logged-in user for this request, or None.
+    
+    Each worker caches session -> user for AUTH_CACHE_TTL seconds, so a hot
+    request costs one stat() of the auth stamp instead of a query. Revoking or
+    deactivating bumps the stamp, which empties every worker's cache on its
+    next request.
+    """
+    sid = session.get('sid')
+    if not sid:
+        return None
+    
+    stamp = read_stamp("auth")
+    now = time.monotonic()
+    with _auth_cache_lock:
+        if stamp != _auth_cache_stamp[0]:
+            _auth_cache.clear()
+            _auth_cache_stamp[0] = stamp
+        cached = _auth_cache.get(sid)
+    if cached and now - cached[0] < AUTH_CACHE_TTL:
+        user = cached[1]
+    else:
+        user = _lookup_session(sid)
+        with _auth_cache_lock:
+            if len(_auth_cache) >= AUTH_CACHE_MAX:
+                _auth_cache.clear()
+            _auth_cache[sid] = (now, user)
+    
+    if user and session.get('role') != user['role']:
+        session['role'] = user['role']
+    return user
 
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
+        if not current_user():
+            session.clear()
             flash("Please login first", "error")
             return redirect(url_for('login'))
         return f(*args, **kwargs)
@@ -701,55 +1634,709 @@ def login_required(f):
 def admin_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
+        user = current_user()
+        if not user:
+            session.clear()
             return redirect(url_for('login'))
-        if session.get('role') != 'admin':
+        if user['role'] != 'admin':
             flash("Admin access required", "error")
             return redirect(url_for('dashboard'))
         return f(*args, **kwargs)
     return decorated_function
 
+def api_login_required(f):
+    """login_required for JSON endpoints: 401 instead of a redirect to the login page."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not current_user():
+            return jsonify({"success": False, "error": "Not logged in"}), 401
+        return f(*args, **kwargs)
+    return decorated_function
+
 def log_activity(user_id, action, details=""):
-    conn = get_db()
-    c = conn.cursor()
     ip = request.remote_addr if request else 'unknown'
-    c.execute("""
-        INSERT INTO activity_log (user_id, action, details, ip_address)
-        VALUES (?, ?, ?, ?)
-    """, (user_id, action, details, ip))
-    conn.commit()
-    conn.close()
+    storage.log_activity(user_id, action, details, ip)
 
 def get_setting(key, default=""):
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT value FROM settings WHERE key = ?", (key,))
-    row = c.fetchone()
-    conn.close()
-    return row['value'] if row else default
+    return storage.get_setting(key, default)
 
-def generate_invoice_number():
+def generate_invoice_number(c):
+    """Next invoice number. Must be called with the cursor of an open write
+    transaction so two workers can never draw the same number."""
     prefix = get_setting("invoice_prefix", "INV-")
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT COUNT(*) as count FROM invoices")
-    count = c.fetchone()['count'] + 1
-    conn.close()
+    c.execute("""
+        INSERT OR IGNORE INTO sequences (key, value)
+        SELECT 'invoice_no', COUNT(*) FROM invoices
+    """)
+    c.execute("UPDATE sequences SET value = value + 1 WHERE key = 'invoice_no'")
+    c.execute("SELECT value FROM sequences WHERE key = 'invoice_no'")
+    count = c.fetchone()['value']
     return f"{prefix}{datetime.datetime.now().strftime('%Y%m')}-{count:04d}"
 
-def render_page(title, page_title, content, active_menu="dashboard"):
-    """Helper function to render a full page with sidebar"""
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
+# ===================== STORAGE BACKENDS =====================
+# Record-level data access (customers, products, invoices, ledger,
+# settings, activity) behind one interface, so the same calls can run on
+# the per-branch SQLite files or on a PostgreSQL server with many concurrent
+# writers. The shared SQL is written with ? placeholders; each backend only
+# supplies transactions and inserted ids. Routes move onto `storage` a few at
+# a time; tests/test_storage_contract.py (and `flask storage-check`) runs the
+# contract against either backend. The app itself always uses SQLite:
+# PostgresStorage is exercised by the contract tests only, until every route
+# that shares its tables has moved over.
+
+class DuplicateRecord(Exception):
+    """A unique key (product name, customer name + phone, inv_no, ...) is taken."""
+
+class StorageContractError(Exception):
+    """A backend does not behave the way the Storage contract says."""
+
+INVOICE_COLUMNS = ("inv_no", "date", "customer_id", "customer_name", "customer_address", "customer_phone",
+                   "salesman_id", "salesman_name", "subtotal", "tax_rate", "tax_amount", "discount",
+                   "total", "paid", "balance", "status", "payment_method", "notes", "source")
+
+class Storage:
+    """Contract shared by all backends. Records go in and come out as dicts.
     
-    # Build alerts HTML
-    alerts_html = ""
-    messages = session.get('_flashes', [])
-    for category, message in messages:
-        alerts_html += f'<div class="alert alert-{category}"><i class="fas fa-{"check-circle" if category == "success" else "exclamation-circle" if category == "error" else "info-circle"}"></i> {message}</div>'
-    session['_flashes'] = []  # Clear flashes
+    Subclasses implement transaction() (a context manager yielding a cursor,
+    committing on success, rolling back and raising DuplicateRecord on a
+    unique-key clash) and insert() (run an INSERT, return the new id).
+    """
     
-    # Build admin menu if user is admin
+    def transaction(self):
+        raise NotImplementedError
+    
+    def insert(self, c, sql, params):
+        raise NotImplementedError
+    
+    def _one(self, sql, params=()):
+        with self.transaction() as c:
+            c.execute(sql, params)
+            row = c.fetchone()
+        return dict(row) if row else None
+    
+    def _all(self, sql, params=()):
+        with self.transaction() as c:
+            c.execute(sql, params)
+            return [dict(row) for row in c.fetchall()]
+    
+    # ---- Customers ----
+    def get_customer(self, id):
+        return self._one("SELECT * FROM customers WHERE id = ?", (id,))
+    
+    def list_customers(self):
+        return self._all("SELECT * FROM customers ORDER BY name")
+    
+    def add_customer(self, name, address=None, phone=None, email=None, credit_limit=0):
+        with self.transaction() as c:
+            return self.insert(c, """
+                INSERT INTO customers (name, address, phone, email, credit_limit) VALUES (?, ?, ?, ?, ?)
+            """, (name, address, phone, email, credit_limit))
+    
+    def set_credit_limit(self, id, credit_limit):
+        """0 means no limit. False if there is no such customer."""
+        with self.transaction() as c:
+            c.execute("UPDATE customers SET credit_limit = ? WHERE id = ?", (credit_limit, id))
+            return c.rowcount == 1
+    
+    # ---- Products ----
+    def get_product(self, id):
+        return self._one("SELECT * FROM products WHERE id = ?", (id,))
+    
+    def list_products(self):
+        return self._all("SELECT * FROM products ORDER BY name")
+    
+    def add_product(self, name, unit_price=0, purchase_price=0, stock=0, min_stock=0, unit="pcs",
+                    description=None):
+        with self.transaction() as c:
+            return self.insert(c, """
+                INSERT INTO products (name, description, unit_price, purchase_price, stock, min_stock, unit)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (name, description, unit_price, purchase_price, stock, min_stock, unit))
+    
+    def take_stock(self, product_id, qty):
+        """Take qty out of stock; False (and no change) if there is not enough."""
+        with self.transaction() as c:
+            c.execute("UPDATE products SET stock = stock - ? WHERE id = ? AND stock >= ?",
+                      (qty, product_id, qty))
+            return c.rowcount == 1
+    
+    # ---- Invoices ----
+    def get_invoice(self, id):
+        """(invoice, items); (None, []) if there is no such invoice. The
+        customer details are the ones saved on the invoice."""
+        with self.transaction() as c:
+            c.execute("SELECT * FROM invoices WHERE id = ?", (id,))
+            invoice = c.fetchone()
+            if not invoice:
+                return None, []
+            c.execute("SELECT * FROM invoice_items WHERE invoice_id = ? ORDER BY id", (id,))
+            return dict(invoice), [dict(row) for row in c.fetchall()]
+    
+    def list_invoices(self, customer_id=None, limit=100):
+        if customer_id is not None:
+            return self._all("SELECT * FROM invoices WHERE customer_id = ? ORDER BY id DESC LIMIT ?",
+                             (customer_id, limit))
+        return self._all("SELECT * FROM invoices ORDER BY id DESC LIMIT ?", (limit,))
+    
+    def add_invoice(self, invoice, items):
+        """Insert an invoice (INVOICE_COLUMNS keys) and its lines (product_id,
+        product_name, qty, unit_price) in one transaction; returns its id."""
+        columns = [key for key in INVOICE_COLUMNS if key in invoice]
+        with self.transaction() as c:
+            invoice_id = self.insert(c, f"""
+                INSERT INTO invoices ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})
+            """, [invoice[key] for key in columns])
+            c.executemany("""
+                INSERT INTO invoice_items (invoice_id, product_id, product_name, qty, unit_price, total)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, [(invoice_id, item.get('product_id'), item['product_name'], item['qty'], item['unit_price'],
+                   item['qty'] * item['unit_price']) for item in items])
+        return invoice_id
+    
+    # ---- Ledger ----
+    def add_transaction(self, customer_id, type, amount, balance=None, invoice_id=None, date=None,
+                        description=None, created_by=None):
+        with self.transaction() as c:
+            return self.insert(c, """
+                INSERT INTO transactions
+                (date, customer_id, invoice_id, type, amount, balance, description, created_by)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, (date or datetime.date.today().isoformat(), customer_id, invoice_id, type, amount,
+                  balance, description, created_by))
+    
+    def list_transactions(self, customer_id):
+        return self._all("SELECT * FROM transactions WHERE customer_id = ? ORDER BY date, id", (customer_id,))
+    
+    # ---- Settings ----
+    def get_setting(self, key, default=""):
+        row = self._one("SELECT value FROM settings WHERE key = ?", (key,))
+        return row['value'] if row else default
+    
+    def get_settings(self):
+        return {row['key']: row['value'] for row in self._all("SELECT key, value FROM settings")}
+    
+    def set_settings(self, values, updated_by=None):
+        now = datetime.datetime.now().isoformat()
+        with self.transaction() as c:
+            c.executemany("""
+                INSERT INTO settings (key, value, updated_by, updated_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    value = excluded.value, updated_by = excluded.updated_by, updated_at = excluded.updated_at
+            """, [(key, value, updated_by, now) for key, value in values.items()])
+    
+    # ---- Activity ----
+    def log_activity(self, user_id, action, details="", ip_address=None):
+        with self.transaction() as c:
+            c.execute("INSERT INTO activity_log (user_id, action, details, ip_address) VALUES (?, ?, ?, ?)",
+                      (user_id, action, details, ip_address))
+    
+    def recent_activity(self, limit=50):
+        return self._all("SELECT * FROM activity_log ORDER BY id DESC LIMIT ?", (limit,))
+
+class SqliteStorage(Storage):
+    """The SQLite files: the current branch's database, or a given file."""
+    
+    def __init__(self, db_file=None):
+        self.db_file = db_file
+    
+    def connect(self):
+        if self.db_file is None:
+            return get_db()
+        conn = sqlite3.connect(self.db_file, timeout=DB_TIMEOUT, factory=TracedConnection)
+        conn.row_factory = sqlite3.Row
+        return conn
+    
+    @contextmanager
+    def transaction(self):
+        conn = self.connect()
+        try:
+            yield conn.cursor()
+            conn.commit()
+        except sqlite3.IntegrityError as e:
+            conn.rollback()
+            if "UNIQUE" in str(e):
+                raise DuplicateRecord(str(e)) from e
+            raise
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+    
+    def insert(self, c, sql, params):
+        c.execute(sql, params)
+        return c.lastrowid
+
+class _PgCursor:
+    """psycopg2 cursor that accepts the shared SQL's ? placeholders."""
+    
+    def __init__(self, cursor):
+        self.cursor = cursor
+    
+    def execute(self, sql, params=()):
+        self.cursor.execute(sql.replace("?", "%s"), params)
+    
+    def executemany(self, sql, seq_of_params):
+        self.cursor.executemany(sql.replace("?", "%s"), seq_of_params)
+    
+    def fetchone(self):
+        return self.cursor.fetchone()
+    
+    def fetchall(self):
+        return self.cursor.fetchall()
+    
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+PG_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS settings (
+        key TEXT PRIMARY KEY,
+        value TEXT,
+        updated_by TEXT,
+        updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )""",
+    """CREATE TABLE IF NOT EXISTS products (
+        id BIGSERIAL PRIMARY KEY,
+        name TEXT UNIQUE NOT NULL,
+        description TEXT,
+        unit_price DOUBLE PRECISION DEFAULT 0,
+        purchase_price DOUBLE PRECISION DEFAULT 0,
+        stock DOUBLE PRECISION DEFAULT 0,
+        min_stock DOUBLE PRECISION DEFAULT 0,
+        unit TEXT DEFAULT 'pcs',
+        category TEXT,
+        barcode TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )""",
+    """CREATE TABLE IF NOT EXISTS customers (
+        id BIGSERIAL PRIMARY KEY,
+        name TEXT NOT NULL,
+        address TEXT,
+        phone TEXT,
+        email TEXT,
+        credit_limit DOUBLE PRECISION DEFAULT 0,
+        balance DOUBLE PRECISION DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE (name, phone)
+    )""",
+    """CREATE TABLE IF NOT EXISTS invoices (
+        id BIGSERIAL PRIMARY KEY,
+        inv_no TEXT UNIQUE NOT NULL,
+        date TEXT,
+        customer_id BIGINT REFERENCES customers(id),
+        customer_name TEXT,
+        customer_address TEXT,
+        customer_phone TEXT,
+        salesman_id BIGINT,
+        salesman_name TEXT,
+        subtotal DOUBLE PRECISION DEFAULT 0,
+        tax_rate DOUBLE PRECISION DEFAULT 0,
+        tax_amount DOUBLE PRECISION DEFAULT 0,
+        discount DOUBLE PRECISION DEFAULT 0,
+        total DOUBLE PRECISION DEFAULT 0,
+        paid DOUBLE PRECISION DEFAULT 0,
+        balance DOUBLE PRECISION DEFAULT 0,
+        status TEXT DEFAULT 'pending',
+        payment_method TEXT DEFAULT 'cash',
+        notes TEXT,
+        source TEXT DEFAULT 'app',
+        version INTEGER DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_invoices_customer ON invoices(customer_id)",
+    """CREATE TABLE IF NOT EXISTS invoice_items (
+        id BIGSERIAL PRIMARY KEY,
+        invoice_id BIGINT REFERENCES invoices(id) ON DELETE CASCADE,
+        product_id BIGINT REFERENCES products(id),
+        product_name TEXT,
+        qty DOUBLE PRECISION,
+        unit_price DOUBLE PRECISION,
+        total DOUBLE PRECISION,
+        unit_cost DOUBLE PRECISION
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_invoice_items_invoice ON invoice_items(invoice_id)",
+    """CREATE TABLE IF NOT EXISTS transactions (
+        id BIGSERIAL PRIMARY KEY,
+        date TEXT,
+        customer_id BIGINT REFERENCES customers(id),
+        invoice_id BIGINT REFERENCES invoices(id),
+        type TEXT,
+        amount DOUBLE PRECISION,
+        balance DOUBLE PRECISION,
+        description TEXT,
+        created_by BIGINT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_transactions_customer ON transactions(customer_id)",
+    "CREATE INDEX IF NOT EXISTS idx_transactions_invoice ON transactions(invoice_id, type)",
+    """CREATE TABLE IF NOT EXISTS activity_log (
+        id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT,
+        action TEXT,
+        details TEXT,
+        ip_address TEXT,
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )""",
+)
+
+class PostgresStorage(Storage):
+    """PostgreSQL through a thread-safe connection pool (needs psycopg2). Not
+    selectable for the app yet; the contract tests run it against SMART_INVOICE_PG_DSN.
+    
+    Row locks instead of SQLite's single database lock, so writers from any
+    number of workers and hosts only wait on the rows they actually share.
+    """
+    
+    def __init__(self, dsn, minconn=1, maxconn=10, schema=None):
+        try:
+            import psycopg2
+            import psycopg2.extras
+            import psycopg2.pool
+        except ImportError:
+            raise RuntimeError("PostgreSQL storage needs psycopg2: pip install psycopg2-binary")
+        self.psycopg2 = psycopg2
+        extra = {"options": f"-c search_path={schema}"} if schema else {}
+        self.pool = psycopg2.pool.ThreadedConnectionPool(
+            minconn, maxconn, dsn, cursor_factory=psycopg2.extras.RealDictCursor, **extra)
+    
+    @contextmanager
+    def transaction(self):
+        conn = self.pool.getconn()
+        try:
+            with conn.cursor() as cursor:
+                yield _PgCursor(cursor)
+            conn.commit()
+        except self.psycopg2.IntegrityError as e:
+            conn.rollback()
+            if e.pgcode == "23505":  # unique_violation
+                raise DuplicateRecord(str(e)) from e
+            raise
+        except BaseException:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            # A connection the server dropped is discarded, not handed out again
+            self.pool.putconn(conn, close=bool(conn.closed))
+    
+    def insert(self, c, sql, params):
+        c.execute(sql + " RETURNING id", params)
+        return c.fetchone()['id']
+    
+    def init_schema(self):
+        with self.transaction() as c:
+            for ddl in PG_SCHEMA:
+                c.execute(ddl)
+    
+    def close(self):
+        self.pool.closeall()
+
+# What the app uses today: the current branch's SQLite database
+storage = SqliteStorage()
+
+def check_storage_contract(store):
+    """Exercise every Storage method against an empty store; raises
+    StorageContractError on the first difference from the contract."""
+    steps = []
+    
+    def step(name, ok):
+        steps.append(name)
+        if not ok:
+            raise StorageContractError(f"{name} failed")
+    
+    cid = store.add_customer("Contract Customer", "1 Test Street", "0300-0000000", "c@example.com")
+    step("add_customer returns id", isinstance(cid, int))
+    step("get_customer", store.get_customer(cid)['name'] == "Contract Customer")
+    try:
+        store.add_customer("Contract Customer", phone="0300-0000000")
+        step("duplicate customer raises DuplicateRecord", False)
+    except DuplicateRecord:
+        step("duplicate customer raises DuplicateRecord", True)
+    step("list_customers", [c['id'] for c in store.list_customers()] == [cid])
+    step("set_credit_limit", store.set_credit_limit(cid, 500) and store.get_customer(cid)['credit_limit'] == 500)
+    step("missing customer is None", store.get_customer(cid + 1000) is None)
+    
+    pid = store.add_product("Contract Pen", unit_price=10, purchase_price=6, stock=5)
+    step("get_product", store.get_product(pid)['stock'] == 5)
+    step("take_stock within stock", store.take_stock(pid, 3))
+    step("take_stock refuses to go negative", not store.take_stock(pid, 3))
+    step("stock after take_stock", store.get_product(pid)['stock'] == 2)
+    try:
+        store.add_product("Contract Pen")
+        step("duplicate product raises DuplicateRecord", False)
+    except DuplicateRecord:
+        step("duplicate product raises DuplicateRecord", True)
+    
+    invoice = {"inv_no": "CONTRACT-0001", "date": "2026-01-15", "customer_id": cid,
+               "customer_name": "Contract Customer", "subtotal": 30, "tax_rate": 0, "tax_amount": 0,
+               "discount": 0, "total": 30, "paid": 10, "balance": 20, "status": "partial"}
+    items = [{"product_id": pid, "product_name": "Contract Pen", "qty": 3, "unit_price": 10}]
+    iid = store.add_invoice(invoice, items)
+    got, got_items = store.get_invoice(iid)
+    step("get_invoice header", got['inv_no'] == "CONTRACT-0001" and got['balance'] == 20)
+    step("get_invoice items", [(i['product_name'], i['qty'], i['total']) for i in got_items]
+         == [("Contract Pen", 3, 30)])
+    step("missing invoice", store.get_invoice(iid + 1000) == (None, []))
+    try:
+        store.add_invoice(invoice, items)
+        step("duplicate inv_no raises DuplicateRecord", False)
+    except DuplicateRecord:
+        step("duplicate inv_no raises DuplicateRecord", True)
+    step("failed add_invoice is rolled back", len(store.list_invoices()) == 1)
+    step("list_invoices by customer", [i['id'] for i in store.list_invoices(customer_id=cid)] == [iid])
+    
+    store.add_transaction(cid, "invoice", 30, balance=20, invoice_id=iid, date="2026-01-15")
+    store.add_transaction(cid, "payment", 10, balance=10, date="2026-01-20")
+    step("list_transactions in date order",
+         [t['type'] for t in store.list_transactions(cid)] == ["invoice", "payment"])
+    
+    step("get_setting default", store.get_setting("contract_key", "none") == "none")
+    store.set_settings({"contract_key": "one"}, updated_by="1")
+    store.set_settings({"contract_key": "two"}, updated_by="1")
+    step("set_settings upserts", store.get_setting("contract_key") == "two")
+    step("get_settings", store.get_settings().get("contract_key") == "two")
+    
+    store.log_activity(1, "CONTRACT", "first")
+    store.log_activity(1, "CONTRACT", "second")
+    step("recent_activity newest first", [a['details'] for a in store.recent_activity(2)] == ["second", "first"])
+    return steps
+
+@contextmanager
+def scratch_storage(backend, dsn=None, directory=None):
+    """An empty store for contract runs: a new SQLite file (in directory, or
+    a temporary one) or a throwaway schema on the PostgreSQL server at dsn."""
+    if backend == "sqlite":
+        with tempfile.TemporaryDirectory(dir=directory) as tmp:
+            db_file = Path(tmp) / "contract.db"
+            init_db(db_file, shared=False)
+            yield SqliteStorage(db_file)
+        return
+    schema = f"smart_invoice_check_{os.getpid()}_{secrets.token_hex(4)}"
+    admin = PostgresStorage(dsn, maxconn=1)
+    try:
+        with admin.transaction() as c:
+            c.execute(f"CREATE SCHEMA {schema}")
+        store = PostgresStorage(dsn, schema=schema)
+        try:
+            store.init_schema()
+            yield store
+        finally:
+            store.close()
+            with admin.transaction() as c:
+                c.execute(f"DROP SCHEMA {schema} CASCADE")
+    finally:
+        admin.close()
+
+@app.cli.command("storage-check")
+@click.option("--backend", type=click.Choice(["sqlite", "postgres"]), default="sqlite")
+@click.option("--dsn", envvar="SMART_INVOICE_PG_DSN", help="PostgreSQL connection string.")
+def storage_check_command(backend, dsn):
+    """Run the storage contract against a scratch SQLite file or PostgreSQL schema."""
+    if backend == "postgres" and not dsn:
+        raise click.UsageError("--dsn or SMART_INVOICE_PG_DSN is required for postgres")
+    try:
+        with scratch_storage(backend, dsn) as store:
+            steps = check_storage_contract(store)
+    except (RuntimeError, StorageContractError) as e:
+        raise click.ClickException(f"{backend}: {e}")
+    print(f"✅ {backend}: {len(steps)} contract checks passed")
+
+# ===================== INVENTORY ENGINE =====================
+STOCK_MOVEMENT_TYPES = ('opening', 'sale', 'purchase', 'adjustment', 'return')
+
+def record_stock_movement(c, product_id, qty, movement_type, date=None, invoice_id=None, note=None, user_id=None):
+    """Append a signed quantity to the stock journal."""
+    date = date or datetime.date.today().isoformat()
+    c.execute("""
+        INSERT INTO stock_movements (product_id, date, type, qty, invoice_id, note, created_by)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, (product_id, date, movement_type, qty, invoice_id, note, user_id))
+    
+    # A back-dated movement shifts every snapshot taken on or after its date
+    c.execute("UPDATE stock_snapshots SET qty = qty + ? WHERE product_id = ? AND date >= ?",
+              (qty, product_id, date))
+
+# Closing stock per product on :as_of = latest snapshot on or before that
+# date plus the journal rows after it (indexed on product_id, date)
+STOCK_ON_DATE_SQL = """
+    SELECT p.id, p.name, p.unit, p.purchase_price,
+           COALESCE(s.qty, 0) + COALESCE((
+               SELECT SUM(m.qty) FROM stock_movements m
+               WHERE m.product_id = p.id
+                 AND m.date > COALESCE(s.date, '')
+                 AND m.date <= :as_of
+           ), 0) as qty
+    FROM products p
+    LEFT JOIN stock_snapshots s ON s.product_id = p.id AND s.date = (
+        SELECT MAX(date) FROM stock_snapshots
+        WHERE product_id = p.id AND date <= :as_of
+    )
+"""
+
+def stock_on_date(c, as_of):
+    """Stock quantity and valuation (at cost price) for every product on a date."""
+    c.execute(f"""
+        SELECT id, name, unit, purchase_price, qty, qty * purchase_price as value
+        FROM ({STOCK_ON_DATE_SQL})
+        ORDER BY name
+    """, {"as_of": as_of})
+    return c.fetchall()
+
+def take_stock_snapshot(c, as_of):
+    """Store closing stock for every product on a date."""
+    c.execute(f"""
+        INSERT OR REPLACE INTO stock_snapshots (product_id, date, qty)
+        SELECT id, :as_of, qty FROM ({STOCK_ON_DATE_SQL})
+    """, {"as_of": as_of})
+
+def last_month_end():
+    return datetime.date.today().replace(day=1) - datetime.timedelta(days=1)
+
+def ensure_stock_snapshots():
+    """Take any missing month-end snapshots up to the end of last month."""
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("SELECT MAX(date) as date FROM stock_snapshots")
+    last = c.fetchone()['date']
+    if not last:
+        c.execute("SELECT MIN(date) as date FROM stock_movements")
+        first = c.fetchone()['date']
+        if not first:
+            conn.close()
+            return 0
+        last = (datetime.date.fromisoformat(first[:10]).replace(day=1) - datetime.timedelta(days=1)).isoformat()
+    
+    cutoff = last_month_end()
+    month_end = datetime.date.fromisoformat(last[:10])
+    taken = 0
+    while True:
+        next_month = month_end + datetime.timedelta(days=1)
+        month_end = (next_month + datetime.timedelta(days=32)).replace(day=1) - datetime.timedelta(days=1)
+        if month_end > cutoff:
+            break
+        c.execute("BEGIN IMMEDIATE")
+        take_stock_snapshot(c, month_end.isoformat())
+        conn.commit()
+        taken += 1
+    
+    conn.close()
+    return taken
+
+def apply_stock_sale(c, invoice_id, items, date, user_id, policy="reject"):
+    """Take invoice quantities out of stock inside the caller's transaction.
+    
+    The caller must already hold the write lock (BEGIN IMMEDIATE). Every
+    decrement is a guarded UPDATE, so stock never goes below zero even if a
+    caller forgets the lock. Returns the list of shortfalls: with the
+    'backorder' policy the available quantity is taken and the rest is
+    recorded in backorders; with 'reject' short lines are left untouched and
+    the caller is expected to roll back.
+    """
+    wanted = {}
+    for item in items:
+        if not item.get('product_id'):
+            continue
+        product_id = int(item['product_id'])
+        wanted[product_id] = wanted.get(product_id, 0) + float(item['qty'])
+    
+    shortages = []
+    for product_id, qty in wanted.items():
+        c.execute("UPDATE products SET stock = stock - ? WHERE id = ? AND stock >= ?",
+                  (qty, product_id, qty))
+        if c.rowcount:
+            record_stock_movement(c, product_id, -qty, 'sale', date, invoice_id, user_id=user_id)
+            continue
+        
+        c.execute("SELECT name, stock FROM products WHERE id = ?", (product_id,))
+        product = c.fetchone()
+        if not product:
+            continue
+        available = max(product['stock'] or 0, 0)
+        shortages.append({
+            "product_id": product_id,
+            "name": product['name'],
+            "requested": qty,
+            "available": available,
+            "short": qty - available
+        })
+        
+        if policy == 'backorder':
+            if available > 0:
+                c.execute("UPDATE products SET stock = stock - ? WHERE id = ? AND stock >= ?",
+                          (available, product_id, available))
+                record_stock_movement(c, product_id, -available, 'sale', date, invoice_id, user_id=user_id)
+            c.execute("""
+                INSERT INTO backorders (invoice_id, product_id, product_name, qty)
+                VALUES (?, ?, ?, ?)
+            """, (invoice_id, product_id, product['name'], qty - available))
+    
+    return shortages
+
+def audit_stock(rebuild=False):
+    """Compare products.stock with the journal; optionally reset it from the journal."""
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("""
+        SELECT p.id, p.name, p.stock, COALESCE(SUM(m.qty), 0) as journal_stock
+        FROM products p
+        LEFT JOIN stock_movements m ON m.product_id = p.id
+        GROUP BY p.id
+        HAVING ABS(p.stock - journal_stock) > 1e-9
+    """)
+    mismatches = [dict(row) for row in c.fetchall()]
+    
+    if rebuild and mismatches:
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("""
+            UPDATE products SET stock = COALESCE(
+                (SELECT SUM(qty) FROM stock_movements m WHERE m.product_id = products.id), 0)
+        """)
+        conn.commit()
+    
+    conn.close()
+    return mismatches
+
+@app.cli.command("stock-audit")
+@click.option("--rebuild", is_flag=True, help="Reset products.stock from the stock journal.")
+def stock_audit_command(rebuild):
+    """Report products whose stock disagrees with the stock journal."""
+    mismatches = audit_stock(rebuild=rebuild)
+    for row in mismatches:
+        click.echo(f"{row['name']}: stock={row['stock']} journal={row['journal_stock']}")
+    if not mismatches:
+        click.echo("Stock matches the journal")
+    elif rebuild:
+        click.echo(f"Rebuilt stock for {len(mismatches)} product(s)")
+
+@app.cli.command("stock-snapshot")
+@click.option("--date", "as_of", default=None, help="Snapshot date (YYYY-MM-DD); default fills missing month ends.")
+def stock_snapshot_command(as_of):
+    """Record per-product stock snapshots."""
+    if as_of:
+        conn = get_db()
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        take_stock_snapshot(c, as_of)
+        conn.commit()
+        conn.close()
+        click.echo(f"Snapshot taken for {as_of}")
+    else:
+        click.echo(f"Took {ensure_stock_snapshots()} month-end snapshot(s)")
+
+def render_page(title, page_title, content, active_menu="dashboard"):
+    """Helper function to render a full page with sidebar"""
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+    
+    # Build alerts HTML
+    alerts_html = ""
+    messages = session.get('_flashes', [])
+    for category, message in messages:
+        alerts_html += f'<div class="alert alert-{category}"><i class="fas fa-{"check-circle" if category == "success" else "exclamation-circle" if category == "error" else "info-circle"}"></i> {message}</div>'
+    session['_flashes'] = []  # Clear flashes
+    
+    # Build admin menu if user is admin
     admin_menu = ""
     if session.get('role') == 'admin':
         admin_menu = """
@@ -759,6 +2346,9 @@ def render_page(title, page_title, content, active_menu="dashboard"):
             <a href="{url_users}" class="nav-item {active_users}">
                 <i class="fas fa-user-shield"></i> Users
             </a>
+            <a href="{url_branches}" class="nav-item {active_branches}">
+                <i class="fas fa-store"></i> Branches
+            </a>
             <a href="{url_settings}" class="nav-item {active_settings}">
                 <i class="fas fa-cog"></i> Settings
             </a>
@@ -767,9 +2357,11 @@ def render_page(title, page_title, content, active_menu="dashboard"):
             </a>
         """.format(
             url_users=url_for('users'),
+            url_branches=url_for('branches'),
             url_settings=url_for('settings'),
             url_backup=url_for('backup'),
             active_users="active" if active_menu == "users" else "",
+            active_branches="active" if active_menu == "branches" else "",
             active_settings="active" if active_menu == "settings" else "",
             active_backup="active" if active_menu == "backup" else ""
         )
@@ -782,6 +2374,8 @@ def render_page(title, page_title, content, active_menu="dashboard"):
         url_customers=url_for('customers'),
         url_products=url_for('products'),
         url_ledger=url_for('ledger'),
+        url_expenses=url_for('expenses'),
+        url_reports=url_for('reports'),
         url_logout=url_for('logout'),
         active_dashboard="active" if active_menu == "dashboard" else "",
         active_new_invoice="active" if active_menu == "new_invoice" else "",
@@ -789,9 +2383,12 @@ def render_page(title, page_title, content, active_menu="dashboard"):
         active_customers="active" if active_menu == "customers" else "",
         active_products="active" if active_menu == "products" else "",
         active_ledger="active" if active_menu == "ledger" else "",
+        active_expenses="active" if active_menu == "expenses" else "",
+        active_reports="active" if active_menu == "reports" else "",
         admin_menu=admin_menu,
         page_title=page_title,
         full_name=session.get('full_name', 'User'),
+        branch=session.get('branch', MAIN_BRANCH),
         avatar=session.get('full_name', 'U')[0].upper(),
         alerts=alerts_html,
         content=content
@@ -805,6 +2402,260 @@ def render_login_page(alerts=""):
     head = HTML_HEAD.replace("{title}", "Login - Smart Invoice Pro")
     return head + HTML_LOGIN.replace("{alerts}", alerts) + HTML_FOOTER
 
+# ===================== METRICS =====================
+# Per-worker, in-memory; every series carries the worker pid so scrapes of
+# different gunicorn workers can be told apart and summed
+SLOW_REQUEST_SECONDS = float(os.environ.get("SLOW_REQUEST_SECONDS", 1.0))
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name, self.help, self.labels = name, help_text, labels
+        self.values = {}
+        self.lock = threading.Lock()
+    
+    def inc(self, label_values=(), amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_labels(self.labels, label_values)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help_text, labels, buckets
+        self.series = {}  # label values -> [bucket counts..., sum, count]
+        self.lock = threading.Lock()
+    
+    def observe(self, value, label_values=()):
+        with self.lock:
+            series = self.series.setdefault(label_values, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for label_values, series in sorted(self.series.items()):
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f"{self.name}_bucket{_labels(self.labels + ('le',), label_values + (bound,))} {count}")
+                lines.append(f"{self.name}_bucket{_labels(self.labels + ('le',), label_values + ('+Inf',))} {series[-1]}")
+                lines.append(f"{self.name}_sum{_labels(self.labels, label_values)} {series[-2]:.6f}")
+                lines.append(f"{self.name}_count{_labels(self.labels, label_values)} {series[-1]}")
+        return lines
+
+def _labels(names, values):
+    pairs = [("worker", os.getpid())] + list(zip(names, values))
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+REQUEST_LATENCY = Histogram("http_request_duration_seconds", "Request latency by route.", ("endpoint", "method"))
+REQUESTS_TOTAL = Counter("http_requests_total", "Requests by route and status.", ("endpoint", "method", "status"))
+SQL_QUERIES_TOTAL = Counter("sql_queries_total", "SQL statements executed by route.", ("endpoint",))
+SQL_SECONDS_TOTAL = Counter("sql_query_seconds_total", "Time spent in SQL statements by route.", ("endpoint",))
+SQL_PER_REQUEST = Histogram("sql_queries_per_request", "SQL statements per request.", ("endpoint",),
+                            buckets=(1, 2, 5, 10, 20, 50, 100, 250, 1000))
+PDF_RENDER_SECONDS = Histogram("pdf_render_seconds", "Invoice PDF render time.")
+SNAPSHOT_REFRESH_SECONDS = Histogram("read_snapshot_refresh_seconds", "Time to copy the read snapshot.")
+SLOW_REQUESTS_TOTAL = Counter("slow_requests_total", "Requests slower than SLOW_REQUEST_SECONDS.", ("endpoint",))
+INVOICE_CACHE_TOTAL = Counter("invoice_render_cache_total", "Invoice render cache lookups by tier.",
+                              ("kind", "result"))
+STARTUP_SECONDS = Counter("app_startup_seconds", "Worker startup time by phase.", ("phase",))
+JOBS_TOTAL = Counter("jobs_total", "Background jobs by kind and outcome.", ("kind", "status"))
+JOB_SECONDS = Histogram("job_run_seconds", "Background job run time.", ("kind",))
+METRICS = (REQUEST_LATENCY, REQUESTS_TOTAL, SQL_QUERIES_TOTAL, SQL_SECONDS_TOTAL,
+           SQL_PER_REQUEST, PDF_RENDER_SECONDS, SLOW_REQUESTS_TOTAL, STARTUP_SECONDS,
+           INVOICE_CACHE_TOTAL, SNAPSHOT_REFRESH_SECONDS, JOBS_TOTAL, JOB_SECONDS)
+
+slow_log = logging.getLogger("smart_invoice.slow")
+
+def _slow_log():
+    if not slow_log.handlers:
+        log_dir = BASE_DATA / "logs"
+        log_dir.mkdir(parents=True, exist_ok=True)
+        handler = logging.FileHandler(log_dir / "slow_requests.log", encoding="utf-8")
+        handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        slow_log.addHandler(handler)
+        slow_log.setLevel(logging.WARNING)
+    return slow_log
+
+@app.before_request
+def start_request_timer():
+    if not _app_ready:
+        create_app()
+    g.request_started = time.perf_counter()
+    g.sql_trace = []
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.get('request_started')
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    endpoint = request.endpoint or "unmatched"
+    trace = g.get('sql_trace') or []
+    sql_seconds = sum(seconds for _, seconds in trace)
+    
+    REQUEST_LATENCY.observe(elapsed, (endpoint, request.method))
+    REQUESTS_TOTAL.inc((endpoint, request.method, response.status_code))
+    SQL_QUERIES_TOTAL.inc((endpoint,), len(trace))
+    SQL_SECONDS_TOTAL.inc((endpoint,), sql_seconds)
+    SQL_PER_REQUEST.observe(len(trace), (endpoint,))
+    
+    if elapsed >= SLOW_REQUEST_SECONDS:
+        SLOW_REQUESTS_TOTAL.inc((endpoint,))
+        slowest = sorted(trace, key=lambda q: q[1], reverse=True)[:10]
+        _slow_log().warning(
+            "%s %s %.3fs status=%s sql=%d/%.3fs\n%s", request.method, request.full_path.rstrip("?"),
+            elapsed, response.status_code, len(trace), sql_seconds,
+            "\n".join(f"    {seconds * 1000:8.1f} ms  {' '.join(sql.split())[:300]}" for sql, seconds in slowest))
+    return response
+
+@app.route("/metrics")
+def metrics():
+    if METRICS_TOKEN:
+        if request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+            abort(401)
+    elif not current_user() or session.get('role') != 'admin':
+        abort(403)
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+# ===================== SQL PROFILER (DEVELOPMENT) =====================
+# Off unless SQL_PROFILER=1: runs EXPLAIN QUERY PLAN for every distinct
+# statement, which is far too slow for production traffic
+SQL_PROFILER = os.environ.get("SQL_PROFILER") == "1"
+PROFILER_DIR = BASE_DATA / "profiler"
+PROFILER_REPEAT_THRESHOLD = 3  # same statement this often in one request looks like N+1
+PROFILER_KEEP = 50
+
+_profiles = OrderedDict()
+_profiles_lock = threading.Lock()
+
+def _normalize_sql(sql):
+    return " ".join(sql.split())
+
+def _explain(conn, sql, parameters):
+    verb = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else ""
+    if verb not in ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "REPLACE"):
+        return []
+    if parameters is None:
+        parameters = [None] * sql.count("?")
+    try:
+        # A plain cursor, so the EXPLAIN itself is not traced
+        cursor = conn.cursor(sqlite3.Cursor)
+        return [row[-1] for row in cursor.execute("EXPLAIN QUERY PLAN " + sql, parameters)]
+    except sqlite3.Error as e:
+        return [f"(no plan: {e})"]
+
+def profile_query(profile, conn, sql, parameters, seconds, many):
+    key = _normalize_sql(sql)
+    plan = profile["plans"].get(key)
+    if plan is None:
+        plan = profile["plans"][key] = _explain(conn, sql, parameters)
+    profile["queries"].append({
+        "sql": key,
+        "params": None if many else repr(parameters)[:200],
+        "executemany": many,
+        "ms": round(seconds * 1000, 3),
+        "plan": plan,
+        # "SCAN t" without an index is a full table scan ("SCAN t USING INDEX" is not)
+        "full_scan": any(step.startswith("SCAN ") and " USING " not in step for step in plan),
+    })
+
+def finish_profile(profile, response, elapsed):
+    counts = {}
+    for q in profile["queries"]:
+        entry = counts.setdefault(q["sql"], {"sql": q["sql"], "count": 0, "ms": 0.0})
+        entry["count"] += 1
+        entry["ms"] = round(entry["ms"] + q["ms"], 3)
+    profile.pop("plans")
+    profile.update({
+        "status": response.status_code,
+        "ms": round(elapsed * 1000, 3),
+        "sql_ms": round(sum(q["ms"] for q in profile["queries"]), 3),
+        "repeated": sorted((e for e in counts.values() if e["count"] >= PROFILER_REPEAT_THRESHOLD),
+                           key=lambda e: e["count"], reverse=True),
+        "full_scans": sorted({q["sql"] for q in profile["queries"] if q["full_scan"]}),
+    })
+    with _profiles_lock:
+        _profiles[profile["id"]] = profile
+        while len(_profiles) > PROFILER_KEEP:
+            _profiles.popitem(last=False)
+    PROFILER_DIR.mkdir(parents=True, exist_ok=True)
+    with open(PROFILER_DIR / f"{profile['id']}.json", "w", encoding="utf-8") as f:
+        json.dump(profile, f, indent=2)
+
+def profiler_panel(profile):
+    """Fixed overlay listing the request's statements, N+1 suspects and scans."""
+    rows = ""
+    for q in profile["queries"]:
+        flags = ""
+        if q["full_scan"]:
+            flags += '<span class="badge badge-danger">SCAN</span> '
+        if any(r["sql"] == q["sql"] for r in profile["repeated"]):
+            flags += '<span class="badge badge-warning">N+1</span> '
+        sql_text = q["sql"].replace("<", "&lt;")
+        plan_text = " | ".join(q["plan"]).replace("<", "&lt;")
+        rows += f"""<tr><td style="padding: 0.25rem;">{q['ms']:.2f}</td><td style="padding: 0.25rem;">{flags}<code>{sql_text[:400]}</code><br><small style="color: var(--text-muted);">{plan_text}</small></td></tr>"""
+    summary = (f"SQL {len(profile['queries'])} q / {profile['sql_ms']:.1f} ms of {profile['ms']:.1f} ms"
+               f" &middot; {len(profile['repeated'])} repeated &middot; {len(profile['full_scans'])} scans")
+    return f"""
+    <div id="sqlProfiler" class="no-print" style="position: fixed; bottom: 0; right: 0; z-index: 2000; max-width: 60vw; font-size: 0.75rem;">
+        <details style="background: var(--card); border: 1px solid var(--border); box-shadow: var(--shadow); border-radius: 8px 0 0 0;">
+            <summary style="padding: 0.5rem 1rem; cursor: pointer; color: {'var(--danger)' if profile['repeated'] or profile['full_scans'] else 'var(--text-muted)'};">
+                <i class="fas fa-database"></i> {summary}
+                <a href="/_profiler/{profile['id']}.json" target="_blank" style="margin-left: 0.5rem;">JSON</a>
+            </summary>
+            <div style="max-height: 50vh; overflow: auto;"><table>{rows}</table></div>
+        </details>
+    </div>
+    """
+
+@app.before_request
+def start_profile():
+    if SQL_PROFILER and not request.path.startswith(("/_profiler", "/static")):
+        g.profile = {
+            "id": f"{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}-{secrets.token_hex(3)}",
+            "method": request.method,
+            "path": request.full_path.rstrip("?"),
+            "endpoint": request.endpoint,
+            "queries": [],
+            "plans": {},
+        }
+
+@app.after_request
+def finish_request_profile(response):
+    profile = g.pop('profile', None)
+    if profile is None:
+        return response
+    finish_profile(profile, response, time.perf_counter() - g.get('request_started', time.perf_counter()))
+    response.headers["X-SQL-Profile"] = profile["id"]
+    if response.mimetype == "text/html" and not response.direct_passthrough and not response.is_streamed:
+        body = response.get_data(as_text=True)
+        if "</body>" in body:
+            response.set_data(body.replace("</body>", profiler_panel(profile) + "</body>", 1))
+    return response
+
+@app.route("/_profiler/<profile_id>.json")
+def profiler_json(profile_id):
+    if not SQL_PROFILER:
+        abort(404)
+    with _profiles_lock:
+        profile = _profiles.get(profile_id)
+    if profile is None:
+        abort(404)
+    return jsonify(profile)
+
 # ===================== AUTHENTICATION ROUTES =====================
 @app.route("/login", methods=["GET", "POST"])
 def login():
@@ -816,22 +2667,39 @@ def login():
             flash("Username and password required", "error")
             return redirect(url_for('login'))
         
-        conn = get_db()
+        throttle_keys = {"ip": request.remote_addr or "unknown", "user": username.lower()}
+        wait = login_throttle.retry_after(**throttle_keys)
+        if wait:
+            flash(f"Too many failed attempts. Try again in {wait} seconds.", "error")
+            return redirect(url_for('login'))
+        
+        conn = get_main_db()
         c = conn.cursor()
         c.execute("""
-            SELECT id, username, full_name, role, is_active 
+            SELECT id, username, full_name, role, is_active, password_hash, branch
             FROM users 
-            WHERE username = ? AND password_hash = ?
-        """, (username, hash_password(password)))
+            WHERE username = ?
+        """, (username,))
         
         user = c.fetchone()
+        matches, needs_rehash = verify_password(user['password_hash'] if user else dummy_password_hash(),
+                                                password)
+        if not user:
+            matches = False
         
-        if user and user['is_active']:
+        if matches and user['is_active']:
+            login_throttle.reset(user=throttle_keys["user"])
+            session.clear()
+            session['sid'] = start_user_session(c, user)
             session['user_id'] = user['id']
             session['username'] = user['username']
             session['full_name'] = user['full_name']
             session['role'] = user['role']
+            session['branch'] = user['branch'] or MAIN_BRANCH
             
+            if needs_rehash:
+                c.execute("UPDATE users SET password_hash = ? WHERE id = ?",
+                          (hash_password(password), user['id']))
             c.execute("UPDATE users SET last_login = CURRENT_TIMESTAMP WHERE id = ?", (user['id'],))
             conn.commit()
             log_activity(user['id'], "LOGIN", f"User {username} logged in")
@@ -841,6 +2709,8 @@ def login():
             return redirect(url_for('dashboard'))
         else:
             conn.close()
+            if not matches:
+                login_throttle.fail(**throttle_keys)
             flash("Invalid credentials or account disabled", "error")
             return redirect(url_for('login'))
     
@@ -857,6 +2727,10 @@ def login():
 def logout():
     if 'user_id' in session:
         log_activity(session['user_id'], "LOGOUT", f"User {session.get('username')} logged out")
+    if session.get('sid'):
+        conn = get_main_db()
+        revoke_user_sessions(conn, sid=session['sid'])
+        conn.close()
     session.clear()
     flash("Logged out successfully", "success")
     return redirect(url_for('login'))
@@ -865,7 +2739,7 @@ def logout():
 @app.route("/")
 @login_required
 def dashboard():
-    conn = get_db()
+    conn = get_read_db()
     c = conn.cursor()
     
     # Today's stats
@@ -968,7 +2842,228 @@ def dashboard():
     
     return render_page("Dashboard - Smart Invoice Pro", "Dashboard", content, "dashboard")
 
+# ===================== INVOICE RENDER CACHE =====================
+INVOICE_CACHE_DIR = BASE_DATA / "cache" / "invoices"
+INVOICE_CACHE_MAX_BYTES = int(os.environ.get("INVOICE_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+INVOICE_CACHE_TTL = 300  # seconds a memory entry is trusted before its version is re-read
+
+def load_invoice(id):
+    """(invoice, items); (None, []) if missing."""
+    return storage.get_invoice(id)
+
+class InvoiceRenderCache:
+    """Rendered invoices (view fragment, PDF) keyed by branch, kind, id and version.
+    
+    Memory tier: per-worker LRU bounded by bytes. Hits cost no SQL; entries
+    are re-checked against invoices.version after INVOICE_CACHE_TTL, and the
+    whole tier is dropped when the "invoices" stamp moves (payments, settings).
+    Disk tier: shared by all workers and restarts; file names carry the
+    version, so a changed invoice simply misses and old files are replaced.
+    """
+    
+    def __init__(self, directory, max_bytes, ttl):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()  # (branch, kind, id) -> (checked_at, version, inv_no, data)
+        self.size = 0
+        self.stamp = None
+        self.lock = threading.Lock()
+    
+    def _path(self, branch, kind, id, version):
+        return self.directory / branch / f"{kind}-{id}-v{version}"
+    
+    def _remember(self, key, entry):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old:
+                self.size -= len(old[3])
+            self.entries[key] = entry
+            self.size += len(entry[3])
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted[3])
+    
+    def _read_disk(self, branch, kind, id, version):
+        try:
+            inv_no, _, data = self._path(branch, kind, id, version).read_bytes().partition(b"\n")
+            return inv_no.decode("utf-8"), data
+        except FileNotFoundError:
+            return None
+    
+    def _write_disk(self, branch, kind, id, version, inv_no, data):
+        path = self._path(branch, kind, id, version)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+        with os.fdopen(fd, "wb") as f:
+            f.write(inv_no.encode("utf-8") + b"\n" + data)
+        os.replace(tmp, path)
+        for stale in path.parent.glob(f"{kind}-{id}-v*"):
+            if stale != path:
+                stale.unlink(missing_ok=True)
+    
+    def get(self, kind, id, build):
+        """(inv_no, bytes) for the invoice, or None if it does not exist.
+        build(id) renders a miss and returns (version, inv_no, bytes) or None;
+        with build=None a miss returns None too (cached copies only)."""
+        branch = current_branch()
+        key = (branch, kind, id)
+        stamp = read_stamp("invoices")
+        now = time.monotonic()
+        with self.lock:
+            if stamp != self.stamp:
+                self.entries.clear()
+                self.size = 0
+                self.stamp = stamp
+            entry = self.entries.get(key)
+            if entry and now - entry[0] < self.ttl:
+                self.entries.move_to_end(key)
+                INVOICE_CACHE_TOTAL.inc((kind, "memory"))
+                return entry[2], entry[3]
+        
+        conn = get_db()
+        row = conn.execute("SELECT version FROM invoices WHERE id = ?", (id,)).fetchone()
+        conn.close()
+        if not row:
+            return None
+        version = row['version']
+        if entry and entry[1] == version:
+            self._remember(key, (now, version, entry[2], entry[3]))
+            INVOICE_CACHE_TOTAL.inc((kind, "memory"))
+            return entry[2], entry[3]
+        
+        hit = self._read_disk(branch, kind, id, version)
+        if hit:
+            INVOICE_CACHE_TOTAL.inc((kind, "disk"))
+            inv_no, data = hit
+        else:
+            INVOICE_CACHE_TOTAL.inc((kind, "miss"))
+            if build is None:
+                return None
+            built = build(id)
+            if built is None:
+                return None
+            version, inv_no, data = built
+            self._write_disk(branch, kind, id, version, inv_no, data)
+        self._remember(key, (now, version, inv_no, data))
+        return inv_no, data
+    
+    def clear(self):
+        """Forget everything, in every worker (for changes outside invoices.version)."""
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+        shutil.rmtree(self.directory, ignore_errors=True)
+        bump_stamp("invoices")
+
+invoice_cache = InvoiceRenderCache(INVOICE_CACHE_DIR, INVOICE_CACHE_MAX_BYTES, INVOICE_CACHE_TTL)
+
 # ===================== INVOICE MANAGEMENT =====================
+class InsufficientStock(Exception):
+    """Raised by create_invoice() when the stock policy rejects the sale."""
+    def __init__(self, shortages):
+        super().__init__("Insufficient stock")
+        self.shortages = shortages
+
+class InvalidInvoice(ValueError):
+    """Raised by create_invoice() for data it will not store, such as a bad date."""
+
+def create_invoice(c, data, user, source='app'):
+    """Insert an invoice with its items, stock, P&L and ledger effects.
+    
+    `c` must belong to an open write transaction (BEGIN IMMEDIATE); the caller
+    commits or rolls back. Returns (invoice_id, inv_no, backorders) and raises
+    InsufficientStock when the 'reject' policy refuses the sale. A missing
+    date means today; one that is not YYYY-MM-DD raises InvalidInvoice.
+    """
+    try:
+        date = datetime.date.fromisoformat(data.get('date') or datetime.date.today().isoformat()).isoformat()
+    except (TypeError, ValueError):
+        raise InvalidInvoice("date must be YYYY-MM-DD")
+    customer_id = data.get('customer_id')
+    items = data.get('items', [])
+    
+    # Calculate totals
+    subtotal = sum(item['qty'] * item['price'] for item in items)
+    tax_rate = float(get_setting('tax_rate', 0))
+    tax_amount = subtotal * (tax_rate / 100)
+    discount = float(data.get('discount', 0))
+    total = subtotal + tax_amount - discount
+    paid = float(data.get('paid', 0))
+    balance = total - paid
+    stock_policy = get_setting('stock_policy', 'reject')
+    
+    # Determine status
+    if balance <= 0:
+        status = 'paid'
+    elif paid > 0:
+        status = 'partial'
+    else:
+        status = 'pending'
+    
+    inv_no = generate_invoice_number(c)
+    
+    # Get customer details
+    c.execute("SELECT name, address, phone FROM customers WHERE id = ?", (customer_id,))
+    customer = c.fetchone()
+    
+    # Insert invoice
+    c.execute("""
+        INSERT INTO invoices 
+        (inv_no, date, customer_id, customer_name, customer_address, customer_phone,
+         salesman_id, salesman_name, subtotal, tax_rate, tax_amount, discount, 
+         total, paid, balance, status, payment_method, notes, source)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (inv_no, date, customer_id, 
+          customer['name'] if customer else data.get('customer_name'),
+          customer['address'] if customer else data.get('address'),
+          customer['phone'] if customer else data.get('phone'),
+          user['id'], user['full_name'],
+          subtotal, tax_rate, tax_amount, discount, total, paid, balance,
+          status, data.get('payment_method', 'cash'), data.get('notes'), source))
+    
+    invoice_id = c.lastrowid
+    
+    # Insert items
+    c.executemany("""
+        INSERT INTO invoice_items 
+        (invoice_id, product_id, product_name, qty, unit_price, total)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, [(invoice_id, item.get('product_id'), item['name'],
+           item['qty'], item['price'], item['qty'] * item['price']) for item in items])
+    
+    # Freeze cost price on the lines and roll the sale into the P&L
+    c.execute("""
+        UPDATE invoice_items SET unit_cost =
+            (SELECT purchase_price FROM products WHERE id = invoice_items.product_id)
+        WHERE invoice_id = ?
+    """, (invoice_id,))
+    c.execute("SELECT COALESCE(SUM(qty * unit_cost), 0) FROM invoice_items WHERE invoice_id = ?",
+              (invoice_id,))
+    bump_monthly_pnl(c, date, revenue=subtotal - discount, tax=tax_amount,
+                     cogs=c.fetchone()[0])
+    bump_monthly_product_sales(c, invoice_id, date)
+    
+    # Update stock
+    shortages = apply_stock_sale(c, invoice_id, items, date, user['id'], stock_policy)
+    if shortages and stock_policy != 'backorder':
+        raise InsufficientStock(shortages)
+    
+    # Update customer balance
+    if customer_id:
+        c.execute("UPDATE customers SET balance = balance + ? WHERE id = ?", 
+                 (balance, customer_id))
+        
+        # Add to ledger
+        c.execute("""
+            INSERT INTO transactions 
+            (date, customer_id, invoice_id, type, amount, balance, description, created_by)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (date, customer_id, invoice_id, 'invoice', 
+              total, balance, f"Invoice #{inv_no}", user['id']))
+    
+    return invoice_id, inv_no, shortages
+
 @app.route("/invoice/new", methods=["GET", "POST"])
 @login_required
 def new_invoice():
@@ -977,81 +3072,33 @@ def new_invoice():
     
     if request.method == "POST":
         data = request.get_json()
+        user = {"id": session['user_id'], "full_name": session['full_name']}
         
-        # Create invoice
-        inv_no = generate_invoice_number()
-        customer_id = data.get('customer_id')
-        items = data.get('items', [])
-        
-        # Calculate totals
-        subtotal = sum(item['qty'] * item['price'] for item in items)
-        tax_rate = float(get_setting('tax_rate', 0))
-        tax_amount = subtotal * (tax_rate / 100)
-        discount = float(data.get('discount', 0))
-        total = subtotal + tax_amount - discount
-        paid = float(data.get('paid', 0))
-        balance = total - paid
-        
-        # Determine status
-        if balance <= 0:
-            status = 'paid'
-        elif paid > 0:
-            status = 'partial'
-        else:
-            status = 'pending'
-        
-        # Get customer details
-        c.execute("SELECT name, address, phone FROM customers WHERE id = ?", (customer_id,))
-        customer = c.fetchone()
-        
-        # Insert invoice
-        c.execute("""
-            INSERT INTO invoices 
-            (inv_no, date, customer_id, customer_name, customer_address, customer_phone,
-             salesman_id, salesman_name, subtotal, tax_rate, tax_amount, discount, 
-             total, paid, balance, status, payment_method, notes)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (inv_no, data.get('date'), customer_id, 
-              customer['name'] if customer else data.get('customer_name'),
-              customer['address'] if customer else data.get('address'),
-              customer['phone'] if customer else data.get('phone'),
-              session['user_id'], session['full_name'],
-              subtotal, tax_rate, tax_amount, discount, total, paid, balance,
-              status, data.get('payment_method', 'cash'), data.get('notes')))
-        
-        invoice_id = c.lastrowid
-        
-        # Insert items and update stock
-        for item in items:
-            c.execute("""
-                INSERT INTO invoice_items 
-                (invoice_id, product_id, product_name, qty, unit_price, total)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (invoice_id, item.get('product_id'), item['name'], 
-                  item['qty'], item['price'], item['qty'] * item['price']))
-            
-            # Update stock
-            c.execute("UPDATE products SET stock = stock - ? WHERE id = ?", 
-                     (item['qty'], item.get('product_id')))
-        
-        # Update customer balance
-        if customer_id:
-            c.execute("UPDATE customers SET balance = balance + ? WHERE id = ?", 
-                     (balance, customer_id))
-            
-            # Add to ledger
-            c.execute("""
-                INSERT INTO transactions 
-                (date, customer_id, invoice_id, type, amount, balance, description, created_by)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, (data.get('date'), customer_id, invoice_id, 'invoice', 
-                  total, balance, f"Invoice #{inv_no}", session['user_id']))
+        try:
+            # Take the write lock up front so numbering, stock and balances are
+            # decided against the same state; readers are not blocked (WAL)
+            c.execute("BEGIN IMMEDIATE")
+            invoice_id, inv_no, shortages = create_invoice(c, data, user)
+            conn.commit()
+        except InsufficientStock as e:
+            conn.rollback()
+            conn.close()
+            return jsonify({"success": False, "error": "Insufficient stock",
+                            "shortages": e.shortages}), 409
+        except InvalidInvoice as e:
+            conn.rollback()
+            conn.close()
+            return jsonify({"success": False, "error": str(e)}), 400
+        except sqlite3.OperationalError as e:
+            conn.rollback()
+            conn.close()
+            return jsonify({"success": False, "error": f"Database busy, please retry ({e})"}), 503
         
-        conn.commit()
         log_activity(session['user_id'], "CREATE_INVOICE", f"Created invoice {inv_no}")
         
         conn.close()
-        return jsonify({"success": True, "invoice_id": invoice_id, "inv_no": inv_no})
+        return jsonify({"success": True, "invoice_id": invoice_id, "inv_no": inv_no,
+                        "backorders": shortages})
     
     # GET request - show form
     c.execute("SELECT id, name, address, phone, balance FROM customers ORDER BY name")
@@ -1285,10 +3332,16 @@ def new_invoice():
             
             const result = await response.json();
             if (result.success) {{
-                alert('Invoice created successfully!');
+                let message = 'Invoice created successfully!';
+                if (result.backorders && result.backorders.length) {{
+                    message += '\\n\\nBack-ordered:\\n' + result.backorders.map(s => `${{s.name}}: ${{s.short}}`).join('\\n');
+                }}
+                alert(message);
                 window.location.href = '{url_for('view_invoice', id=0)}'.replace('0', result.invoice_id);
+            }} else if (result.shortages) {{
+                alert('Insufficient stock:\\n' + result.shortages.map(s => `${{s.name}}: requested ${{s.requested}}, available ${{s.available}}`).join('\\n'));
             }} else {{
-                alert('Error creating invoice');
+                alert(result.error || 'Error creating invoice');
             }}
         }});
         
@@ -1302,7 +3355,7 @@ def new_invoice():
 @app.route("/invoices")
 @login_required
 def invoices():
-    conn = get_db()
+    conn = get_read_db()
     c = conn.cursor()
     
     c.execute("""
@@ -1343,9 +3396,20 @@ def invoices():
             <div style="display: flex; gap: 1rem;">
                 <input type="text" id="searchInput" class="form-control" placeholder="Search invoices..." style="width: 300px;">
             </div>
-            <a href="{url_for('new_invoice')}" class="btn btn-primary">
-                <i class="fas fa-plus"></i> New Invoice
-            </a>
+            <div style="display: flex; gap: 0.5rem;">
+                <a href="{url_for('export_data', dataset='invoices', fmt='csv')}" class="btn btn-secondary">
+                    <i class="fas fa-file-csv"></i> CSV
+                </a>
+                <a href="{url_for('export_data', dataset='invoices', fmt='xlsx')}" class="btn btn-secondary">
+                    <i class="fas fa-file-excel"></i> Excel
+                </a>
+                <a href="{url_for('export_data', dataset='items', fmt='xlsx')}" class="btn btn-secondary">
+                    <i class="fas fa-list"></i> Items
+                </a>
+                <a href="{url_for('new_invoice')}" class="btn btn-primary">
+                    <i class="fas fa-plus"></i> New Invoice
+                </a>
+            </div>
         </div>
         
         <div class="table-container">
@@ -1385,24 +3449,17 @@ def invoices():
 @app.route("/invoice/<int:id>")
 @login_required
 def view_invoice(id):
-    conn = get_db()
-    c = conn.cursor()
-    
-    c.execute("""
-        SELECT i.*, c.name as customer_name, c.phone as customer_phone, c.address as customer_address
-        FROM invoices i 
-        LEFT JOIN customers c ON i.customer_id = c.id 
-        WHERE i.id = ?
-    """, (id,))
-    invoice = c.fetchone()
-    
-    if not invoice:
+    cached = invoice_cache.get("html", id, render_invoice_html)
+    if cached is None:
         abort(404)
-    
-    c.execute("SELECT * FROM invoice_items WHERE invoice_id = ?", (id,))
-    items = c.fetchall()
-    
-    conn.close()
+    inv_no, content = cached
+    return render_page(f"Invoice {inv_no} - Smart Invoice Pro", "Invoice Details", content.decode("utf-8"), "invoices")
+
+def render_invoice_html(id):
+    """The invoice card for view_invoice, as (version, inv_no, bytes) for the cache."""
+    invoice, items = load_invoice(id)
+    if not invoice:
+        return None
     
     # Build items rows
     items_rows = ""
@@ -1426,6 +3483,26 @@ def view_invoice(id):
         </div>
         """
     
+    payment_form = ""
+    if invoice['balance'] > 0:
+        payment_form = f"""
+    <form method="POST" action="{url_for('record_payment', id=id)}" class="card no-print" style="margin-top: 2rem; display: flex; gap: 1rem; align-items: flex-end; flex-wrap: wrap;">
+        <div class="form-group" style="margin: 0;">
+            <label class="form-label">Receive Payment</label>
+            <input type="number" name="amount" step="0.01" min="0.01" max="{invoice['balance']:.2f}" value="{invoice['balance']:.2f}" class="form-control" required>
+        </div>
+        <div class="form-group" style="margin: 0;">
+            <label class="form-label">Method</label>
+            <select name="payment_method" class="form-control">
+                <option value="cash">Cash</option>
+                <option value="bank">Bank</option>
+                <option value="card">Card</option>
+            </select>
+        </div>
+        <button type="submit" class="btn btn-success"><i class="fas fa-money-bill"></i> Record Payment</button>
+    </form>
+        """
+    
     content = f"""
     <div class="card" id="invoiceCard">
         <div style="display: flex; justify-content: space-between; margin-bottom: 2rem;">
@@ -1499,15 +3576,503 @@ def view_invoice(id):
         </button>
         <a href="{url_for('invoices')}" class="btn btn-secondary">Back to List</a>
     </div>
+    {payment_form}
+    """
+    
+    return invoice['version'], invoice['inv_no'], content.encode("utf-8")
+
+@app.route("/invoice/<int:id>/payment", methods=["POST"])
+@login_required
+def record_payment(id):
+    """Take a payment against an invoice: invoice, customer balance and ledger."""
+    amount = request.form.get('amount', 0, type=float) or 0
+    if not math.isfinite(amount):
+        amount = 0
+    amount = round(amount, 2)
+    method = request.form.get('payment_method', 'cash')
+    try:
+        date = datetime.date.fromisoformat(request.form.get('date') or datetime.date.today().isoformat()).isoformat()
+    except ValueError:
+        flash("Payment date must be a date (YYYY-MM-DD)", "error")
+        return redirect(url_for('view_invoice', id=id))
+    
+    conn = get_db()
+    c = conn.cursor()
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("SELECT inv_no, customer_id, total, paid, balance FROM invoices WHERE id = ?", (id,))
+        invoice = c.fetchone()
+        if not invoice:
+            conn.rollback()
+            conn.close()
+            abort(404)
+        if amount <= 0 or amount > round(invoice['balance'], 2):
+            conn.rollback()
+            conn.close()
+            flash(f"Payment must be between 0 and the balance due (Rs {invoice['balance']:.2f})", "error")
+            return redirect(url_for('view_invoice', id=id))
+        
+        paid = invoice['paid'] + amount
+        balance = round(invoice['total'] - paid, 2)
+        status = 'paid' if balance <= 0 else 'partial'
+        c.execute("UPDATE invoices SET paid = ?, balance = ?, status = ?, payment_method = ? WHERE id = ?",
+                  (paid, balance, status, method, id))
+        if invoice['customer_id']:
+            c.execute("UPDATE customers SET balance = balance - ? WHERE id = ?", (amount, invoice['customer_id']))
+            c.execute("""
+                INSERT INTO transactions
+                (date, customer_id, invoice_id, type, amount, balance, description, created_by)
+                VALUES (?, ?, ?, 'payment', ?, ?, ?, ?)
+            """, (date, invoice['customer_id'], id, amount, balance,
+                  f"Payment for #{invoice['inv_no']}", session['user_id']))
+        conn.commit()
+    except sqlite3.OperationalError as e:
+        conn.rollback()
+        conn.close()
+        flash(f"Database busy, please retry ({e})", "error")
+        return redirect(url_for('view_invoice', id=id))
+    conn.close()
+    # The version trigger already moved the invoice to a new cache key; the
+    # stamp makes every worker drop its memory copy right away
+    bump_stamp("invoices")
+    
+    log_activity(session['user_id'], "PAYMENT", f"Rs {amount:.2f} received for {invoice['inv_no']}")
+    flash(f"Payment of Rs {amount:.2f} recorded", "success")
+    return redirect(url_for('view_invoice', id=id))
+
+# ===================== OFFLINE SYNC =====================
+SYNC_MAX_BATCH = 500
+
+def _sync_validate(inv):
+    """Error message for a malformed offline invoice, or None."""
+    uuid = inv.get('client_uuid') if isinstance(inv, dict) else None
+    if not isinstance(uuid, str) or not 8 <= len(uuid) <= 64:
+        return "client_uuid is required"
+    items = inv.get('items')
+    if not isinstance(items, list) or not items:
+        return "items are required"
+    for item in items:
+        if not isinstance(item, dict) or not item.get('name'):
+            return "every item needs a name"
+        try:
+            item['qty'] = float(item['qty'])
+            item['price'] = float(item['price'])
+        except (KeyError, TypeError, ValueError):
+            return "every item needs a numeric qty and price"
+    for key in ('discount', 'paid'):
+        try:
+            float(inv.get(key) or 0)
+        except (TypeError, ValueError):
+            return f"{key} must be a number"
+    return None
+
+@app.route("/api/sync", methods=["POST"])
+@api_login_required
+def api_sync():
+    """Ingest a batch of invoices created offline.
+    
+    Body: {"device_id": "...", "invoices": [{"client_uuid": "...", ...new_invoice fields}]}.
+    Idempotent on client_uuid: an invoice that was already ingested comes back
+    as "duplicate" with its original number, so a client can resend a batch
+    whose response it never received. The whole batch is one write
+    transaction; each invoice gets a savepoint so a rejected one (stock,
+    validation, any other error) does not undo the others.
+    """
+    data = request.get_json(silent=True) or {}
+    invoices = data.get('invoices')
+    if not isinstance(invoices, list):
+        return jsonify({"success": False, "error": "invoices must be a list"}), 400
+    if len(invoices) > SYNC_MAX_BATCH:
+        return jsonify({"success": False,
+                        "error": f"At most {SYNC_MAX_BATCH} invoices per batch"}), 413
+    
+    user = {"id": session['user_id'], "full_name": session['full_name']}
+    device_id = str(data.get('device_id') or '')[:64] or None
+    results = []
+    conn = get_db()
+    c = conn.cursor()
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        for inv in invoices:
+            error = _sync_validate(inv)
+            if error:
+                results.append({"client_uuid": inv.get('client_uuid') if isinstance(inv, dict) else None,
+                                "status": "invalid", "error": error})
+                continue
+            uuid = inv['client_uuid']
+            c.execute("SELECT invoice_id, inv_no FROM sync_receipts WHERE client_uuid = ?", (uuid,))
+            receipt = c.fetchone()
+            if receipt:
+                results.append({"client_uuid": uuid, "status": "duplicate",
+                                "invoice_id": receipt['invoice_id'], "inv_no": receipt['inv_no']})
+                continue
+            
+            c.execute("SAVEPOINT sync_invoice")
+            try:
+                invoice_id, inv_no, backorders = create_invoice(c, inv, user, source='offline')
+            except InsufficientStock as e:
+                c.execute("ROLLBACK TO sync_invoice")
+                c.execute("RELEASE sync_invoice")
+                results.append({"client_uuid": uuid, "status": "rejected",
+                                "error": "Insufficient stock", "shortages": e.shortages})
+                continue
+            except sqlite3.OperationalError:
+                raise
+            except Exception as e:
+                # A malformed invoice the checks above let through: report it, keep the rest
+                c.execute("ROLLBACK TO sync_invoice")
+                c.execute("RELEASE sync_invoice")
+                results.append({"client_uuid": uuid, "status": "invalid",
+                                "error": str(e) or type(e).__name__})
+                continue
+            c.execute("""
+                INSERT INTO sync_receipts (client_uuid, invoice_id, inv_no, device_id, user_id)
+                VALUES (?, ?, ?, ?, ?)
+            """, (uuid, invoice_id, inv_no, device_id, user['id']))
+            c.execute("RELEASE sync_invoice")
+            results.append({"client_uuid": uuid, "status": "created", "invoice_id": invoice_id,
+                            "inv_no": inv_no, "backorders": backorders})
+        conn.commit()
+    except sqlite3.OperationalError as e:
+        # Nothing was kept; the client resends the same batch later
+        conn.rollback()
+        return jsonify({"success": False, "error": f"Database busy, please retry ({e})"}), 503
+    finally:
+        conn.close()
+    
+    created = sum(1 for r in results if r['status'] == 'created')
+    if created:
+        log_activity(session['user_id'], "SYNC_INVOICES",
+                     f"Synced {created} offline invoice(s) from {device_id or 'unknown device'}")
+    return jsonify({"success": True, "results": results})
+
+# ===================== PWA / SERVICE WORKER =====================
+# Static shell the service worker precaches; /api/catalog is warmed into the
+# stale-while-revalidate API cache. Pages are never cached (live balances).
+PRECACHE_STATIC = ("manifest.json", "offline.js", "offline_db.js", "icon-192.png", "icon-512.png")
+PRECACHE_API = ("/api/catalog",)
+
+_precache_manifest = None
+
+def precache_manifest():
+    """{version, urls, api}; the version hashes the precached files and the
+    worker script, so a deploy that changes any of them rolls the caches."""
+    global _precache_manifest
+    if _precache_manifest is None:
+        static_dir = Path(app.static_folder)
+        digest = hashlib.sha256()
+        for name in PRECACHE_STATIC + ("service-worker.js",):
+            digest.update(name.encode())
+            digest.update((static_dir / name).read_bytes())
+        digest.update(OFFLINE_PAGE.encode())
+        _precache_manifest = {
+            "version": digest.hexdigest()[:12],
+            "urls": ["/offline"] + [f"/static/{name}" for name in PRECACHE_STATIC],
+            "api": list(PRECACHE_API),
+        }
+    return _precache_manifest
+
+OFFLINE_PAGE = """
+<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Offline - Smart Invoice Pro</title>
+    <link rel="manifest" href="/static/manifest.json">
+    <style>
+        body { font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif; background: #f1f5f9;
+               color: #1e293b; display: flex; align-items: center; justify-content: center; min-height: 100vh; margin: 0; }
+        .card { background: #fff; border-radius: 12px; padding: 2rem; max-width: 420px; text-align: center;
+                box-shadow: 0 4px 6px -1px rgba(0, 0, 0, 0.1); }
+        button { background: #3b82f6; color: #fff; border: 0; border-radius: 8px; padding: 0.6rem 1.2rem; cursor: pointer; }
+    </style>
+</head>
+<body>
+    <div class="card">
+        <h2>You are offline</h2>
+        <p>Pages with balances and stock need a connection. Invoices saved on this device
+           will be uploaded as soon as you are back online.</p>
+        <p id="pending"></p>
+        <button onclick="location.reload()">Try again</button>
+    </div>
+    <script src="/static/offline_db.js"></script>
+    <script>
+        getAllOfflineInvoices().then(list => {
+            document.getElementById('pending').textContent = list.length + ' invoice(s) waiting to sync';
+        });
+    </script>
+</body>
+</html>
+"""
+
+@app.route("/service-worker.js")
+def service_worker():
+    # Served from the root (not /static) so its scope covers the whole app
+    script = (Path(app.static_folder) / "service-worker.js").read_text(encoding="utf-8")
+    header = f"self.__PRECACHE = {json.dumps(precache_manifest())};\n"
+    response = Response(header + script, mimetype="application/javascript")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["Service-Worker-Allowed"] = "/"
+    return response
+
+@app.route("/offline")
+def offline_page():
+    return OFFLINE_PAGE
+
+@app.route("/api/catalog")
+@api_login_required
+def api_catalog():
+    """Products and customers for offline invoice entry. No balances: the
+    service worker may serve this from cache."""
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("SELECT id, name, unit_price, stock, unit, category, barcode FROM products ORDER BY name")
+    products = [dict(row) for row in c.fetchall()]
+    c.execute("SELECT id, name, phone, address FROM customers ORDER BY name")
+    customers = [dict(row) for row in c.fetchall()]
+    conn.close()
+    return jsonify({"products": products, "customers": customers,
+                    "generated_at": datetime.datetime.now().isoformat(timespec='seconds')})
+
+# ===================== DELTA SYNC =====================
+CHANGES_PAGE_SIZE = 1000
+
+@app.route("/api/changes")
+@api_login_required
+def api_changes():
+    """Records changed since ?since=<seq>, grouped per entity.
+    
+    Returns {"next": seq, "more": bool, "reset": bool, "changes": {entity:
+    {"upsert": [rows], "delete": [ids]}}}. Clients store `next` and call again
+    while `more` is true. `reset` means the server's feed is behind the
+    client's seq (e.g. a backup was restored): drop local data and start at 0.
     """
+    since = request.args.get('since', 0, type=int)
+    limit = max(1, min(request.args.get('limit', CHANGES_PAGE_SIZE, type=int), CHANGES_PAGE_SIZE * 5))
+    
+    conn = get_db()
+    c = conn.cursor()
+    # One read transaction, so the rows match the log entries (WAL snapshot)
+    c.execute("BEGIN")
+    c.execute("SELECT COALESCE(MAX(seq), 0) FROM change_log")
+    head = c.fetchone()[0]
+    c.execute("""
+        SELECT seq, entity, entity_id, op FROM change_log
+        WHERE seq > ? ORDER BY seq LIMIT ?
+    """, (since, limit + 1))
+    log = c.fetchall()
+    more = len(log) > limit
+    log = log[:limit]
+    
+    changes = {}
+    for entity, columns in CHANGE_FEED_COLUMNS.items():
+        ids = [row['entity_id'] for row in log if row['entity'] == entity and row['op'] == 'upsert']
+        deleted = [row['entity_id'] for row in log if row['entity'] == entity and row['op'] == 'delete']
+        rows = []
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            c.execute(f"SELECT {', '.join(columns)} FROM {entity} WHERE id IN ({','.join('?' * len(chunk))})",
+                      chunk)
+            rows.extend(dict(row) for row in c.fetchall())
+        if rows or deleted:
+            changes[entity] = {"upsert": rows, "delete": deleted}
+    conn.rollback()
+    conn.close()
+    
+    return jsonify({
+        "since": since,
+        "next": log[-1]['seq'] if log else (0 if since > head else since),
+        "more": more,
+        "reset": since > head,
+        "changes": changes,
+    })
+
+# ===================== REST API (v1) =====================
+# Read-only JSON views of the main tables. Every list takes ?fields=a,b,c,
+# ?limit= and keyset pagination (?after=<cursor from the previous page>), so
+# a client pulls exactly the columns and rows it needs.
+API_DEFAULT_LIMIT = 100
+API_MAX_LIMIT = 1000
+API_GZIP_MIN_BYTES = 1400  # below one packet compression is not worth it
+
+API_RESOURCES = {
+    "invoices": {
+        "table": "invoices",
+        "fields": ("id", "inv_no", "date", "customer_id", "customer_name", "customer_address",
+                   "customer_phone", "salesman_id", "salesman_name", "subtotal", "tax_rate",
+                   "tax_amount", "discount", "total", "paid", "balance", "status",
+                   "payment_method", "notes", "source", "created_at"),
+        "default": ("id", "inv_no", "date", "customer_id", "customer_name", "total", "paid",
+                    "balance", "status"),
+        "filters": {"customer_id": "customer_id = ?", "status": "status = ?",
+                    "from": "date >= ?", "to": "date <= ?"},
+        "newest_first": True,
+    },
+    "items": {
+        "table": "invoice_items",
+        "fields": ("id", "invoice_id", "product_id", "product_name", "qty", "unit_price", "total",
+                   "unit_cost"),
+        "default": ("id", "invoice_id", "product_id", "product_name", "qty", "unit_price", "total"),
+        "filters": {"invoice_id": "invoice_id = ?", "product_id": "product_id = ?"},
+        "newest_first": False,
+    },
+    "customers": {
+        "table": "customers",
+        "fields": ("id", "name", "address", "phone", "email", "credit_limit", "balance", "created_at"),
+        "default": ("id", "name", "phone", "balance"),
+        "filters": {"q": "name LIKE ?", "phone": "phone = ?"},
+        "newest_first": False,
+    },
+    "products": {
+        "table": "products",
+        "fields": ("id", "name", "description", "unit_price", "purchase_price", "stock", "min_stock",
+                   "unit", "category", "barcode", "created_at"),
+        "default": ("id", "name", "unit_price", "stock", "unit", "category"),
+        "filters": {"q": "name LIKE ?", "category": "category = ?", "barcode": "barcode = ?"},
+        "newest_first": False,
+    },
+    "ledger": {
+        "table": "transactions",
+        "fields": ("id", "date", "customer_id", "invoice_id", "type", "amount", "balance",
+                   "description", "created_by", "created_at"),
+        "default": ("id", "date", "customer_id", "invoice_id", "type", "amount", "balance", "description"),
+        "filters": {"customer_id": "customer_id = ?", "invoice_id": "invoice_id = ?",
+                    "type": "type = ?", "from": "date >= ?", "to": "date <= ?"},
+        "newest_first": True,
+    },
+}
+
+class ApiError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+@app.errorhandler(ApiError)
+def handle_api_error(e):
+    return api_response({"error": str(e)}, e.status)
+
+def api_response(payload, status=200):
+    """JSON response via orjson when installed, gzipped when it is large and
+    the client accepts it."""
+    if orjson is not None:
+        body = orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS)
+    else:
+        body = json.dumps(payload, separators=(",", ":"), default=str).encode("utf-8")
+    response = Response(body, status=status, mimetype="application/json")
+    response.headers["Vary"] = "Accept-Encoding"
+    if len(body) >= API_GZIP_MIN_BYTES and "gzip" in request.headers.get("Accept-Encoding", ""):
+        response.set_data(gzip.compress(body, compresslevel=5))
+        response.headers["Content-Encoding"] = "gzip"
+    return response
+
+def api_fields(resource):
+    """Columns from ?fields=, checked against the resource's whitelist."""
+    spec = API_RESOURCES[resource]
+    requested = request.args.get('fields')
+    if not requested:
+        return spec["default"]
+    if requested == "*":
+        return spec["fields"]
+    fields = tuple(f.strip() for f in requested.split(",") if f.strip())
+    unknown = [f for f in fields if f not in spec["fields"]]
+    if unknown:
+        raise ApiError(f"Unknown field(s) for {resource}: {', '.join(unknown)}")
+    # The id is the pagination cursor, so it is always returned
+    return fields if "id" in fields else ("id",) + fields
+
+def api_list(resource, **fixed_filters):
+    spec = API_RESOURCES[resource]
+    fields = api_fields(resource)
+    limit = request.args.get('limit', API_DEFAULT_LIMIT, type=int)
+    limit = max(1, min(limit, API_MAX_LIMIT))
+    after = request.args.get('after', type=int)
+    
+    where, params = [], []
+    for name, clause in spec["filters"].items():
+        value = fixed_filters.get(name, request.args.get(name))
+        if value in (None, ""):
+            continue
+        where.append(clause)
+        params.append(f"%{value}%" if " LIKE " in clause else value)
+    if after is not None:
+        where.append("id < ?" if spec["newest_first"] else "id > ?")
+        params.append(after)
     
-    return render_page(f"Invoice {invoice['inv_no']} - Smart Invoice Pro", "Invoice Details", content, "invoices")
+    sql = f"SELECT {', '.join(fields)} FROM {spec['table']}"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += f" ORDER BY id {'DESC' if spec['newest_first'] else 'ASC'} LIMIT ?"
+    params.append(limit + 1)
+    
+    conn = get_db()
+    c = conn.cursor()
+    c.execute(sql, params)
+    rows = [dict(row) for row in c.fetchall()]
+    conn.close()
+    
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return {"data": rows, "next": rows[-1]["id"] if has_more else None}
+
+def api_get(resource, id):
+    spec = API_RESOURCES[resource]
+    conn = get_db()
+    c = conn.cursor()
+    c.execute(f"SELECT {', '.join(api_fields(resource))} FROM {spec['table']} WHERE id = ?", (id,))
+    row = c.fetchone()
+    conn.close()
+    if not row:
+        raise ApiError(f"{resource} {id} not found", 404)
+    return dict(row)
+
+@app.route("/api/v1/<resource>")
+@api_login_required
+def api_v1_list(resource):
+    if resource not in API_RESOURCES:
+        raise ApiError(f"Unknown resource: {resource}", 404)
+    return api_response(api_list(resource))
+
+@app.route("/api/v1/<resource>/<int:id>")
+@api_login_required
+def api_v1_get(resource, id):
+    if resource not in API_RESOURCES:
+        raise ApiError(f"Unknown resource: {resource}", 404)
+    data = api_get(resource, id)
+    if resource == "invoices" and request.args.get('include') == "items":
+        conn = get_db()
+        c = conn.cursor()
+        c.execute(f"SELECT {', '.join(API_RESOURCES['items']['default'])} FROM invoice_items "
+                  "WHERE invoice_id = ? ORDER BY id", (id,))
+        data["items"] = [dict(row) for row in c.fetchall()]
+        conn.close()
+    return api_response({"data": data})
+
+@app.route("/api/v1/invoices/<int:id>/items")
+@api_login_required
+def api_v1_invoice_items(id):
+    conn = get_db()
+    exists = conn.execute("SELECT 1 FROM invoices WHERE id = ?", (id,)).fetchone()
+    conn.close()
+    if not exists:
+        raise ApiError(f"invoices {id} not found", 404)
+    return api_response(api_list("items", invoice_id=id))
+
+@app.route("/api/v1/settings")
+@api_login_required
+def api_v1_settings():
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("SELECT key, value FROM settings ORDER BY key")
+    settings = {row['key']: row['value'] for row in c.fetchall()}
+    conn.close()
+    return api_response({"data": settings})
 
 # ===================== CUSTOMER LEDGER =====================
 @app.route("/ledger")
 @login_required
 def ledger():
-    conn = get_db()
+    conn = get_read_db()
     c = conn.cursor()
     
     customer_id = request.args.get('customer_id', type=int)
@@ -1559,6 +4124,14 @@ def ledger():
     <div class="card">
         <div class="card-header">
             <h3>Select Customer</h3>
+            <div style="display: flex; gap: 0.5rem;">
+                <a href="{url_for('export_data', dataset='ledger', fmt='csv', customer_id=customer_id or None)}" class="btn btn-secondary btn-sm">
+                    <i class="fas fa-file-csv"></i> CSV
+                </a>
+                <a href="{url_for('export_data', dataset='ledger', fmt='xlsx', customer_id=customer_id or None)}" class="btn btn-secondary btn-sm">
+                    <i class="fas fa-file-excel"></i> Excel
+                </a>
+            </div>
         </div>
         <form method="get" class="form-row">
             <div class="form-group" style="flex: 1;">
@@ -1611,172 +4184,1281 @@ def ledger():
     
     return render_page("Customer Ledger - Smart Invoice Pro", "Customer Ledger", content, "ledger")
 
-# ===================== USER MANAGEMENT (ADMIN ONLY) =====================
-@app.route("/admin/users", methods=["GET", "POST"])
-@admin_required
-def users():
-    conn = get_db()
-    c = conn.cursor()
-    
-    if request.method == "POST":
-        action = request.form.get("action")
-        
-        if action == "add":
-            username = request.form.get("username").strip()
-            full_name = request.form.get("full_name").strip()
-            password = request.form.get("password")
-            role = request.form.get("role")
-            phone = request.form.get("phone", "")
-            
-            try:
-                c.execute("""
-                    INSERT INTO users (username, password_hash, full_name, role, phone)
-                    VALUES (?, ?, ?, ?, ?)
-                """, (username, hash_password(password), full_name, role, phone))
-                conn.commit()
-                flash(f"User {username} created successfully", "success")
-                log_activity(session['user_id'], "CREATE_USER", f"Created user {username}")
-            except sqlite3.IntegrityError:
-                flash("Username already exists", "error")
-        
-        elif action == "toggle":
-            user_id = request.form.get("user_id")
-            c.execute("UPDATE users SET is_active = NOT is_active WHERE id = ?", (user_id,))
-            conn.commit()
-            flash("User status updated", "success")
+# ===================== RECEIVABLES =====================
+# Aging comes from open invoice balances by days since the invoice date, in
+# one pass over the partial index idx_invoices_open (only invoices with a
+# balance, so paid-up history costs nothing). customers.balance stays the
+# figure of record: credit not applied to an invoice is taken off the oldest
+# buckets, and balance with no open invoice behind it (opening balances) is
+# shown as unallocated, so each row adds up to the customer's balance. Since
+# those balances are current, the report always ages to today. Open invoices
+# without a usable date are not aged: they are shown as 'undated'. Sorting
+# and paging happen in SQL, so a page only builds the rows it shows.
+AGING_BUCKETS = (("0-30", 30), ("31-60", 60), ("61-90", 90), ("90+", None))
+RECEIVABLES_PAGE_SIZE = 100
+
+def _receivables_sql():
+    n_buckets = len(AGING_BUCKETS)
+    # An invoice goes in the first bucket its age fits under; the last one is open-ended
+    bucket_case = " ".join(
+        f"WHEN age <= {upper} THEN {n}" for n, (_, upper) in enumerate(AGING_BUCKETS) if upper is not None)
+    bucket_sums = ",\n".join(
+        f"SUM(CASE WHEN bucket = {n} THEN balance ELSE 0 END) AS b{n}" for n in range(n_buckets))
+    # Credit goes to the oldest amounts first, undated ones last: each column
+    # keeps what is left of it once the credit has used up everything older
+    order = [f"b{n}" for n in reversed(range(n_buckets))] + ["undated"]
+    allocated = ",\n".join(
+        f"MAX(0, MIN({col}, {' + '.join(order[:i + 1])} - credit)) AS {col}" for i, col in enumerate(order))
+    return f"""
+        WITH open AS (
+            SELECT customer_id, MIN(CASE WHEN age IS NOT NULL THEN date END) AS oldest,
+                   SUM(balance) AS open_total,
+                   SUM(CASE WHEN bucket IS NULL THEN balance ELSE 0 END) AS undated,
+                   {bucket_sums}
+            FROM (
+                SELECT customer_id, date, balance,
+                       CASE WHEN age IS NULL THEN NULL {bucket_case} ELSE {n_buckets - 1} END AS bucket,
+                       age
+                FROM (SELECT customer_id, date, balance, julianday(:as_of) - julianday(date) AS age
+                      FROM invoices WHERE balance > 0 AND customer_id IS NOT NULL)
+            )
+            GROUP BY customer_id
+        ),
+        owing AS (
+            SELECT c.id, c.name, c.phone, COALESCE(c.credit_limit, 0) AS credit_limit, c.balance, o.oldest,
+                   COALESCE(o.open_total, 0) AS open_total, COALESCE(o.undated, 0) AS undated,
+                   {", ".join(f"COALESCE(o.b{n}, 0) AS b{n}" for n in range(n_buckets))},
+                   MAX(COALESCE(o.open_total, 0) - c.balance, 0) AS credit
+            FROM customers c
+            LEFT JOIN open o ON o.customer_id = c.id
+            WHERE c.balance > 0.005
+        ),
+        aging AS (
+            SELECT id, name, phone, credit_limit, balance, oldest,
+                   {allocated},
+                   MAX(balance - open_total, 0) AS unallocated,
+                   credit_limit > 0 AND balance > credit_limit AS over_limit
+            FROM owing
+        )
+    """
+
+RECEIVABLES_SQL = _receivables_sql()
+# Oldest money first: the most overdue bucket, then the next, ...
+RECEIVABLES_ORDER = ", ".join(
+    [f"b{n} DESC" for n in reversed(range(len(AGING_BUCKETS)))] + ["undated DESC", "balance DESC", "id"])
+
+def receivables_aging(c, as_of, over_limit_only=False, limit=-1, offset=0):
+    """A page of the customers who owe money, most overdue first, with
+    AGING_BUCKETS amounts, 'undated', 'unallocated', 'over_limit' and
+    'oldest' (date of the oldest dated open invoice)."""
+    c.execute(f"""
+        {RECEIVABLES_SQL}
+        SELECT * FROM aging
+        {"WHERE over_limit" if over_limit_only else ""}
+        ORDER BY {RECEIVABLES_ORDER}
+        LIMIT :limit OFFSET :offset
+    """, {"as_of": as_of, "limit": limit, "offset": offset})
+    return [{
+        "id": r['id'],
+        "name": r['name'],
+        "phone": r['phone'],
+        "balance": r['balance'],
+        "credit_limit": r['credit_limit'],
+        "over_limit": bool(r['over_limit']),
+        "oldest": r['oldest'],
+        "buckets": [round(r[f'b{n}'], 2) for n in range(len(AGING_BUCKETS))],
+        "undated": round(r['undated'], 2),
+        "unallocated": round(r['unallocated'], 2),
+    } for r in c.fetchall()]
+
+def receivables_totals(c, as_of):
+    """Report totals over every customer who owes money."""
+    c.execute(f"""
+        {RECEIVABLES_SQL}
+        SELECT COUNT(*) AS customers, COALESCE(SUM(over_limit), 0) AS over_limit,
+               {", ".join(f"COALESCE(SUM(b{n}), 0) AS b{n}" for n in range(len(AGING_BUCKETS)))},
+               COALESCE(SUM(undated), 0) AS undated, COALESCE(SUM(unallocated), 0) AS unallocated,
+               COALESCE(SUM(balance), 0) AS balance
+        FROM aging
+    """, {"as_of": as_of})
+    r = c.fetchone()
+    return {
+        "customers": r['customers'],
+        "over_limit": r['over_limit'],
+        "buckets": [round(r[f'b{n}'], 2) for n in range(len(AGING_BUCKETS))],
+        "undated": round(r['undated'], 2),
+        "unallocated": round(r['unallocated'], 2),
+        "balance": r['balance'],
+    }
+
+@app.route("/reports/receivables")
+@login_required
+def receivables():
+    as_of = datetime.date.today().isoformat()
+    over_limit_only = request.args.get('over_limit') == '1'
+    page = max(request.args.get('page', 1, type=int), 1)
     
-    c.execute("SELECT * FROM users ORDER BY created_at DESC")
-    users_list = c.fetchall()
+    conn = get_read_db()
+    c = conn.cursor()
+    summary = receivables_totals(c, as_of)
+    totals = summary['buckets']
+    over_limit_count = summary['over_limit']
+    listed = over_limit_count if over_limit_only else summary['customers']
+    pages = max((listed + RECEIVABLES_PAGE_SIZE - 1) // RECEIVABLES_PAGE_SIZE, 1)
+    page = min(page, pages)
+    shown = receivables_aging(c, as_of, over_limit_only, RECEIVABLES_PAGE_SIZE, (page - 1) * RECEIVABLES_PAGE_SIZE)
     conn.close()
     
-    users_rows = ""
-    for user in users_list:
-        status_badge = "success" if user['is_active'] else "danger"
-        status_text = "Active" if user['is_active'] else "Inactive"
-        btn_class = "danger" if user['is_active'] else "success"
-        btn_text = "Deactivate" if user['is_active'] else "Activate"
-        
-        users_rows += f"""
+    table_rows = ""
+    for r in shown:
+        limit_cell = "-"
+        if r['credit_limit']:
+            used = r['balance'] / r['credit_limit'] * 100
+            badge = "danger" if r['over_limit'] else "warning" if used >= 90 else "success"
+            limit_cell = f'Rs {r["credit_limit"]:.2f} <span class="badge badge-{badge}">{used:.0f}%</span>'
+        bucket_cells = "".join(
+            f'<td style="{"color: var(--danger);" if n == len(AGING_BUCKETS) - 1 and b > 0 else ""}">'
+            f'{f"Rs {b:.2f}" if b else "-"}</td>'
+            for n, b in enumerate(r['buckets']))
+        table_rows += f"""
         <tr>
-            <td>{user['username']}</td>
-            <td>{user['full_name']}</td>
-            <td><span class="badge badge-info">{user['role'].title()}</span></td>
-            <td>{user['phone'] or '-'}</td>
-            <td><span class="badge badge-{status_badge}">{status_text}</span></td>
-            <td>{user['last_login'] or 'Never'}</td>
-            <td>
-                <form method="post" style="display: inline;">
-                    <input type="hidden" name="action" value="toggle">
-                    <input type="hidden" name="user_id" value="{user['id']}">
-                    <button type="submit" class="btn btn-sm btn-{btn_class}">{btn_text}</button>
-                </form>
-            </td>
+            <td><a href="{url_for('ledger', customer_id=r['id'])}">{r['name']}</a>
+                {'<span class="badge badge-danger">Over limit</span>' if r['over_limit'] else ''}</td>
+            <td>{r['phone'] or '-'}</td>
+            {bucket_cells}
+            <td>{f'<span class="badge badge-warning">Rs {r["undated"]:.2f}</span>' if r['undated'] else '-'}</td>
+            <td>{f"Rs {r['unallocated']:.2f}" if r['unallocated'] else '-'}</td>
+            <td><strong>Rs {r['balance']:.2f}</strong></td>
+            <td>{limit_cell}</td>
+            <td>{r['oldest'] or '-'}</td>
         </tr>
         """
     
+    def page_url(n):
+        return url_for('receivables', page=n, **({'over_limit': '1'} if over_limit_only else {}))
+    
+    pager = ""
+    if pages > 1:
+        pager = f"""
+        <div style="display: flex; gap: 0.5rem; justify-content: flex-end; margin-top: 1rem;">
+            {f'<a href="{page_url(page - 1)}" class="btn btn-secondary btn-sm"><i class="fas fa-chevron-left"></i></a>' if page > 1 else ''}
+            <span style="align-self: center;">Page {page} of {pages}</span>
+            {f'<a href="{page_url(page + 1)}" class="btn btn-secondary btn-sm"><i class="fas fa-chevron-right"></i></a>' if page < pages else ''}
+        </div>
+        """
+    
+    bucket_headers = "".join(f"<th>{label} days</th>" for label, _ in AGING_BUCKETS)
+    bucket_totals = "".join(f"<td><strong>Rs {t:.2f}</strong></td>" for t in totals)
+    
     content = f"""
-    <div class="card">
-        <div class="card-header">
-            <h3>Add New User</h3>
+    <div class="stats-grid">
+        <div class="stat-card primary">
+            <div class="icon"><i class="fas fa-hand-holding-usd"></i></div>
+            <div class="stat-value">Rs {summary['balance']:.0f}</div>
+            <div class="stat-label">Total Receivable</div>
+        </div>
+        <div class="stat-card warning">
+            <div class="icon"><i class="fas fa-hourglass-half"></i></div>
+            <div class="stat-value">Rs {totals[-1]:.0f}</div>
+            <div class="stat-label">Over {AGING_BUCKETS[-2][1]} Days</div>
+        </div>
+        <div class="stat-card danger">
+            <div class="icon"><i class="fas fa-exclamation-triangle"></i></div>
+            <div class="stat-value">{over_limit_count}</div>
+            <div class="stat-label">Over Credit Limit</div>
         </div>
-        <form method="post">
-            <input type="hidden" name="action" value="add">
-            <div class="form-row">
-                <div class="form-group">
-                    <label class="form-label">Username *</label>
-                    <input type="text" name="username" class="form-control" required>
-                </div>
-                <div class="form-group">
-                    <label class="form-label">Full Name *</label>
-                    <input type="text" name="full_name" class="form-control" required>
-                </div>
-                <div class="form-group">
-                    <label class="form-label">Password *</label>
-                    <input type="password" name="password" class="form-control" required>
-                </div>
-                <div class="form-group">
-                    <label class="form-label">Role *</label>
-                    <select name="role" class="form-control" required>
-                        <option value="salesman">Salesman</option>
-                        <option value="manager">Manager</option>
-                        <option value="admin">Admin</option>
-                    </select>
-                </div>
-                <div class="form-group">
-                    <label class="form-label">Phone</label>
-                    <input type="text" name="phone" class="form-control">
-                </div>
-            </div>
-            <button type="submit" class="btn btn-primary">Add User</button>
-        </form>
     </div>
     
     <div class="card">
         <div class="card-header">
-            <h3>All Users</h3>
+            <h3>Receivables Aging as of {as_of}</h3>
+            <form method="get" style="display: flex; gap: 0.5rem; align-items: center;">
+                <label style="white-space: nowrap;">
+                    <input type="checkbox" name="over_limit" value="1" {'checked' if over_limit_only else ''}> Over limit only
+                </label>
+                <button type="submit" class="btn btn-primary btn-sm">Apply</button>
+            </form>
         </div>
         <div class="table-container">
             <table>
                 <thead>
                     <tr>
-                        <th>Username</th>
-                        <th>Full Name</th>
-                        <th>Role</th>
+                        <th>Customer</th>
                         <th>Phone</th>
-                        <th>Status</th>
-                        <th>Last Login</th>
-                        <th>Actions</th>
+                        {bucket_headers}
+                        <th title="Open invoices without a date are not aged">Undated</th>
+                        <th>Unallocated</th>
+                        <th>Balance</th>
+                        <th>Credit Limit</th>
+                        <th>Oldest Open</th>
                     </tr>
                 </thead>
                 <tbody>
-                    {users_rows}
+                    {table_rows}
                 </tbody>
+                <tfoot>
+                    <tr>
+                        <td colspan="2"><strong>All customers</strong></td>
+                        {bucket_totals}
+                        <td><strong>Rs {summary['undated']:.2f}</strong></td>
+                        <td><strong>Rs {summary['unallocated']:.2f}</strong></td>
+                        <td><strong>Rs {summary['balance']:.2f}</strong></td>
+                        <td colspan="2"></td>
+                    </tr>
+                </tfoot>
             </table>
         </div>
+        {pager}
     </div>
     """
     
-    return render_page("User Management - Smart Invoice Pro", "User Management", content, "users")
+    return render_page("Receivables - Smart Invoice Pro", "Receivables Aging", content, "reports")
 
-# ===================== BACKUP & RESTORE =====================
-@app.route("/admin/backup", methods=["GET", "POST"])
-@admin_required
-def backup():
-    if request.method == "POST":
-        action = request.form.get("action")
-        
-        if action == "backup":
-            timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-            backup_file = BACKUP_DIR / f"backup_{timestamp}.db"
-            shutil.copy2(DB_FILE, backup_file)
-            flash(f"Backup created: {backup_file.name}", "success")
-            log_activity(session['user_id'], "BACKUP", f"Created backup {backup_file.name}")
-        
-        elif action == "restore":
-            file = request.files.get("backup_file")
-            if file:
-                temp_path = BACKUP_DIR / "temp_restore.db"
-                file.save(temp_path)
-                
-                try:
-                    conn = sqlite3.connect(temp_path)
-                    conn.execute("SELECT name FROM sqlite_master WHERE type='table'")
-                    conn.close()
-                    
-                    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-                    current_backup = BACKUP_DIR / f"before_restore_{timestamp}.db"
-                    shutil.copy2(DB_FILE, current_backup)
-                    
-                    shutil.copy2(temp_path, DB_FILE)
-                    temp_path.unlink()
-                    
-                    flash("Database restored successfully", "success")
-                    log_activity(session['user_id'], "RESTORE", "Database restored from backup")
-                except Exception as e:
-                    flash(f"Invalid backup file: {str(e)}", "error")
+# ===================== SALES REPORTS =====================
+# group -> (SQL key expression, column heading)
+REPORT_GROUPS = {
+    "day": ("i.date", "Date"),
+    "week": ("strftime('%Y-W%W', i.date)", "Week"),
+    "month": ("substr(i.date, 1, 7)", "Month"),
+    "product": ("it.product_name", "Product"),
+    "customer": ("COALESCE(i.customer_name, 'Walk-in')", "Customer"),
+    "salesman": ("COALESCE(i.salesman_name, 'Unknown')", "Salesman"),
+}
+
+def sales_report(c, group="month", date_from=None, date_to=None):
+    """Sales, cost and gross margin per group in a single GROUP BY pass.
+    
+    Revenue is the line total (before invoice-level tax and discount); cost is
+    qty x the cost price captured at sale, else the product's purchase price.
+    """
+    key, _ = REPORT_GROUPS[group]
+    c.execute(f"""
+        SELECT {key} as label,
+               COUNT(DISTINCT i.id) as invoices,
+               COALESCE(SUM(it.qty), 0) as qty,
+               COALESCE(SUM(it.total), 0) as revenue,
+               COALESCE(SUM(it.qty * COALESCE(it.unit_cost, p.purchase_price, 0)), 0) as cost
+        FROM invoice_items it
+        JOIN invoices i ON i.id = it.invoice_id
+        LEFT JOIN products p ON p.id = it.product_id
+        WHERE i.date >= ? AND i.date <= ?
+        GROUP BY label
+        ORDER BY {'label' if group in ('day', 'week', 'month') else 'revenue DESC'}
+    """, (date_from or '0000-00-00', date_to or '9999-12-31'))
+    return c.fetchall()
+
+@app.route("/reports")
+@login_required
+def reports():
+    group = request.args.get('group', 'month')
+    if group not in REPORT_GROUPS:
+        group = 'month'
+    today = datetime.date.today()
+    date_from = date_arg('from', today.replace(month=1, day=1).isoformat())
+    date_to = date_arg('to', today.isoformat())
+    
+    conn = get_read_db()
+    c = conn.cursor()
+    report = sales_report(c, group, date_from, date_to)
+    conn.close()
+    
+    total_revenue = sum(r['revenue'] or 0 for r in report)
+    total_cost = sum(r['cost'] or 0 for r in report)
+    total_margin = total_revenue - total_cost
+    
+    rows = ""
+    for r in report:
+        margin = (r['revenue'] or 0) - (r['cost'] or 0)
+        margin_pct = margin / r['revenue'] * 100 if r['revenue'] else 0
+        rows += f"""
+        <tr>
+            <td><strong>{r['label']}</strong></td>
+            <td>{r['invoices']}</td>
+            <td>{r['qty']:g}</td>
+            <td>Rs {r['revenue']:.2f}</td>
+            <td>Rs {r['cost']:.2f}</td>
+            <td style="color: {'var(--success)' if margin >= 0 else 'var(--danger)'};">Rs {margin:.2f}</td>
+            <td>{margin_pct:.1f}%</td>
+        </tr>
+        """
+    
+    group_options = "".join(
+        f'<option value="{g}" {"selected" if g == group else ""}>{heading}</option>'
+        for g, (_, heading) in REPORT_GROUPS.items())
+    
+    content = f"""
+    <div class="stats-grid">
+        <div class="stat-card primary">
+            <div class="icon"><i class="fas fa-coins"></i></div>
+            <div class="stat-value">Rs {total_revenue:.0f}</div>
+            <div class="stat-label">Sales</div>
+        </div>
+        <div class="stat-card warning">
+            <div class="icon"><i class="fas fa-truck"></i></div>
+            <div class="stat-value">Rs {total_cost:.0f}</div>
+            <div class="stat-label">Cost of Goods</div>
+        </div>
+        <div class="stat-card success">
+            <div class="icon"><i class="fas fa-chart-line"></i></div>
+            <div class="stat-value">Rs {total_margin:.0f}</div>
+            <div class="stat-label">Gross Margin ({(total_margin / total_revenue * 100) if total_revenue else 0:.1f}%)</div>
+        </div>
+    </div>
+    
+    <div class="card">
+        <div class="card-header">
+            <h3>Sales & Margin</h3>
+            <div style="display: flex; gap: 0.5rem;">
+                <a href="{url_for('targets')}" class="btn btn-secondary btn-sm">
+                    <i class="fas fa-bullseye"></i> Targets
+                </a>
+                <a href="{url_for('profit_and_loss')}" class="btn btn-secondary btn-sm">
+                    <i class="fas fa-balance-scale"></i> Profit & Loss
+                </a>
+                <a href="{url_for('receivables')}" class="btn btn-secondary btn-sm">
+                    <i class="fas fa-hand-holding-usd"></i> Receivables
+                </a>
+            </div>
+        </div>
+        <form method="get" class="form-row">
+            <div class="form-group">
+                <label class="form-label">Group By</label>
+                <select name="group" class="form-control">{group_options}</select>
+            </div>
+            <div class="form-group">
+                <label class="form-label">From</label>
+                <input type="date" name="from" class="form-control" value="{date_from}">
+            </div>
+            <div class="form-group">
+                <label class="form-label">To</label>
+                <input type="date" name="to" class="form-control" value="{date_to}">
+            </div>
+            <div class="form-group" style="display: flex; align-items: flex-end;">
+                <button type="submit" class="btn btn-primary">Run Report</button>
+            </div>
+        </form>
+    </div>
+    
+    <div class="card">
+        <div class="table-container">
+            <table>
+                <thead>
+                    <tr>
+                        <th>{REPORT_GROUPS[group][1]}</th>
+                        <th>Invoices</th>
+                        <th>Qty</th>
+                        <th>Sales</th>
+                        <th>Cost</th>
+                        <th>Margin</th>
+                        <th>Margin %</th>
+                    </tr>
+                </thead>
+                <tbody>
+                    {rows}
+                </tbody>
+            </table>
+        </div>
+    </div>
+    """
+    
+    return render_page("Reports - Smart Invoice Pro", "Sales Reports", content, "reports")
+
+@app.route("/reports/pnl")
+@login_required
+def profit_and_loss():
+    year = request.args.get('year', type=int) or datetime.date.today().year
+    
+    conn = get_read_db()
+    c = conn.cursor()
+    c.execute("SELECT * FROM monthly_pnl WHERE month LIKE ? ORDER BY month", (f"{year}-%",))
+    months = c.fetchall()
+    conn.close()
+    
+    totals = {"revenue": 0, "tax": 0, "cogs": 0, "expenses": 0}
+    rows = ""
+    for m in months:
+        for key in totals:
+            totals[key] += m[key] or 0
+        gross = m['revenue'] - m['cogs']
+        net = gross - m['expenses']
+        rows += f"""
+        <tr>
+            <td><strong>{m['month']}</strong></td>
+            <td>Rs {m['revenue']:.2f}</td>
+            <td>Rs {m['cogs']:.2f}</td>
+            <td>Rs {gross:.2f}</td>
+            <td>Rs {m['expenses']:.2f}</td>
+            <td style="color: {'var(--success)' if net >= 0 else 'var(--danger)'};"><strong>Rs {net:.2f}</strong></td>
+            <td>Rs {m['tax']:.2f}</td>
+        </tr>
+        """
+    
+    gross_total = totals['revenue'] - totals['cogs']
+    net_total = gross_total - totals['expenses']
+    
+    content = f"""
+    <div class="stats-grid">
+        <div class="stat-card primary">
+            <div class="icon"><i class="fas fa-coins"></i></div>
+            <div class="stat-value">Rs {totals['revenue']:.0f}</div>
+            <div class="stat-label">Revenue {year}</div>
+        </div>
+        <div class="stat-card success">
+            <div class="icon"><i class="fas fa-chart-line"></i></div>
+            <div class="stat-value">Rs {gross_total:.0f}</div>
+            <div class="stat-label">Gross Profit</div>
+        </div>
+        <div class="stat-card warning">
+            <div class="icon"><i class="fas fa-receipt"></i></div>
+            <div class="stat-value">Rs {totals['expenses']:.0f}</div>
+            <div class="stat-label">Expenses</div>
+        </div>
+        <div class="stat-card {'success' if net_total >= 0 else 'danger'}">
+            <div class="icon"><i class="fas fa-balance-scale"></i></div>
+            <div class="stat-value">Rs {net_total:.0f}</div>
+            <div class="stat-label">Net Profit</div>
+        </div>
+    </div>
+    
+    <div class="card">
+        <div class="card-header">
+            <h3>Profit & Loss {year}</h3>
+            <div style="display: flex; gap: 0.5rem;">
+                <a href="{url_for('profit_and_loss', year=year - 1)}" class="btn btn-secondary btn-sm"><i class="fas fa-chevron-left"></i> {year - 1}</a>
+                <a href="{url_for('profit_and_loss', year=year + 1)}" class="btn btn-secondary btn-sm">{year + 1} <i class="fas fa-chevron-right"></i></a>
+            </div>
+        </div>
+        <div class="table-container">
+            <table>
+                <thead>
+                    <tr>
+                        <th>Month</th>
+                        <th>Revenue</th>
+                        <th>Cost of Goods</th>
+                        <th>Gross Profit</th>
+                        <th>Expenses</th>
+                        <th>Net Profit</th>
+                        <th>Tax Collected</th>
+                    </tr>
+                </thead>
+                <tbody>
+                    {rows}
+                </tbody>
+            </table>
+        </div>
+    </div>
+    """
+    
+    return render_page("Profit & Loss - Smart Invoice Pro", "Profit & Loss", content, "reports")
+
+@app.cli.command("rebuild-rollups")
+def rebuild_rollups_command():
+    """Recompute the monthly P&L rollup and sales counters from scratch."""
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("BEGIN IMMEDIATE")
+    rebuild_monthly_pnl(c)
+    rebuild_monthly_product_sales(c)
+    conn.commit()
+    conn.close()
+    click.echo("Monthly P&L and sales counters rebuilt")
+
+# ===================== SALES TARGETS =====================
+@app.route("/targets", methods=["GET", "POST"])
+@login_required
+def targets():
+    month = month_arg()
+    conn = get_db()
+    c = conn.cursor()
+    
+    if request.method == "POST":
+        product_id = request.form.get("product_id", type=int)
+        qty = request.form.get("qty", 0, type=float)
+        c.execute("SELECT 1 FROM products WHERE id = ?", (product_id,))
+        if product_id is None or not c.fetchone():
+            flash("Choose a product for the target", "error")
+        else:
+            c.execute("BEGIN IMMEDIATE")
+            if qty > 0:
+                c.execute("""
+                    INSERT INTO sales_targets (month, product_id, qty) VALUES (?, ?, ?)
+                    ON CONFLICT(month, product_id) DO UPDATE SET qty = excluded.qty
+                """, (month, product_id, qty))
+            else:
+                c.execute("DELETE FROM sales_targets WHERE month = ? AND product_id = ?", (month, product_id))
+            conn.commit()
+            flash("Target saved", "success")
+            log_activity(session['user_id'], "SET_TARGET", f"{month} product {product_id}: {qty:g}")
+    
+    c.execute("""
+        SELECT p.id, p.name, p.unit, t.qty as target, COALESCE(s.qty, 0) as sold,
+               COALESCE(s.amount, 0) as amount
+        FROM sales_targets t
+        JOIN products p ON p.id = t.product_id
+        LEFT JOIN monthly_product_sales s ON s.month = t.month AND s.product_id = t.product_id
+        WHERE t.month = ?
+        ORDER BY p.name
+    """, (month,))
+    progress = c.fetchall()
+    c.execute("SELECT id, name FROM products ORDER BY name")
+    products_list = c.fetchall()
+    conn.close()
+    
+    rows = ""
+    for t in progress:
+        pct = t['sold'] / t['target'] * 100 if t['target'] else 0
+        bar_color = "var(--success)" if pct >= 100 else "var(--warning)" if pct >= 50 else "var(--danger)"
+        rows += f"""
+        <tr>
+            <td><strong>{t['name']}</strong></td>
+            <td>{t['target']:g} {t['unit'] or ''}</td>
+            <td>{t['sold']:g}</td>
+            <td>Rs {t['amount']:.2f}</td>
+            <td style="width: 30%;">
+                <div style="background: var(--border); border-radius: 9999px; height: 10px;">
+                    <div style="width: {min(pct, 100):.0f}%; background: {bar_color}; height: 10px; border-radius: 9999px;"></div>
+                </div>
+                <small>{pct:.0f}%</small>
+            </td>
+        </tr>
+        """
+    
+    product_options = "".join(f'<option value="{p["id"]}">{p["name"]}</option>' for p in products_list)
+    first_day = datetime.date.fromisoformat(f"{month}-01")
+    prev_month = (first_day - datetime.timedelta(days=1)).strftime('%Y-%m')
+    next_month = (first_day + datetime.timedelta(days=32)).strftime('%Y-%m')
+    
+    content = f"""
+    <div class="card">
+        <div class="card-header">
+            <h3>Set Target for {month}</h3>
+        </div>
+        <form method="post" class="form-row">
+            <input type="hidden" name="month" value="{month}">
+            <div class="form-group">
+                <label class="form-label">Product *</label>
+                <select name="product_id" class="form-control" required>{product_options}</select>
+            </div>
+            <div class="form-group">
+                <label class="form-label">Target Qty (0 removes)</label>
+                <input type="number" name="qty" class="form-control" step="0.01" required>
+            </div>
+            <div class="form-group" style="display: flex; align-items: flex-end;">
+                <button type="submit" class="btn btn-primary">Save Target</button>
+            </div>
+        </form>
+    </div>
+    
+    <div class="card">
+        <div class="card-header">
+            <div style="display: flex; gap: 0.5rem; align-items: center;">
+                <a href="{url_for('targets', month=prev_month)}" class="btn btn-secondary btn-sm"><i class="fas fa-chevron-left"></i></a>
+                <h3>Progress {month}</h3>
+                <a href="{url_for('targets', month=next_month)}" class="btn btn-secondary btn-sm"><i class="fas fa-chevron-right"></i></a>
+            </div>
+        </div>
+        <div class="table-container">
+            <table>
+                <thead>
+                    <tr>
+                        <th>Product</th>
+                        <th>Target</th>
+                        <th>Sold</th>
+                        <th>Sales</th>
+                        <th>Progress</th>
+                    </tr>
+                </thead>
+                <tbody>
+                    {rows}
+                </tbody>
+            </table>
+        </div>
+    </div>
+    """
+    
+    return render_page("Sales Targets - Smart Invoice Pro", "Sales Targets", content, "reports")
+
+# ===================== EXPENSES =====================
+def _expense_form(expense=None):
+    expense = expense or {}
+    return f"""
+            <div class="form-group">
+                <label class="form-label">Date *</label>
+                <input type="date" name="date" class="form-control" value="{expense.get('date') or datetime.date.today().isoformat()}" required>
+            </div>
+            <div class="form-group">
+                <label class="form-label">Category *</label>
+                <input type="text" name="category" class="form-control" list="expenseCategories" value="{expense.get('category') or ''}" required>
+            </div>
+            <div class="form-group">
+                <label class="form-label">Amount *</label>
+                <input type="number" name="amount" class="form-control" step="0.01" value="{expense.get('amount') or ''}" required>
+            </div>
+            <div class="form-group" style="grid-column: 1 / -1;">
+                <label class="form-label">Description</label>
+                <input type="text" name="description" class="form-control" value="{expense.get('description') or ''}">
+            </div>
+    """
+
+@app.route("/expenses", methods=["GET", "POST"])
+@login_required
+def expenses():
+    conn = get_db()
+    c = conn.cursor()
+    
+    if request.method == "POST":
+        date = request.form.get("date") or datetime.date.today().isoformat()
+        amount = float(request.form.get("amount", 0))
+        category = request.form.get("category", "").strip() or "General"
+        
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("""
+            INSERT INTO expenses (date, category, amount, description, created_by)
+            VALUES (?, ?, ?, ?, ?)
+        """, (date, category, amount, request.form.get("description", ""), session['user_id']))
+        bump_monthly_pnl(c, date, expenses=amount)
+        conn.commit()
+        flash("Expense added successfully", "success")
+        log_activity(session['user_id'], "ADD_EXPENSE", f"{category}: {amount:.2f}")
+    
+    month = month_arg()
+    attach_users(conn)
+    c.execute("""
+        SELECT e.*, u.full_name as created_by_name
+        FROM expenses e
+        LEFT JOIN users u ON e.created_by = u.id
+        WHERE e.date LIKE ?
+        ORDER BY e.date DESC, e.id DESC
+    """, (f"{month}%",))
+    expenses_list = c.fetchall()
+    c.execute("SELECT DISTINCT category FROM expenses WHERE category IS NOT NULL ORDER BY category")
+    categories = [row['category'] for row in c.fetchall()]
+    conn.close()
+    
+    total = sum(e['amount'] or 0 for e in expenses_list)
+    rows = ""
+    for e in expenses_list:
+        rows += f"""
+        <tr>
+            <td>{e['date']}</td>
+            <td><span class="badge badge-info">{e['category']}</span></td>
+            <td>{e['description'] or ''}</td>
+            <td>Rs {e['amount']:.2f}</td>
+            <td>{e['created_by_name'] or 'System'}</td>
+            <td>
+                <a href="{url_for('edit_expense', id=e['id'])}" class="btn btn-sm btn-secondary"><i class="fas fa-edit"></i></a>
+                <form method="post" action="{url_for('delete_expense', id=e['id'])}" style="display: inline;">
+                    <button type="submit" class="btn btn-sm btn-danger" onclick="return confirm('Delete this expense?')"><i class="fas fa-trash"></i></button>
+                </form>
+            </td>
+        </tr>
+        """
+    
+    category_options = "".join(f'<option value="{cat}">' for cat in categories)
+    first_day = datetime.date.fromisoformat(f"{month}-01")
+    prev_month = (first_day - datetime.timedelta(days=1)).strftime('%Y-%m')
+    next_month = (first_day + datetime.timedelta(days=32)).strftime('%Y-%m')
+    
+    content = f"""
+    <div class="card">
+        <div class="card-header">
+            <h3>Add Expense</h3>
+        </div>
+        <form method="post" class="form-row">
+            {_expense_form()}
+            <div class="form-group">
+                <button type="submit" class="btn btn-primary">Add Expense</button>
+            </div>
+        </form>
+        <datalist id="expenseCategories">{category_options}</datalist>
+    </div>
+    
+    <div class="card">
+        <div class="card-header">
+            <div style="display: flex; gap: 0.5rem; align-items: center;">
+                <a href="{url_for('expenses', month=prev_month)}" class="btn btn-secondary btn-sm"><i class="fas fa-chevron-left"></i></a>
+                <h3>{month}: Rs {total:.2f}</h3>
+                <a href="{url_for('expenses', month=next_month)}" class="btn btn-secondary btn-sm"><i class="fas fa-chevron-right"></i></a>
+            </div>
+            <a href="{url_for('export_data', dataset='expenses', fmt='csv', **{'from': f'{month}-01', 'to': f'{month}-31'})}" class="btn btn-secondary btn-sm">
+                <i class="fas fa-file-csv"></i> CSV
+            </a>
+        </div>
+        <div class="table-container">
+            <table>
+                <thead>
+                    <tr>
+                        <th>Date</th>
+                        <th>Category</th>
+                        <th>Description</th>
+                        <th>Amount</th>
+                        <th>By</th>
+                        <th>Actions</th>
+                    </tr>
+                </thead>
+                <tbody>
+                    {rows}
+                </tbody>
+            </table>
+        </div>
+    </div>
+    """
+    
+    return render_page("Expenses - Smart Invoice Pro", "Expenses", content, "expenses")
+
+@app.route("/expenses/<int:id>/edit", methods=["GET", "POST"])
+@login_required
+def edit_expense(id):
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("SELECT * FROM expenses WHERE id = ?", (id,))
+    expense = c.fetchone()
+    if not expense:
+        conn.close()
+        abort(404)
+    
+    if request.method == "POST":
+        amount = float(request.form.get("amount", 0))
+        category = request.form.get("category", "").strip() or "General"
+        
+        c.execute("BEGIN IMMEDIATE")
+        # The amount being replaced, read under the write lock: a concurrent
+        # edit in between would otherwise be reversed twice in monthly_pnl
+        c.execute("SELECT date, amount FROM expenses WHERE id = ?", (id,))
+        expense = c.fetchone()
+        if not expense:
+            conn.rollback()
+            conn.close()
+            abort(404)
+        date = request.form.get("date") or expense['date']
+        c.execute("""
+            UPDATE expenses SET date = ?, category = ?, amount = ?, description = ?
+            WHERE id = ?
+        """, (date, category, amount, request.form.get("description", ""), id))
+        bump_monthly_pnl(c, expense['date'], expenses=-(expense['amount'] or 0))
+        bump_monthly_pnl(c, date, expenses=amount)
+        conn.commit()
+        conn.close()
+        flash("Expense updated successfully", "success")
+        log_activity(session['user_id'], "EDIT_EXPENSE", f"Expense {id}")
+        return redirect(url_for('expenses', month=date[:7]))
+    
+    conn.close()
+    content = f"""
+    <div class="card">
+        <div class="card-header">
+            <h3>Edit Expense</h3>
+        </div>
+        <form method="post" class="form-row">
+            {_expense_form(dict(expense))}
+            <div class="form-group" style="display: flex; gap: 1rem;">
+                <button type="submit" class="btn btn-primary">Save</button>
+                <a href="{url_for('expenses', month=(expense['date'] or '')[:7] or None)}" class="btn btn-secondary">Cancel</a>
+            </div>
+        </form>
+    </div>
+    """
+    
+    return render_page("Edit Expense - Smart Invoice Pro", "Edit Expense", content, "expenses")
+
+@app.route("/expenses/<int:id>/delete", methods=["POST"])
+@login_required
+def delete_expense(id):
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("BEGIN IMMEDIATE")
+    c.execute("SELECT date, amount FROM expenses WHERE id = ?", (id,))
+    expense = c.fetchone()
+    if expense:
+        c.execute("DELETE FROM expenses WHERE id = ?", (id,))
+        bump_monthly_pnl(c, expense['date'], expenses=-(expense['amount'] or 0))
+    conn.commit()
+    conn.close()
+    
+    if expense:
+        flash("Expense deleted", "success")
+        log_activity(session['user_id'], "DELETE_EXPENSE", f"Expense {id}")
+    return redirect(url_for('expenses', month=(expense['date'] or '')[:7] if expense else None))
+
+# ===================== USER MANAGEMENT (ADMIN ONLY) =====================
+@app.route("/admin/users", methods=["GET", "POST"])
+@admin_required
+def users():
+    conn = get_main_db()
+    c = conn.cursor()
+    c.execute("SELECT code, name FROM branches ORDER BY code != ?, code", (MAIN_BRANCH,))
+    branches = {row['code']: row['name'] for row in c.fetchall()}
+    
+    if request.method == "POST":
+        action = request.form.get("action")
+        
+        if action == "add":
+            username = request.form.get("username").strip()
+            full_name = request.form.get("full_name").strip()
+            password = request.form.get("password")
+            role = request.form.get("role")
+            phone = request.form.get("phone", "")
+            branch = request.form.get("branch", MAIN_BRANCH)
+            if branch not in branches:
+                branch = MAIN_BRANCH
+            
+            try:
+                c.execute("""
+                    INSERT INTO users (username, password_hash, full_name, role, phone, branch)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, (username, hash_password(password), full_name, role, phone, branch))
+                conn.commit()
+                flash(f"User {username} created successfully", "success")
+                log_activity(session['user_id'], "CREATE_USER", f"Created user {username}")
+            except sqlite3.IntegrityError:
+                flash("Username already exists", "error")
+        
+        elif action == "toggle":
+            user_id = request.form.get("user_id")
+            c.execute("UPDATE users SET is_active = NOT is_active WHERE id = ?", (user_id,))
+            revoke_user_sessions(conn, user_id=user_id)
+            flash("User status updated", "success")
+        
+        elif action == "branch":
+            user_id = request.form.get("user_id")
+            branch = request.form.get("branch")
+            if branch in branches:
+                c.execute("UPDATE users SET branch = ? WHERE id = ?", (branch, user_id))
+                # Sessions carry the branch picked at login
+                revoke_user_sessions(conn, user_id=user_id)
+                flash("User moved to another branch", "success")
+    
+    c.execute("SELECT * FROM users ORDER BY created_at DESC")
+    users_list = c.fetchall()
+    conn.close()
+    
+    users_rows = ""
+    for user in users_list:
+        status_badge = "success" if user['is_active'] else "danger"
+        status_text = "Active" if user['is_active'] else "Inactive"
+        btn_class = "danger" if user['is_active'] else "success"
+        btn_text = "Deactivate" if user['is_active'] else "Activate"
+        branch_options = "".join(
+            f'<option value="{code}" {"selected" if code == user["branch"] else ""}>{name}</option>'
+            for code, name in branches.items())
+        
+        users_rows += f"""
+        <tr>
+            <td>{user['username']}</td>
+            <td>{user['full_name']}</td>
+            <td><span class="badge badge-info">{user['role'].title()}</span></td>
+            <td>{user['phone'] or '-'}</td>
+            <td>
+                <form method="post" style="display: inline;">
+                    <input type="hidden" name="action" value="branch">
+                    <input type="hidden" name="user_id" value="{user['id']}">
+                    <select name="branch" class="form-control" onchange="this.form.submit()">{branch_options}</select>
+                </form>
+            </td>
+            <td><span class="badge badge-{status_badge}">{status_text}</span></td>
+            <td>{user['last_login'] or 'Never'}</td>
+            <td>
+                <form method="post" style="display: inline;">
+                    <input type="hidden" name="action" value="toggle">
+                    <input type="hidden" name="user_id" value="{user['id']}">
+                    <button type="submit" class="btn btn-sm btn-{btn_class}">{btn_text}</button>
+                </form>
+            </td>
+        </tr>
+        """
+    
+    content = f"""
+    <div class="card">
+        <div class="card-header">
+            <h3>Add New User</h3>
+        </div>
+        <form method="post">
+            <input type="hidden" name="action" value="add">
+            <div class="form-row">
+                <div class="form-group">
+                    <label class="form-label">Username *</label>
+                    <input type="text" name="username" class="form-control" required>
+                </div>
+                <div class="form-group">
+                    <label class="form-label">Full Name *</label>
+                    <input type="text" name="full_name" class="form-control" required>
+                </div>
+                <div class="form-group">
+                    <label class="form-label">Password *</label>
+                    <input type="password" name="password" class="form-control" required>
+                </div>
+                <div class="form-group">
+                    <label class="form-label">Role *</label>
+                    <select name="role" class="form-control" required>
+                        <option value="salesman">Salesman</option>
+                        <option value="manager">Manager</option>
+                        <option value="admin">Admin</option>
+                    </select>
+                </div>
+                <div class="form-group">
+                    <label class="form-label">Phone</label>
+                    <input type="text" name="phone" class="form-control">
+                </div>
+                <div class="form-group">
+                    <label class="form-label">Branch</label>
+                    <select name="branch" class="form-control">
+                        {"".join(f'<option value="{code}">{name}</option>' for code, name in branches.items())}
+                    </select>
+                </div>
+            </div>
+            <button type="submit" class="btn btn-primary">Add User</button>
+        </form>
+    </div>
+    
+    <div class="card">
+        <div class="card-header">
+            <h3>All Users</h3>
+        </div>
+        <div class="table-container">
+            <table>
+                <thead>
+                    <tr>
+                        <th>Username</th>
+                        <th>Full Name</th>
+                        <th>Role</th>
+                        <th>Phone</th>
+                        <th>Branch</th>
+                        <th>Status</th>
+                        <th>Last Login</th>
+                        <th>Actions</th>
+                    </tr>
+                </thead>
+                <tbody>
+                    {users_rows}
+                </tbody>
+            </table>
+        </div>
+    </div>
+    """
+    
+    return render_page("User Management - Smart Invoice Pro", "User Management", content, "users")
+
+# ===================== BRANCHES (ADMIN ONLY) =====================
+BRANCH_ATTACH_BATCH = 8  # SQLite attaches at most 10 databases per connection
+
+@app.route("/admin/branches", methods=["GET", "POST"])
+@admin_required
+def branches():
+    conn = get_main_db()
+    c = conn.cursor()
+    
+    if request.method == "POST":
+        action = request.form.get("action")
+        
+        if action == "add":
+            code = request.form.get("code", "").strip().lower()
+            name = request.form.get("name", "").strip()
+            if not BRANCH_CODE_RE.match(code) or not name:
+                flash("Branch code must be lowercase letters, digits, '-' or '_' (max 32), and a name is required", "error")
+            else:
+                try:
+                    c.execute("INSERT INTO branches (code, name) VALUES (?, ?)", (code, name))
+                    conn.commit()
+                except sqlite3.IntegrityError:
+                    flash("Branch code already exists", "error")
+                else:
+                    migrate_branch_db(code)
+                    branch_conn = get_db(code)
+                    branch_conn.executemany("UPDATE settings SET value = ? WHERE key = ?", [
+                        (name, "company_name"),
+                        # Branch prefixes keep invoice numbers unique across the business
+                        (f"{code.upper()}-INV-", "invoice_prefix"),
+                    ])
+                    branch_conn.commit()
+                    branch_conn.close()
+                    flash(f"Branch {name} created", "success")
+                    log_activity(session['user_id'], "CREATE_BRANCH", f"Created branch {code}")
+        
+        elif action == "switch":
+            code = request.form.get("code")
+            c.execute("SELECT name FROM branches WHERE code = ?", (code,))
+            row = c.fetchone()
+            if row:
+                conn.close()
+                session['branch'] = code
+                flash(f"Now working in {row['name']}", "success")
+                return redirect(url_for('dashboard'))
+    
+    c.execute("SELECT * FROM branches ORDER BY code != ?, code", (MAIN_BRANCH,))
+    branch_list = c.fetchall()
+    c.execute("SELECT branch, COUNT(*) AS n FROM users GROUP BY branch")
+    user_counts = {row['branch']: row['n'] for row in c.fetchall()}
+    conn.close()
+    
+    rows = ""
+    for b in branch_list:
+        db_file = branch_db_file(b['code'])
+        size_kb = db_file.stat().st_size / 1024 if db_file.exists() else 0
+        if b['code'] == current_branch():
+            action_cell = '<span class="badge badge-success">Current</span>'
+        else:
+            action_cell = f"""
+                <form method="post" style="display: inline;">
+                    <input type="hidden" name="action" value="switch">
+                    <input type="hidden" name="code" value="{b['code']}">
+                    <button type="submit" class="btn btn-sm btn-primary">Switch</button>
+                </form>"""
+        rows += f"""
+        <tr>
+            <td><strong>{b['code']}</strong></td>
+            <td>{b['name']}</td>
+            <td>{db_file.name}</td>
+            <td>{size_kb:.0f} KB</td>
+            <td>{user_counts.get(b['code'], 0)}</td>
+            <td>{action_cell}</td>
+        </tr>
+        """
+    
+    content = f"""
+    <div class="card">
+        <div class="card-header">
+            <h3>Add Branch</h3>
+            <a href="{url_for('branch_report')}" class="btn btn-secondary btn-sm"><i class="fas fa-chart-bar"></i> Consolidated Report</a>
+        </div>
+        <p style="margin-bottom: 1rem; color: var(--text-muted);">
+            Each branch keeps its own customers, products, stock and invoices in a separate database file.
+            Users log in to their own branch; administrators can switch between branches.
+        </p>
+        <form method="post">
+            <input type="hidden" name="action" value="add">
+            <div class="form-row">
+                <div class="form-group">
+                    <label class="form-label">Code *</label>
+                    <input type="text" name="code" class="form-control" pattern="[a-z0-9][a-z0-9_-]{{0,31}}" placeholder="e.g. lahore" required>
+                </div>
+                <div class="form-group">
+                    <label class="form-label">Name *</label>
+                    <input type="text" name="name" class="form-control" required>
+                </div>
+            </div>
+            <button type="submit" class="btn btn-primary">Add Branch</button>
+        </form>
+    </div>
+    
+    <div class="card">
+        <div class="card-header">
+            <h3>All Branches</h3>
+        </div>
+        <div class="table-container">
+            <table>
+                <thead>
+                    <tr>
+                        <th>Code</th>
+                        <th>Name</th>
+                        <th>Database</th>
+                        <th>Size</th>
+                        <th>Users</th>
+                        <th>Action</th>
+                    </tr>
+                </thead>
+                <tbody>
+                    {rows}
+                </tbody>
+            </table>
+        </div>
+    </div>
+    """
+    
+    return render_page("Branches - Smart Invoice Pro", "Branches", content, "branches")
+
+def consolidated_pnl(year):
+    """monthly_pnl rows for every branch: one connection attaches the branch
+    databases read-only, BRANCH_ATTACH_BATCH at a time, and reads each batch
+    with a single UNION ALL."""
+    codes = [MAIN_BRANCH] + list_branches()
+    rows = []
+    for start in range(0, len(codes), BRANCH_ATTACH_BATCH):
+        batch = codes[start:start + BRANCH_ATTACH_BATCH]
+        conn = sqlite3.connect(":memory:", uri=True, timeout=DB_TIMEOUT, factory=TracedConnection)
+        conn.row_factory = sqlite3.Row
+        parts = []
+        for n, code in enumerate(batch):
+            migrate_branch_db(code)
+            conn.execute(f"ATTACH DATABASE ? AS b{n}", (branch_db_file(code).resolve().as_uri() + "?mode=ro",))
+            parts.append(f"""
+                SELECT '{code}' AS branch, month, revenue, tax, cogs, expenses,
+                       (SELECT COUNT(*) FROM b{n}.invoices WHERE date LIKE :year) AS invoices,
+                       (SELECT COALESCE(SUM(balance), 0) FROM b{n}.invoices WHERE balance > 0) AS receivable
+                FROM b{n}.monthly_pnl WHERE month LIKE :year
+            """)
+        rows += conn.execute(" UNION ALL ".join(parts) + " ORDER BY month", {"year": f"{year}-%"}).fetchall()
+        conn.close()
+    return rows
+
+@app.route("/admin/branches/report")
+@admin_required
+def branch_report():
+    year = request.args.get('year', type=int) or datetime.date.today().year
+    conn = get_main_db()
+    names = {row['code']: row['name'] for row in conn.execute("SELECT code, name FROM branches")}
+    conn.close()
+    
+    by_branch = {}
+    by_month = {}
+    for r in consolidated_pnl(year):
+        b = by_branch.setdefault(r['branch'], {"revenue": 0, "cogs": 0, "expenses": 0, "tax": 0,
+                                               "invoices": r['invoices'], "receivable": r['receivable']})
+        m = by_month.setdefault(r['month'], {"revenue": 0, "cogs": 0, "expenses": 0, "tax": 0})
+        for key in ("revenue", "cogs", "expenses", "tax"):
+            b[key] += r[key] or 0
+            m[key] += r[key] or 0
+    
+    branch_rows = ""
+    for code, b in sorted(by_branch.items(), key=lambda item: -item[1]['revenue']):
+        net = b['revenue'] - b['cogs'] - b['expenses']
+        branch_rows += f"""
+        <tr>
+            <td><strong>{names.get(code, code)}</strong> <small style="color: var(--text-muted);">{code}</small></td>
+            <td>{b['invoices']}</td>
+            <td>Rs {b['revenue']:.2f}</td>
+            <td>Rs {b['cogs']:.2f}</td>
+            <td>Rs {b['expenses']:.2f}</td>
+            <td style="color: {'var(--success)' if net >= 0 else 'var(--danger)'};"><strong>Rs {net:.2f}</strong></td>
+            <td>Rs {b['receivable']:.2f}</td>
+        </tr>
+        """
+    
+    month_rows = ""
+    for month, m in sorted(by_month.items()):
+        net = m['revenue'] - m['cogs'] - m['expenses']
+        month_rows += f"""
+        <tr>
+            <td><strong>{month}</strong></td>
+            <td>Rs {m['revenue']:.2f}</td>
+            <td>Rs {m['cogs']:.2f}</td>
+            <td>Rs {m['expenses']:.2f}</td>
+            <td style="color: {'var(--success)' if net >= 0 else 'var(--danger)'};"><strong>Rs {net:.2f}</strong></td>
+            <td>Rs {m['tax']:.2f}</td>
+        </tr>
+        """
+    
+    total_revenue = sum(m['revenue'] for m in by_month.values())
+    total_net = sum(m['revenue'] - m['cogs'] - m['expenses'] for m in by_month.values())
+    
+    content = f"""
+    <div class="stats-grid">
+        <div class="stat-card primary">
+            <div class="icon"><i class="fas fa-store"></i></div>
+            <div class="stat-value">{len(names)}</div>
+            <div class="stat-label">Branches</div>
+        </div>
+        <div class="stat-card success">
+            <div class="icon"><i class="fas fa-coins"></i></div>
+            <div class="stat-value">Rs {total_revenue:.0f}</div>
+            <div class="stat-label">Revenue {year}</div>
+        </div>
+        <div class="stat-card {'success' if total_net >= 0 else 'danger'}">
+            <div class="icon"><i class="fas fa-balance-scale"></i></div>
+            <div class="stat-value">Rs {total_net:.0f}</div>
+            <div class="stat-label">Net Profit</div>
+        </div>
+    </div>
+    
+    <div class="card">
+        <div class="card-header">
+            <h3>Branches {year}</h3>
+            <div style="display: flex; gap: 0.5rem;">
+                <a href="{url_for('branch_report', year=year - 1)}" class="btn btn-secondary btn-sm"><i class="fas fa-chevron-left"></i> {year - 1}</a>
+                <a href="{url_for('branch_report', year=year + 1)}" class="btn btn-secondary btn-sm">{year + 1} <i class="fas fa-chevron-right"></i></a>
+            </div>
+        </div>
+        <div class="table-container">
+            <table>
+                <thead>
+                    <tr>
+                        <th>Branch</th>
+                        <th>Invoices</th>
+                        <th>Revenue</th>
+                        <th>Cost of Goods</th>
+                        <th>Expenses</th>
+                        <th>Net Profit</th>
+                        <th>Receivable</th>
+                    </tr>
+                </thead>
+                <tbody>
+                    {branch_rows}
+                </tbody>
+            </table>
+        </div>
+    </div>
+    
+    <div class="card">
+        <div class="card-header">
+            <h3>All Branches by Month</h3>
+        </div>
+        <div class="table-container">
+            <table>
+                <thead>
+                    <tr>
+                        <th>Month</th>
+                        <th>Revenue</th>
+                        <th>Cost of Goods</th>
+                        <th>Expenses</th>
+                        <th>Net Profit</th>
+                        <th>Tax Collected</th>
+                    </tr>
+                </thead>
+                <tbody>
+                    {month_rows}
+                </tbody>
+            </table>
+        </div>
+    </div>
+    """
+    
+    return render_page("Branch Report - Smart Invoice Pro", "Consolidated Report", content, "branches")
+
+# ===================== BACKUP & RESTORE =====================
+@app.route("/admin/backup", methods=["GET", "POST"])
+@admin_required
+def backup():
+    # Backups and restores cover the branch being worked on; both run in the job queue
+    if request.method == "POST":
+        action = request.form.get("action")
+        
+        if action == "backup":
+            job_id = enqueue_job("backup", {})
+            flash(f"Backup started (job #{job_id}); it will be listed below when done", "success")
+        
+        elif action == "restore":
+            file = request.files.get("backup_file")
+            if file:
+                RESTORE_UPLOADS_DIR.mkdir(parents=True, exist_ok=True)
+                upload = RESTORE_UPLOADS_DIR / f"restore_{secrets.token_hex(8)}.db"
+                file.save(upload)
+                job_id = enqueue_job("restore", {"file": upload.name}, priority=JOB_PRIORITY_HIGH,
+                                     max_attempts=1)
+                flash(f"Restore started (job #{job_id})", "success")
+        return redirect(url_for('backup'))
     
     backups = sorted(BACKUP_DIR.glob("*.db"), key=lambda x: x.stat().st_mtime, reverse=True)
     
+    conn = get_main_db()
+    recent_jobs = conn.execute("""
+        SELECT id, kind, status, attempts, error, created_at, finished_at FROM jobs
+        WHERE kind IN ('backup', 'restore') AND branch = ?
+        ORDER BY id DESC LIMIT 10
+    """, (current_branch(),)).fetchall()
+    conn.close()
+    job_rows = ""
+    for job in recent_jobs:
+        badge = {"done": "success", "failed": "danger"}.get(job['status'], "info")
+        job_rows += f"""
+        <tr>
+            <td>#{job['id']}</td>
+            <td>{job['kind'].title()}</td>
+            <td><span class="badge badge-{badge}">{job['status'].title()}</span></td>
+            <td>{job['created_at']}</td>
+            <td>{job['finished_at'] or '-'}</td>
+            <td>{job['error'] or ''}</td>
+        </tr>
+        """
+    
     backup_rows = ""
     for backup in backups:
         size_kb = backup.stat().st_size / 1024
@@ -1828,6 +5510,29 @@ def backup():
         </form>
     </div>
     
+    <div class="card">
+        <div class="card-header">
+            <h3>Recent Backup Jobs</h3>
+        </div>
+        <div class="table-container">
+            <table>
+                <thead>
+                    <tr>
+                        <th>Job</th>
+                        <th>Type</th>
+                        <th>Status</th>
+                        <th>Queued</th>
+                        <th>Finished</th>
+                        <th>Error</th>
+                    </tr>
+                </thead>
+                <tbody>
+                    {job_rows}
+                </tbody>
+            </table>
+        </div>
+    </div>
+    
     <div class="card">
         <div class="card-header">
             <h3>Available Backups</h3>
@@ -1861,44 +5566,76 @@ def download_backup(filename):
 @app.route("/customers", methods=["GET", "POST"])
 @login_required
 def customers():
-    conn = get_db()
-    c = conn.cursor()
-    
+    is_admin = session.get('role') == 'admin'
     if request.method == "POST":
-        name = request.form.get("name").strip()
-        address = request.form.get("address", "")
-        phone = request.form.get("phone", "")
-        email = request.form.get("email", "")
-        
         try:
-            c.execute("""
-                INSERT INTO customers (name, address, phone, email)
-                VALUES (?, ?, ?, ?)
-            """, (name, address, phone, email))
-            conn.commit()
-            flash("Customer added successfully", "success")
-        except sqlite3.IntegrityError:
-            flash("Customer already exists", "error")
+            credit_limit = float(request.form.get("credit_limit") or 0)
+        except ValueError:
+            credit_limit = None
+        if credit_limit is not None and not (math.isfinite(credit_limit) and credit_limit >= 0):
+            credit_limit = None
+        
+        if request.form.get("action") == "credit_limit":
+            if not is_admin:
+                flash("Admin access required", "error")
+            elif credit_limit is None:
+                flash("Credit limit must be a number of 0 or more", "error")
+            else:
+                storage.set_credit_limit(request.form.get("customer_id", type=int), credit_limit)
+                flash("Credit limit updated", "success")
+        elif credit_limit is None:
+            flash("Credit limit must be a number of 0 or more", "error")
+        else:
+            name = request.form.get("name").strip()
+            address = request.form.get("address", "")
+            phone = request.form.get("phone", "")
+            email = request.form.get("email", "")
+            
+            try:
+                storage.add_customer(name, address, phone, email, credit_limit if is_admin else 0)
+                flash("Customer added successfully", "success")
+            except DuplicateRecord:
+                flash("Customer already exists", "error")
     
-    c.execute("SELECT * FROM customers ORDER BY name")
-    customers_list = c.fetchall()
-    conn.close()
+    customers_list = storage.list_customers()
     
     rows = ""
     for c in customers_list:
         balance_color = "var(--danger)" if c['balance'] > 0 else "var(--success)"
+        over_limit = c['credit_limit'] and c['balance'] > c['credit_limit']
+        if is_admin:
+            limit_cell = f"""
+                <form method="post" style="display: flex; gap: 0.25rem;">
+                    <input type="hidden" name="action" value="credit_limit">
+                    <input type="hidden" name="customer_id" value="{c['id']}">
+                    <input type="number" name="credit_limit" class="form-control" step="0.01" min="0"
+                           value="{c['credit_limit'] or 0:g}" style="width: 7rem;" title="0 = no limit">
+                    <button type="submit" class="btn btn-sm btn-secondary"><i class="fas fa-check"></i></button>
+                </form>
+            """
+        else:
+            limit_cell = f"Rs {c['credit_limit']:.2f}" if c['credit_limit'] else "-"
         rows += f"""
         <tr>
-            <td>{c['name']}</td>
+            <td>{c['name']} {'<span class="badge badge-danger">Over limit</span>' if over_limit else ''}</td>
             <td>{c['phone'] or '-'}</td>
             <td>{c['email'] or '-'}</td>
             <td style="color: {balance_color};">Rs {c['balance']:.2f}</td>
+            <td>{limit_cell}</td>
             <td>
                 <a href="{url_for('ledger', customer_id=c['id'])}" class="btn btn-sm btn-secondary">Ledger</a>
             </td>
         </tr>
         """
     
+    # Credit limits are an admin decision
+    credit_limit_field = """
+            <div class="form-group">
+                <label class="form-label">Credit Limit</label>
+                <input type="number" name="credit_limit" class="form-control" step="0.01" min="0" placeholder="0 = no limit">
+            </div>
+    """ if is_admin else ""
+    
     content = f"""
     <div class="card">
         <div class="card-header">
@@ -1917,6 +5654,7 @@ def customers():
                 <label class="form-label">Email</label>
                 <input type="email" name="email" class="form-control">
             </div>
+            {credit_limit_field}
             <div class="form-group" style="grid-column: 1 / -1;">
                 <label class="form-label">Address</label>
                 <input type="text" name="address" class="form-control">
@@ -1936,6 +5674,7 @@ def customers():
                         <th>Phone</th>
                         <th>Email</th>
                         <th>Balance</th>
+                        <th>Credit Limit</th>
                         <th>Actions</th>
                     </tr>
                 </thead>
@@ -1965,92 +5704,504 @@ def products():
         unit = request.form.get("unit", "pcs")
         
         try:
-            c.execute("""
-                INSERT INTO products (name, description, unit_price, purchase_price, stock, min_stock, unit)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            """, (name, description, unit_price, purchase_price, stock, min_stock, unit))
-            conn.commit()
-            flash("Product added successfully", "success")
-        except sqlite3.IntegrityError:
-            c.execute("""
-                UPDATE products SET 
-                description = ?, unit_price = ?, purchase_price = ?, 
-                stock = stock + ?, min_stock = ?, unit = ?
-                WHERE name = ?
-            """, (description, unit_price, purchase_price, stock, min_stock, unit, name))
-            conn.commit()
-            flash("Product updated successfully", "success")
+            c.execute("""
+                INSERT INTO products (name, description, unit_price, purchase_price, stock, min_stock, unit)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (name, description, unit_price, purchase_price, stock, min_stock, unit))
+            product_id = c.lastrowid
+            message = "Product added successfully"
+        except sqlite3.IntegrityError:
+            c.execute("""
+                UPDATE products SET 
+                description = ?, unit_price = ?, purchase_price = ?, 
+                stock = stock + ?, min_stock = ?, unit = ?
+                WHERE name = ?
+            """, (description, unit_price, purchase_price, stock, min_stock, unit, name))
+            c.execute("SELECT id FROM products WHERE name = ?", (name,))
+            product_id = c.fetchone()['id']
+            message = "Product updated successfully"
+        
+        if stock:
+            record_stock_movement(c, product_id, stock, 'purchase', user_id=session['user_id'])
+        conn.commit()
+        flash(message, "success")
+    
+    c.execute("SELECT * FROM products ORDER BY name")
+    products_list = c.fetchall()
+    conn.close()
+    
+    rows = ""
+    for p in products_list:
+        status_badge = "danger" if p['stock'] <= p['min_stock'] else "success"
+        status_text = "Low Stock" if p['stock'] <= p['min_stock'] else "In Stock"
+        
+        rows += f"""
+        <tr>
+            <td>
+                <strong>{p['name']}</strong>
+                {f'<br><small>{p["description"]}</small>' if p['description'] else ''}
+            </td>
+            <td>Rs {p['unit_price']:.2f}</td>
+            <td>{p['stock']} {p['unit']}</td>
+            <td><span class="badge badge-{status_badge}">{status_text}</span></td>
+        </tr>
+        """
+    
+    content = f"""
+    <div class="card">
+        <div class="card-header">
+            <h3>Add/Update Product</h3>
+            <div style="display: flex; gap: 0.5rem;">
+                <a href="{url_for('import_products_page')}" class="btn btn-secondary btn-sm">
+                    <i class="fas fa-file-import"></i> Import
+                </a>
+                <a href="{url_for('stock_report')}" class="btn btn-secondary btn-sm">
+                    <i class="fas fa-warehouse"></i> Stock & Valuation
+                </a>
+            </div>
+        </div>
+        <form method="post" class="form-row">
+            <div class="form-group">
+                <label class="form-label">Name *</label>
+                <input type="text" name="name" class="form-control" required>
+            </div>
+            <div class="form-group">
+                <label class="form-label">Selling Price *</label>
+                <input type="number" name="unit_price" class="form-control" step="0.01" required>
+            </div>
+            <div class="form-group">
+                <label class="form-label">Cost Price</label>
+                <input type="number" name="purchase_price" class="form-control" step="0.01">
+            </div>
+            <div class="form-group">
+                <label class="form-label">Add Stock</label>
+                <input type="number" name="stock" class="form-control" step="0.01" value="0">
+            </div>
+            <div class="form-group">
+                <label class="form-label">Min Stock Alert</label>
+                <input type="number" name="min_stock" class="form-control" step="0.01" value="10">
+            </div>
+            <div class="form-group">
+                <label class="form-label">Unit</label>
+                <input type="text" name="unit" class="form-control" value="pcs">
+            </div>
+            <div class="form-group" style="grid-column: 1 / -1;">
+                <label class="form-label">Description</label>
+                <input type="text" name="description" class="form-control">
+            </div>
+            <div class="form-group">
+                <button type="submit" class="btn btn-primary">Save Product</button>
+            </div>
+        </form>
+    </div>
+    
+    <div class="card">
+        <div class="table-container">
+            <table>
+                <thead>
+                    <tr>
+                        <th>Name</th>
+                        <th>Price</th>
+                        <th>Stock</th>
+                        <th>Status</th>
+                    </tr>
+                </thead>
+                <tbody>
+                    {rows}
+                </tbody>
+            </table>
+        </div>
+    </div>
+    """
+    
+    return render_page("Products - Smart Invoice Pro", "Products", content, "products")
+
+# ===================== PRODUCT IMPORT =====================
+IMPORT_CHUNK_SIZE = 5000
+PRODUCT_IMPORT_COLUMNS = ('name', 'description', 'unit_price', 'purchase_price',
+                          'stock', 'min_stock', 'unit', 'category', 'barcode')
+PRODUCT_NUMERIC_COLUMNS = ('unit_price', 'purchase_price', 'stock', 'min_stock')
+
+def iter_import_chunks(stream, filename, chunk_size=IMPORT_CHUNK_SIZE):
+    """Yield lists of row dicts from a CSV or XLSX upload without loading it whole."""
+    if filename.lower().endswith(('.xlsx', '.xlsm')):
+        from openpyxl import load_workbook
+        workbook = load_workbook(stream, read_only=True, data_only=True)
+        rows = workbook.active.iter_rows(values_only=True)
+        header = [str(h or '').strip().lower() for h in next(rows, ())]
+        chunk = []
+        for values in rows:
+            chunk.append(dict(zip(header, values)))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+        workbook.close()
+    else:
+        import pandas as pd
+        reader = pd.read_csv(stream, chunksize=chunk_size, dtype=str,
+                             keep_default_na=False, skipinitialspace=True)
+        for frame in reader:
+            frame.columns = [str(col).strip().lower() for col in frame.columns]
+            yield frame.to_dict('records')
+
+def import_products(stream, filename, user_id=None, chunk_size=IMPORT_CHUNK_SIZE):
+    """Upsert products from a CSV/XLSX price list, one transaction per chunk.
+    
+    Only the columns present in the file are updated on existing products,
+    and a blank price or quantity cell leaves the stored value alone (new
+    products get 0); 'stock' is added to the current stock and journalled as
+    a purchase, the same as the product form. Returns counts and per-row errors.
+    """
+    result = {"processed": 0, "errors": []}
+    today = datetime.date.today().isoformat()
+    conn = get_db()
+    c = conn.cursor()
+    
+    line = 1  # header
+    sql = columns = None
+    for chunk in iter_import_chunks(stream, filename, chunk_size):
+        if columns is None:
+            columns = [col for col in PRODUCT_IMPORT_COLUMNS if col in chunk[0]]
+            if 'name' not in columns:
+                conn.close()
+                result["errors"].append({"row": 1, "error": "Missing 'name' column"})
+                return result
+            # Blank numbers arrive as NULL: 0 for a new product, unchanged on update
+            inserts = [f"COALESCE(:{col}, 0)" if col in PRODUCT_NUMERIC_COLUMNS else f":{col}" for col in columns]
+            updates = [f"stock = stock + COALESCE(:stock, 0)" if col == 'stock'
+                       else f"{col} = COALESCE(:{col}, {col})" if col in PRODUCT_NUMERIC_COLUMNS
+                       else f"{col} = :{col}"
+                       for col in columns if col != 'name']
+            sql = f"""
+                INSERT INTO products ({', '.join(columns)})
+                VALUES ({', '.join(inserts)})
+                ON CONFLICT(name) DO {'UPDATE SET ' + ', '.join(updates) if updates else 'NOTHING'}
+            """
+        
+        params = []
+        stock_added = []
+        for row in chunk:
+            line += 1
+            name = str(row.get('name') or '').strip()
+            if not name:
+                result["errors"].append({"row": line, "error": "Name is required"})
+                continue
+            values = {}
+            try:
+                for col in columns:
+                    value = row.get(col)
+                    if col == 'name':
+                        value = name
+                    elif col in PRODUCT_NUMERIC_COLUMNS:
+                        value = float(value) if str(value if value is not None else '').strip() else None
+                        if value is not None and not math.isfinite(value):
+                            raise ValueError
+                    elif value is not None:
+                        value = str(value).strip()
+                    values[col] = value
+            except ValueError:
+                result["errors"].append({"row": line, "error": f"Invalid number in '{col}': {row.get(col)!r}"})
+                continue
+            params.append(values)
+            if values.get('stock'):
+                stock_added.append((values['stock'], name))
+        
+        c.execute("BEGIN IMMEDIATE")
+        c.executemany(sql, params)
+        if stock_added:
+            c.executemany("""
+                INSERT INTO stock_movements (product_id, date, type, qty, note, created_by)
+                SELECT id, ?, 'purchase', ?, 'Bulk import', ? FROM products WHERE name = ?
+            """, [(today, qty, user_id, name) for qty, name in stock_added])
+            c.executemany("""
+                UPDATE stock_snapshots SET qty = qty + ?
+                WHERE product_id = (SELECT id FROM products WHERE name = ?) AND date >= ?
+            """, [(qty, name, today) for qty, name in stock_added])
+        conn.commit()
+        result["processed"] += len(params)
+    
+    conn.close()
+    return result
+
+@app.cli.command("import-products")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+def import_products_command(path):
+    """Upsert products from a CSV or XLSX file."""
+    with open(path, "rb") as f:
+        result = import_products(f, path)
+    for error in result["errors"]:
+        click.echo(f"Row {error['row']}: {error['error']}")
+    click.echo(f"Imported {result['processed']} product(s), {len(result['errors'])} error(s)")
+
+@app.route("/products/import", methods=["GET", "POST"])
+@login_required
+def import_products_page():
+    errors_html = ""
+    if request.method == "POST":
+        file = request.files.get("file")
+        if not file or not file.filename:
+            flash("Choose a CSV or XLSX file", "error")
+            return redirect(url_for('import_products_page'))
+        
+        filename = secure_filename(file.filename)
+        try:
+            result = import_products(file.stream, filename, session['user_id'])
+        except Exception as e:
+            flash(f"Could not read {filename}: {str(e)}", "error")
+            return redirect(url_for('import_products_page'))
+        
+        log_activity(session['user_id'], "IMPORT_PRODUCTS",
+                     f"Imported {result['processed']} products from {filename}")
+        flash(f"Imported {result['processed']} product(s) with {len(result['errors'])} error(s)",
+              "success" if not result['errors'] else "warning")
+        
+        if result['errors']:
+            error_rows = "".join(f"<tr><td>{e['row']}</td><td>{e['error']}</td></tr>"
+                                 for e in result['errors'][:500])
+            errors_html = f"""
+    <div class="card">
+        <div class="card-header">
+            <h3>Rows Not Imported</h3>
+        </div>
+        <div class="table-container">
+            <table>
+                <thead>
+                    <tr>
+                        <th>Row</th>
+                        <th>Error</th>
+                    </tr>
+                </thead>
+                <tbody>
+                    {error_rows}
+                </tbody>
+            </table>
+        </div>
+    </div>
+            """
+    
+    content = f"""
+    <div class="card">
+        <div class="card-header">
+            <h3>Import Products</h3>
+            <a href="{url_for('products')}" class="btn btn-secondary btn-sm">Back to Products</a>
+        </div>
+        <p style="margin-bottom: 1rem; color: var(--text-muted);">
+            CSV or XLSX with a header row: <code>name,unit_price,purchase_price,stock,min_stock</code>
+            (optional: description, unit, category, barcode). Existing products are updated by name;
+            stock is added to the current stock.
+        </p>
+        <form method="post" enctype="multipart/form-data">
+            <div class="form-group">
+                <input type="file" name="file" class="form-control" accept=".csv,.xlsx,.xlsm" required>
+            </div>
+            <button type="submit" class="btn btn-primary">
+                <i class="fas fa-file-import"></i> Import
+            </button>
+        </form>
+    </div>
+    {errors_html}
+    """
+    
+    return render_page("Import Products - Smart Invoice Pro", "Import Products", content, "products")
+
+@app.route("/products/stock", methods=["GET", "POST"])
+@login_required
+def stock_report():
+    if request.method == "POST":
+        product_id = request.form.get("product_id", type=int)
+        movement_type = request.form.get("type", "adjustment")
+        qty = request.form.get("qty", 0, type=float) or 0
+        note = request.form.get("note", "")
+        try:
+            date = datetime.date.fromisoformat(request.form.get("date") or datetime.date.today().isoformat()).isoformat()
+        except ValueError:
+            flash("Movement date must be a date (YYYY-MM-DD)", "error")
+            return redirect(url_for('stock_report'))
+        
+        if movement_type not in ('adjustment', 'return') or not product_id or not qty or not math.isfinite(qty):
+            flash("Choose a product, a movement type and a non-zero quantity", "error")
+            return redirect(url_for('stock_report'))
+        if movement_type == 'return':
+            qty = abs(qty)
+        
+        conn = get_db()
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        # Guarded like a sale: stock never goes below zero
+        c.execute("UPDATE products SET stock = stock + ? WHERE id = ? AND stock + ? >= 0",
+                  (qty, product_id, qty))
+        if not c.rowcount:
+            c.execute("SELECT stock FROM products WHERE id = ?", (product_id,))
+            product = c.fetchone()
+            available = max(product['stock'] or 0, 0) if product else 0
+            if not product or get_setting('stock_policy', 'reject') != 'backorder' or not available:
+                conn.rollback()
+                conn.close()
+                flash(f"Only {available:g} in stock; the adjustment would take it below zero", "error")
+                return redirect(url_for('stock_report'))
+            # 'backorder' policy: take out what is there, as a sale would
+            c.execute("UPDATE products SET stock = stock - ? WHERE id = ? AND stock >= ?",
+                      (available, product_id, available))
+            flash(f"Only {available:g} in stock; adjusted by -{available:g}", "warning")
+            qty = -available
+        record_stock_movement(c, product_id, qty, movement_type, date, note=note, user_id=session['user_id'])
+        conn.commit()
+        conn.close()
+        log_activity(session['user_id'], "STOCK_" + movement_type.upper(), f"Product {product_id}: {qty:+g}")
+        flash("Stock movement recorded", "success")
+        return redirect(url_for('stock_report'))
     
-    c.execute("SELECT * FROM products ORDER BY name")
-    products_list = c.fetchall()
+    as_of = date_arg('date', datetime.date.today().isoformat())
+    
+    conn = get_read_db()
+    c = conn.cursor()
+    # Month-end snapshots are written by a background job, not by this GET
+    c.execute("SELECT (SELECT MAX(date) FROM stock_snapshots), (SELECT MIN(date) FROM stock_movements)")
+    last_snapshot, first_movement = c.fetchone()
+    month_end = last_month_end().isoformat()
+    if first_movement and first_movement[:10] <= month_end and (last_snapshot or '') < month_end:
+        enqueue_job("stock_snapshots", {}, dedupe=True)
+    stock = stock_on_date(c, as_of)
     conn.close()
     
+    product_options = ""
     rows = ""
-    for p in products_list:
-        status_badge = "danger" if p['stock'] <= p['min_stock'] else "success"
-        status_text = "Low Stock" if p['stock'] <= p['min_stock'] else "In Stock"
-        
+    total_value = 0
+    for p in stock:
+        product_options += f'<option value="{p["id"]}">{p["name"]}</option>'
+        total_value += p['value'] or 0
         rows += f"""
         <tr>
-            <td>
-                <strong>{p['name']}</strong>
-                {f'<br><small>{p["description"]}</small>' if p['description'] else ''}
-            </td>
-            <td>Rs {p['unit_price']:.2f}</td>
-            <td>{p['stock']} {p['unit']}</td>
-            <td><span class="badge badge-{status_badge}">{status_text}</span></td>
+            <td><a href="{url_for('stock_movements', id=p['id'])}">{p['name']}</a></td>
+            <td>{p['qty']:g} {p['unit'] or ''}</td>
+            <td>Rs {p['purchase_price'] or 0:.2f}</td>
+            <td>Rs {p['value'] or 0:.2f}</td>
         </tr>
         """
     
     content = f"""
     <div class="card">
         <div class="card-header">
-            <h3>Add/Update Product</h3>
+            <h3>Stock on Date</h3>
+            <strong>Valuation: Rs {total_value:.2f}</strong>
         </div>
-        <form method="post" class="form-row">
-            <div class="form-group">
-                <label class="form-label">Name *</label>
-                <input type="text" name="name" class="form-control" required>
-            </div>
+        <form method="get" class="form-row">
             <div class="form-group">
-                <label class="form-label">Selling Price *</label>
-                <input type="number" name="unit_price" class="form-control" step="0.01" required>
+                <input type="date" name="date" class="form-control" value="{as_of}" onchange="this.form.submit()">
             </div>
+        </form>
+        <div class="table-container">
+            <table>
+                <thead>
+                    <tr>
+                        <th>Product</th>
+                        <th>Stock</th>
+                        <th>Cost Price</th>
+                        <th>Value</th>
+                    </tr>
+                </thead>
+                <tbody>
+                    {rows}
+                </tbody>
+            </table>
+        </div>
+    </div>
+    
+    <div class="card">
+        <div class="card-header">
+            <h3>Adjustment / Return</h3>
+        </div>
+        <form method="post" class="form-row">
             <div class="form-group">
-                <label class="form-label">Cost Price</label>
-                <input type="number" name="purchase_price" class="form-control" step="0.01">
+                <label class="form-label">Product *</label>
+                <select name="product_id" class="form-control" required>
+                    {product_options}
+                </select>
             </div>
             <div class="form-group">
-                <label class="form-label">Add Stock</label>
-                <input type="number" name="stock" class="form-control" step="0.01" value="0">
+                <label class="form-label">Type</label>
+                <select name="type" class="form-control">
+                    <option value="adjustment">Adjustment (+/-)</option>
+                    <option value="return">Customer Return</option>
+                </select>
             </div>
             <div class="form-group">
-                <label class="form-label">Min Stock Alert</label>
-                <input type="number" name="min_stock" class="form-control" step="0.01" value="10">
+                <label class="form-label">Quantity *</label>
+                <input type="number" name="qty" class="form-control" step="0.01" required>
             </div>
             <div class="form-group">
-                <label class="form-label">Unit</label>
-                <input type="text" name="unit" class="form-control" value="pcs">
+                <label class="form-label">Date</label>
+                <input type="date" name="date" class="form-control" value="{datetime.date.today().isoformat()}">
             </div>
             <div class="form-group" style="grid-column: 1 / -1;">
-                <label class="form-label">Description</label>
-                <input type="text" name="description" class="form-control">
+                <label class="form-label">Note</label>
+                <input type="text" name="note" class="form-control">
             </div>
             <div class="form-group">
-                <button type="submit" class="btn btn-primary">Save Product</button>
+                <button type="submit" class="btn btn-primary">Record Movement</button>
             </div>
         </form>
     </div>
+    """
+    
+    return render_page("Stock Report - Smart Invoice Pro", "Stock & Valuation", content, "products")
+
+@app.route("/products/<int:id>/movements")
+@login_required
+def stock_movements(id):
+    conn = get_db()
+    attach_users(conn)
+    c = conn.cursor()
+    
+    c.execute("SELECT * FROM products WHERE id = ?", (id,))
+    product = c.fetchone()
+    if not product:
+        conn.close()
+        abort(404)
+    
+    c.execute("""
+        SELECT m.*, i.inv_no, u.full_name as created_by_name
+        FROM stock_movements m
+        LEFT JOIN invoices i ON m.invoice_id = i.id
+        LEFT JOIN users u ON m.created_by = u.id
+        WHERE m.product_id = ?
+        ORDER BY m.date DESC, m.id DESC
+        LIMIT 500
+    """, (id,))
+    movements = c.fetchall()
+    conn.close()
+    
+    rows = ""
+    for m in movements:
+        type_class = "success" if m['qty'] > 0 else "danger"
+        ref = f'<br><small>Ref: {m["inv_no"]}</small>' if m['inv_no'] else ''
+        rows += f"""
+        <tr>
+            <td>{m['date']}</td>
+            <td><span class="badge badge-{type_class}">{m['type'].title()}</span></td>
+            <td>{m['qty']:+g}</td>
+            <td>{m['note'] or ''}{ref}</td>
+            <td>{m['created_by_name'] or 'System'}</td>
+        </tr>
+        """
     
+    content = f"""
     <div class="card">
+        <div class="card-header">
+            <h3>{product['name']}</h3>
+            <strong>Current Stock: {product['stock']:g} {product['unit'] or ''}</strong>
+        </div>
         <div class="table-container">
             <table>
                 <thead>
                     <tr>
-                        <th>Name</th>
-                        <th>Price</th>
-                        <th>Stock</th>
-                        <th>Status</th>
+                        <th>Date</th>
+                        <th>Type</th>
+                        <th>Qty</th>
+                        <th>Note</th>
+                        <th>By</th>
                     </tr>
                 </thead>
                 <tbody>
@@ -2061,28 +6212,20 @@ def products():
     </div>
     """
     
-    return render_page("Products - Smart Invoice Pro", "Products", content, "products")
+    return render_page(f"{product['name']} Stock - Smart Invoice Pro", "Stock Movements", content, "products")
 
 @app.route("/settings", methods=["GET", "POST"])
 @admin_required
 def settings():
-    conn = get_db()
-    c = conn.cursor()
-    
     if request.method == "POST":
-        for key in request.form:
-            if key != "action":
-                c.execute("""
-                    INSERT OR REPLACE INTO settings (key, value, updated_by, updated_at)
-                    VALUES (?, ?, ?, ?)
-                """, (key, request.form.get(key), session['user_id'], datetime.datetime.now().isoformat()))
-        conn.commit()
+        storage.set_settings({key: request.form.get(key) for key in request.form if key != "action"},
+                             session['user_id'])
+        # Company name/address/phone are baked into every rendered invoice
+        invoice_cache.clear()
         flash("Settings updated successfully", "success")
         log_activity(session['user_id'], "UPDATE_SETTINGS", "Updated system settings")
     
-    c.execute("SELECT * FROM settings")
-    settings_dict = {row['key']: row['value'] for row in c.fetchall()}
-    conn.close()
+    settings_dict = storage.get_settings()
     
     content = f"""
     <form method="post">
@@ -2123,6 +6266,13 @@ def settings():
                     <label class="form-label">Currency</label>
                     <input type="text" name="currency" class="form-control" value="{settings_dict.get('currency', 'PKR')}">
                 </div>
+                <div class="form-group">
+                    <label class="form-label">When Stock Runs Short</label>
+                    <select name="stock_policy" class="form-control">
+                        <option value="reject" {'selected' if settings_dict.get('stock_policy', 'reject') == 'reject' else ''}>Reject the invoice</option>
+                        <option value="backorder" {'selected' if settings_dict.get('stock_policy') == 'backorder' else ''}>Sell available, back-order the rest</option>
+                    </select>
+                </div>
             </div>
         </div>
         
@@ -2134,33 +6284,146 @@ def settings():
     
     return render_page("Settings - Smart Invoice Pro", "System Settings", content, "settings")
 
-# ===================== PDF GENERATION =====================
-@app.route("/invoice/<int:id>/print")
-@login_required
-def print_invoice(id):
-    conn = get_db()
-    c = conn.cursor()
+# ===================== DATA EXPORT =====================
+EXPORT_FETCH_SIZE = 1000
+
+# dataset -> (query with a {where} slot, date column used for from/to filters)
+EXPORT_QUERIES = {
+    "invoices": ("""
+        SELECT inv_no, date, customer_name, customer_phone, salesman_name, subtotal, tax_rate,
+               tax_amount, discount, total, paid, balance, status, payment_method, notes
+        FROM invoices {where}
+        ORDER BY date, id
+    """, "date"),
+    "items": ("""
+        SELECT i.inv_no, i.date, i.customer_name, it.product_name, it.qty, it.unit_price, it.total
+        FROM invoice_items it
+        JOIN invoices i ON i.id = it.invoice_id {where}
+        ORDER BY i.date, it.id
+    """, "i.date"),
+    "ledger": ("""
+        SELECT t.date, c.name as customer, i.inv_no, t.type, t.amount, t.balance, t.description
+        FROM transactions t
+        LEFT JOIN customers c ON t.customer_id = c.id
+        LEFT JOIN invoices i ON t.invoice_id = i.id {where}
+        ORDER BY t.date, t.id
+    """, "t.date"),
+    "expenses": ("""
+        SELECT date, category, amount, description
+        FROM expenses {where}
+        ORDER BY date, id
+    """, "date"),
+}
+
+def export_cursor(dataset, args, last_write=None):
+    """Open a cursor over an export query, filtered by ?from=, ?to= and (ledger) ?customer_id=."""
+    sql, date_column = EXPORT_QUERIES[dataset]
+    clauses, params = [], []
+    if args.get('from'):
+        clauses.append(f"{date_column} >= ?")
+        params.append(args['from'])
+    if args.get('to'):
+        clauses.append(f"{date_column} <= ?")
+        params.append(args['to'])
+    if dataset == 'ledger' and args.get('customer_id'):
+        clauses.append("t.customer_id = ?")
+        params.append(args['customer_id'])
+    where = "WHERE " + " AND ".join(clauses) if clauses else ""
     
-    c.execute("""
-        SELECT i.*, c.name as customer_name, c.phone as customer_phone, c.address as customer_address
-        FROM invoices i 
-        LEFT JOIN customers c ON i.customer_id = c.id 
-        WHERE i.id = ?
-    """, (id,))
-    invoice = c.fetchone()
+    conn = get_read_db(last_write)
+    c = conn.cursor()
+    c.execute(sql.format(where=where), params)
+    return conn, c
+
+def iter_export_csv(conn, c):
+    """Yield CSV text a batch of rows at a time straight off the cursor."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    try:
+        writer.writerow([col[0] for col in c.description])
+        while True:
+            rows = c.fetchmany(EXPORT_FETCH_SIZE)
+            if not rows:
+                break
+            writer.writerows(rows)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+    finally:
+        conn.close()
+
+def write_export_xlsx(conn, c, path, title):
+    """Write the cursor to an XLSX file using openpyxl's write-only (streaming) mode."""
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(title)
+    try:
+        sheet.append([col[0] for col in c.description])
+        while True:
+            rows = c.fetchmany(EXPORT_FETCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                sheet.append(tuple(row))
+        workbook.save(path)
+    finally:
+        conn.close()
+
+@app.route("/export/<dataset>.<fmt>")
+@login_required
+def export_data(dataset, fmt):
+    if dataset not in EXPORT_QUERIES or fmt not in ('csv', 'xlsx'):
+        abort(404)
     
-    c.execute("SELECT * FROM invoice_items WHERE invoice_id = ?", (id,))
-    items = c.fetchall()
+    log_activity(session['user_id'], "EXPORT", f"Exported {dataset} as {fmt}")
     
-    conn.close()
+    if fmt == 'csv':
+        stamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        conn, c = export_cursor(dataset, request.args)
+        return Response(stream_with_context(iter_export_csv(conn, c)), mimetype="text/csv",
+                        headers={"Content-Disposition": f"attachment; filename={dataset}_{stamp}.csv"})
     
+    # XLSX is a zip and cannot be emitted before it is complete, so it is
+    # built in the job queue and downloaded from there
+    args = {key: request.args[key] for key in ('from', 'to', 'customer_id') if request.args.get(key)}
+    # The job has no session: carry the user's last save so it does not read an older snapshot
+    job_id = enqueue_job("export_xlsx", {"dataset": dataset, "args": args,
+                                         "last_write": session.get('last_write', 0)},
+                         priority=JOB_PRIORITY_HIGH)
+    return job_wait_page(job_id, f"Exporting {dataset.title()}", active_menu="reports")
+
+# ===================== PDF GENERATION =====================
+@app.route("/invoice/<int:id>/print")
+@login_required
+def print_invoice(id):
+    # A cached PDF goes out at once; otherwise it is rendered in the job queue
+    cached = invoice_cache.get("pdf", id, None)
+    if cached is None:
+        conn = get_db()
+        exists = conn.execute("SELECT 1 FROM invoices WHERE id = ?", (id,)).fetchone()
+        conn.close()
+        if not exists:
+            abort(404)
+        job_id = enqueue_job("invoice_pdf", {"invoice_id": id}, priority=JOB_PRIORITY_HIGH, dedupe=True)
+        return job_wait_page(job_id, "Preparing invoice PDF", url_for('print_invoice', id=id))
+    inv_no, pdf = cached
+    return send_file(io.BytesIO(pdf), mimetype="application/pdf", as_attachment=True,
+                     download_name=f"invoice_{inv_no}.pdf")
+
+def render_invoice_pdf(id):
+    """The invoice PDF as (version, inv_no, bytes) for the cache."""
+    invoice, items = load_invoice(id)
     if not invoice:
-        abort(404)
+        return None
     
-    filename = f"invoice_{invoice['inv_no']}.pdf"
-    filepath = EXPORT_DIR / filename
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.units import mm
     
-    c = canvas.Canvas(str(filepath), pagesize=A4)
+    render_started = time.perf_counter()
+    buffer = io.BytesIO()
+    c = canvas.Canvas(buffer, pagesize=A4)
     width, height = A4
     
     # Header
@@ -2237,11 +6500,725 @@ def print_invoice(id):
     c.drawRightString(width-25*mm, y, f"{invoice['total']:.2f}")
     
     c.save()
+    PDF_RENDER_SECONDS.observe(time.perf_counter() - render_started)
+    
+    return invoice['version'], invoice['inv_no'], buffer.getvalue()
+
+# ===================== BACKGROUND JOBS =====================
+# Slow work (PDFs, XLSX exports, backups, restores) runs outside the request:
+# routes enqueue a job in the jobs table and return at once. Workers claim
+# jobs highest priority first; a failure is retried with exponential backoff
+# until max_attempts. A running job's heartbeat is refreshed every
+# JOB_HEARTBEAT_SECONDS, and one whose worker died (no heartbeat for
+# JOB_LEASE_SECONDS) is re-queued. Each web process runs JOB_WORKER_THREADS
+# worker threads; set it to 0 to leave the queue to `flask jobs-worker` processes.
+JOB_WORKER_THREADS = int(os.environ.get("JOB_WORKER_THREADS", 1))
+JOB_POLL_SECONDS = 1.0
+JOB_HEARTBEAT_SECONDS = 30
+JOB_LEASE_SECONDS = 120
+JOB_RETRY_SECONDS = 5  # first retry delay, doubled on every further attempt
+JOB_FILE_RETENTION = 24 * 3600  # seconds export files stay downloadable
+JOB_PRIORITY_HIGH = 10  # someone is waiting on the result
+EXPORT_JOBS_DIR = EXPORT_DIR / "jobs"
+RESTORE_UPLOADS_DIR = BACKUP_DIR / "incoming"
+
+JOB_HANDLERS = {}
+_job_wakeup = threading.Event()
+_job_workers_started = False
+_job_workers_lock = threading.Lock()
+
+def job_handler(kind):
+    """Register handler(job) for a job kind; it returns a JSON-able result."""
+    def register(f):
+        JOB_HANDLERS[kind] = f
+        return f
+    return register
+
+def _utcnow(offset=0):
+    return (datetime.datetime.utcnow() + datetime.timedelta(seconds=offset)).isoformat(timespec="seconds")
+
+def enqueue_job(kind, payload, priority=0, max_attempts=3, dedupe=False):
+    """Queue a job for the current branch and user; returns its id. With
+    dedupe, an identical job that is still queued or running is reused."""
+    payload_json = json.dumps(payload, sort_keys=True)
+    branch = current_branch()
+    user_id = session.get('user_id') if has_request_context() else None
+    conn = get_main_db()
+    c = conn.cursor()
+    c.execute("BEGIN IMMEDIATE")
+    row = None
+    if dedupe:
+        c.execute("""
+            SELECT id FROM jobs
+            WHERE kind = ? AND branch = ? AND payload = ? AND status IN ('queued', 'running')
+        """, (kind, branch, payload_json))
+        row = c.fetchone()
+    if row:
+        job_id = row['id']
+    else:
+        c.execute("""
+            INSERT INTO jobs (kind, branch, payload, priority, max_attempts, run_after, created_by)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (kind, branch, payload_json, priority, max_attempts, _utcnow(), user_id))
+        job_id = c.lastrowid
+        JOBS_TOTAL.inc((kind, "queued"))
+    conn.commit()
+    conn.close()
+    _job_wakeup.set()
+    return job_id
+
+def claim_job(worker_id):
+    """Take the most urgent due job and mark it running; None if there is none."""
+    now = _utcnow()
+    conn = get_main_db()
+    c = conn.cursor()
+    c.execute("BEGIN IMMEDIATE")
+    # Jobs whose worker died mid-run go back to the queue (or fail for good)
+    c.execute("""
+        UPDATE jobs SET locked_by = NULL, error = 'worker lost',
+            status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'queued' END
+        WHERE status = 'running' AND COALESCE(heartbeat_at, started_at) < ?
+    """, (_utcnow(-JOB_LEASE_SECONDS),))
+    c.execute("""
+        SELECT * FROM jobs WHERE status = 'queued' AND run_after <= ?
+        ORDER BY priority DESC, id LIMIT 1
+    """, (now,))
+    job = c.fetchone()
+    if job:
+        c.execute("""
+            UPDATE jobs SET status = 'running', attempts = attempts + 1, started_at = ?, heartbeat_at = ?,
+                locked_by = ?
+            WHERE id = ?
+        """, (now, now, worker_id, job['id']))
+    conn.commit()
+    conn.close()
+    if not job:
+        return None
+    job = dict(job)
+    job['attempts'] += 1
+    job['locked_by'] = worker_id
+    job['payload'] = json.loads(job['payload'])
+    return job
+
+def _job_heartbeat(job, stop):
+    """Keep a running job's lease while its handler works (backups and big
+    exports can take longer than JOB_LEASE_SECONDS)."""
+    while not stop.wait(JOB_HEARTBEAT_SECONDS):
+        try:
+            conn = get_main_db()
+            conn.execute("UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND locked_by = ? AND status = 'running'",
+                         (_utcnow(), job['id'], job['locked_by']))
+            conn.commit()
+            conn.close()
+        except sqlite3.OperationalError as e:
+            print(f"⚠️  Job #{job['id']} heartbeat: {e}")
+
+def run_job(job):
+    """Run a claimed job in its branch and record the outcome."""
+    started = time.perf_counter()
+    _branch_context.branch = job['branch']
+    handler = JOB_HANDLERS.get(job['kind'])
+    stop_heartbeat = threading.Event()
+    threading.Thread(target=_job_heartbeat, args=(job, stop_heartbeat),
+                     name=f"job-{job['id']}-heartbeat", daemon=True).start()
+    try:
+        if handler is None:
+            raise ValueError(f"No handler for job kind '{job['kind']}'")
+        result = handler(job)
+    except Exception as e:
+        retry = handler is not None and job['attempts'] < job['max_attempts']
+        status = "queued" if retry else "failed"
+        update = ("UPDATE jobs SET status = ?, error = ?, run_after = ?, locked_by = NULL, finished_at = ? "
+                  "WHERE id = ?",
+                  (status, f"{type(e).__name__}: {e}",
+                   _utcnow(JOB_RETRY_SECONDS * 2 ** (job['attempts'] - 1)),
+                   None if retry else _utcnow(), job['id']))
+        print(f"⚠️  Job #{job['id']} ({job['kind']}) attempt {job['attempts']} failed: {e}")
+    else:
+        status = "done"
+        update = ("UPDATE jobs SET status = 'done', result = ?, error = NULL, locked_by = NULL, finished_at = ? "
+                  "WHERE id = ?", (json.dumps(result), _utcnow(), job['id']))
+    finally:
+        stop_heartbeat.set()
+        _branch_context.branch = None
+    conn = get_main_db()
+    conn.execute(*update)
+    conn.commit()
+    conn.close()
+    JOBS_TOTAL.inc((job['kind'], status if status != "queued" else "retried"))
+    JOB_SECONDS.observe(time.perf_counter() - started, (job['kind'],))
+    return status
+
+def work_jobs(worker_id, once=False):
+    """Worker loop; with once=True, stop when no job is due."""
+    while True:
+        try:
+            job = claim_job(worker_id)
+        except sqlite3.OperationalError as e:
+            print(f"⚠️  Job worker {worker_id}: {e}")
+            job = None
+        if job:
+            run_job(job)
+            continue
+        if once:
+            return
+        _job_wakeup.wait(JOB_POLL_SECONDS)
+        _job_wakeup.clear()
+
+@app.before_request
+def start_job_workers():
+    # Only web processes get in-process workers; CLI tools never start them
+    global _job_workers_started
+    if _job_workers_started or not JOB_WORKER_THREADS:
+        return
+    with _job_workers_lock:
+        if _job_workers_started:
+            return
+        for n in range(JOB_WORKER_THREADS):
+            threading.Thread(target=work_jobs, args=(f"{socket.gethostname()}:{os.getpid()}:{n}",),
+                             name=f"job-worker-{n}", daemon=True).start()
+        _job_workers_started = True
+
+@app.cli.command("jobs-worker")
+@click.option("--once", is_flag=True, help="Run the jobs that are due, then exit.")
+def jobs_worker_command(once):
+    """Process background jobs (run as many of these as you like)."""
+    create_app()
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    print(f"👷 Job worker {worker_id} started")
+    work_jobs(worker_id, once=once)
+
+# ---- Handlers ----
+def copy_database(source, target):
+    """Copy through SQLite's backup API: consistent while the source is being
+    written, and safe to aim at a live database (it takes SQLite's locks)."""
+    src = sqlite3.connect(source, timeout=DB_TIMEOUT)
+    dst = sqlite3.connect(target, timeout=DB_TIMEOUT)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+
+def _backup_label(branch):
+    return "" if branch == MAIN_BRANCH else f"{branch}_"
+
+# Head office tables that describe the running installation, not the books:
+# backups leave them out and a restore keeps the live rows, so restoring
+# neither loses queued jobs nor brings back old jobs and sessions
+LIVE_TABLES = ("jobs", "user_sessions")
+
+def _strip_live_tables(db_file):
+    conn = sqlite3.connect(db_file, timeout=DB_TIMEOUT)
+    try:
+        for table in LIVE_TABLES:
+            conn.execute(f"DELETE FROM {table}")
+        conn.commit()
+    finally:
+        conn.close()
+
+def _carry_live_tables(live_file, restored_file):
+    """Replace the LIVE_TABLES rows in restored_file with live_file's (both at SCHEMA_VERSION)."""
+    live = sqlite3.connect(live_file, timeout=DB_TIMEOUT)
+    restored = sqlite3.connect(restored_file, timeout=DB_TIMEOUT)
+    try:
+        for table in LIVE_TABLES:
+            cur = live.execute(f"SELECT * FROM {table}")
+            columns = [d[0] for d in cur.description]
+            restored.execute(f"DELETE FROM {table}")
+            restored.executemany(f"INSERT INTO {table} ({', '.join(columns)}) "
+                                 f"VALUES ({', '.join('?' * len(columns))})", cur.fetchall())
+        restored.commit()
+    finally:
+        restored.close()
+        live.close()
+
+@job_handler("invoice_pdf")
+def invoice_pdf_job(job):
+    cached = invoice_cache.get("pdf", job['payload']['invoice_id'], render_invoice_pdf)
+    if cached is None:
+        raise LookupError("invoice no longer exists")
+    return {"inv_no": cached[0], "bytes": len(cached[1])}
+
+@job_handler("stock_snapshots")
+def stock_snapshots_job(job):
+    return {"taken": ensure_stock_snapshots()}
+
+@job_handler("export_xlsx")
+def export_xlsx_job(job):
+    dataset = job['payload']['dataset']
+    EXPORT_JOBS_DIR.mkdir(parents=True, exist_ok=True)
+    cutoff = time.time() - JOB_FILE_RETENTION
+    for old in EXPORT_JOBS_DIR.glob("*.xlsx"):
+        if old.stat().st_mtime < cutoff:
+            old.unlink(missing_ok=True)
+    path = EXPORT_JOBS_DIR / f"job_{job['id']}.xlsx"
+    conn, c = export_cursor(dataset, job['payload']['args'], job['payload'].get('last_write', 0))
+    write_export_xlsx(conn, c, path, dataset.title())
+    stamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    return {"file": path.name, "download_name": f"{dataset}_{stamp}.xlsx"}
+
+@job_handler("backup")
+def backup_job(job):
+    branch = current_branch()
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    backup_file = BACKUP_DIR / f"backup_{_backup_label(branch)}{timestamp}.db"
+    copy_database(branch_db_file(branch), backup_file)
+    if branch == MAIN_BRANCH:
+        _strip_live_tables(backup_file)
+    log_activity(job['created_by'], "BACKUP", f"Created backup {backup_file.name}")
+    return {"file": backup_file.name}
+
+@job_handler("restore")
+def restore_job(job):
+    branch = current_branch()
+    db_file = branch_db_file(branch)
+    upload = RESTORE_UPLOADS_DIR / Path(job['payload']['file']).name
+    try:
+        conn = sqlite3.connect(upload)
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+        conn.close()
+        # A head office backup carries the users table; in a branch
+        # database it would hide the real one
+        if ("users" in tables) != (branch == MAIN_BRANCH):
+            raise ValueError("Invalid backup file: it belongs to another branch")
+        
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        current_backup = BACKUP_DIR / f"before_restore_{_backup_label(branch)}{timestamp}.db"
+        copy_database(db_file, current_backup)
+        # An older backup may predate the current schema
+        migrate_db(upload, shared=branch == MAIN_BRANCH)
+        if branch == MAIN_BRANCH:
+            _carry_live_tables(db_file, upload)
+        copy_database(upload, db_file)
+    finally:
+        upload.unlink(missing_ok=True)
+    if branch == MAIN_BRANCH:
+        bump_stamp("auth")
+    invoice_cache.clear()
+    refresh_read_snapshot(force=True, branch=branch)
+    log_activity(job['created_by'], "RESTORE", "Database restored from backup")
+    return {"safety_backup": current_backup.name}
+
+# ---- Status API and downloads ----
+def _job_for_user(id):
+    """The job row if the logged-in user may see it (their own, or any for admins)."""
+    conn = get_main_db()
+    job = conn.execute("SELECT * FROM jobs WHERE id = ?", (id,)).fetchone()
+    conn.close()
+    if not job or (session.get('role') != 'admin' and job['created_by'] != session.get('user_id')):
+        return None
+    return job
+
+def job_download_url(job):
+    if job['status'] != 'done':
+        return None
+    if job['kind'] == 'invoice_pdf':
+        return url_for('print_invoice', id=json.loads(job['payload'])['invoice_id'])
+    if job['kind'] in ('export_xlsx', 'backup'):
+        return url_for('download_job_result', id=job['id'])
+    return None
+
+def job_json(job):
+    return {
+        "id": job['id'],
+        "kind": job['kind'],
+        "status": job['status'],
+        "priority": job['priority'],
+        "attempts": job['attempts'],
+        "max_attempts": job['max_attempts'],
+        "error": job['error'],
+        "result": json.loads(job['result']) if job['result'] else None,
+        "created_at": job['created_at'],
+        "started_at": job['started_at'],
+        "finished_at": job['finished_at'],
+        "download_url": job_download_url(job),
+    }
+
+@app.route("/api/jobs")
+@api_login_required
+def api_jobs():
+    """The user's recent jobs, newest first (?status= to filter)."""
+    clauses, params = [], []
+    if session.get('role') != 'admin':
+        clauses.append("created_by = ?")
+        params.append(session['user_id'])
+    if request.args.get('status'):
+        clauses.append("status = ?")
+        params.append(request.args['status'])
+    where = "WHERE " + " AND ".join(clauses) if clauses else ""
+    conn = get_main_db()
+    jobs = conn.execute(f"SELECT * FROM jobs {where} ORDER BY id DESC LIMIT 50", params).fetchall()
+    conn.close()
+    return jsonify({"jobs": [job_json(job) for job in jobs]})
+
+@app.route("/api/jobs/<int:id>")
+@api_login_required
+def api_job(id):
+    job = _job_for_user(id)
+    if not job:
+        return jsonify({"success": False, "error": "Job not found"}), 404
+    return jsonify(job_json(job))
+
+@app.route("/jobs/<int:id>/download")
+@login_required
+def download_job_result(id):
+    job = _job_for_user(id)
+    if not job or job['status'] != 'done' or job['kind'] not in ('export_xlsx', 'backup'):
+        abort(404)
+    result = json.loads(job['result'])
+    if job['kind'] == 'backup':
+        if session.get('role') != 'admin':
+            abort(404)
+        return send_file(BACKUP_DIR / Path(result['file']).name, as_attachment=True)
+    path = EXPORT_JOBS_DIR / Path(result['file']).name
+    if not path.exists():
+        abort(404)
+    return send_file(path, as_attachment=True, download_name=result['download_name'],
+                     mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+
+def job_wait_page(job_id, title, done_url=None, active_menu="invoices"):
+    """Page that polls the job and goes to done_url (or its download) when it finishes."""
+    content = f"""
+    <div class="card" style="max-width: 520px; margin: 2rem auto; text-align: center;">
+        <h3 style="margin-bottom: 1rem;"><i class="fas fa-spinner fa-spin" id="job-icon"></i> {title}</h3>
+        <p id="job-status" style="color: var(--text-muted);">Queued (job #{job_id})</p>
+    </div>
+    <script>
+    (function poll() {{
+        fetch("{url_for('api_job', id=job_id)}", {{credentials: "same-origin"}})
+            .then(r => r.json())
+            .then(job => {{
+                const status = document.getElementById("job-status");
+                if (job.status === "done") {{
+                    status.textContent = "Done";
+                    window.location = {json.dumps(done_url)} || job.download_url;
+                }} else if (job.status === "failed" || job.error && job.status !== "running") {{
+                    document.getElementById("job-icon").className = "fas fa-exclamation-circle";
+                    status.textContent = (job.status === "failed" ? "Failed: " : "Retrying after: ") + job.error;
+                    if (job.status !== "failed") setTimeout(poll, 2000);
+                }} else {{
+                    status.textContent = job.status === "running" ? "Working..." : "Queued (job #{job_id})";
+                    setTimeout(poll, 1000);
+                }}
+            }})
+            .catch(() => setTimeout(poll, 2000));
+    }})();
+    </script>
+    """
+    return render_page(f"{title} - Smart Invoice Pro", title, content, active_menu)
+
+# ===================== LEGACY CSV MIGRATION =====================
+MIGRATION_BATCH_SIZE = 10000
+
+def parse_legacy_date(value):
+    """Legacy files store dd-mm-yy; accept ISO and four-digit years too."""
+    value = (value or "").strip()
+    if not value:
+        return None
+    for fmt in ("%d-%m-%y", "%d-%m-%Y", "%Y-%m-%d", "%d/%m/%y", "%d/%m/%Y"):
+        try:
+            return datetime.datetime.strptime(value, fmt).date().isoformat()
+        except ValueError:
+            continue
+    raise ValueError(f"Unrecognised date {value!r}")
+
+def parse_legacy_number(value):
+    value = (value or "").replace(",", "").strip()
+    return float(value) if value else 0.0
+
+def _migrate_customers(c, rows):
+    c.executemany("INSERT OR IGNORE INTO customers (name, address, phone) VALUES (?, ?, ?)",
+                  [(r['name'].strip(), r.get('address', ''), r.get('phone', '')) for r in rows])
+
+def _migrate_products(c, rows):
+    c.executemany("""
+        INSERT INTO products (name, unit_price, purchase_price, stock, min_stock)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(name) DO UPDATE SET
+            unit_price = excluded.unit_price,
+            purchase_price = excluded.purchase_price,
+            min_stock = excluded.min_stock
+    """, [(r['name'].strip(), parse_legacy_number(r.get('unit_price')),
+           parse_legacy_number(r.get('purchase_price')), parse_legacy_number(r.get('stock')),
+           parse_legacy_number(r.get('min_stock'))) for r in rows])
+    # Legacy stock is already net of legacy sales, so it becomes the opening balance
+    c.execute(OPENING_STOCK_SQL)
+
+def _migrate_invoices(c, rows):
+    params = []
+    for r in rows:
+        date = parse_legacy_date(r.get('date'))
+        total = parse_legacy_number(r.get('total'))
+        tax_rate = parse_legacy_number(r.get('tax'))
+        subtotal = total / (1 + tax_rate / 100) if tax_rate else total
+        params.append((r['inv_no'].strip(), date, r.get('name', '').strip(), r.get('phone', ''),
+                       r.get('name', ''), r.get('address', ''), r.get('phone', ''),
+                       subtotal, tax_rate, total - subtotal, total, total, r.get('remarks') or None,
+                       date))
+    
+    c.executemany("INSERT OR IGNORE INTO customers (name, address, phone) SELECT ?, ?, ? WHERE ? != ''",
+                  [(p[4].strip(), p[5], p[6], p[4].strip()) for p in params])
+    c.executemany("""
+        INSERT OR IGNORE INTO invoices
+        (inv_no, date, customer_id, customer_name, customer_address, customer_phone,
+         subtotal, tax_rate, tax_amount, total, balance, notes, created_at, source)
+        VALUES (?, ?, (SELECT id FROM customers WHERE name = ? AND phone = ?),
+                ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'legacy')
+    """, params)
+    c.executemany("""
+        INSERT INTO transactions (date, customer_id, invoice_id, type, amount, balance, description)
+        SELECT date, customer_id, id, 'invoice', total, total, 'Invoice #' || inv_no
+        FROM invoices i
+        WHERE inv_no = ? AND customer_id IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM transactions t WHERE t.invoice_id = i.id AND t.type = 'invoice')
+    """, [(p[0],) for p in params])
+
+def _migrate_invoice_lines(c, rows):
+    for inv_no in {r['inv_no'].strip() for r in rows}:
+        c.execute("SELECT 1 FROM invoices WHERE inv_no = ?", (inv_no,))
+        if not c.fetchone():
+            raise ValueError(f"Unknown invoice {inv_no!r}")
+    params = []
+    for r in rows:
+        qty = parse_legacy_number(r.get('qty'))
+        price = parse_legacy_number(r.get('unit_price'))
+        params.append((r['inv_no'].strip(), r['product'].strip(), r['product'].strip(),
+                       qty, price, qty * price))
+    c.executemany("""
+        INSERT INTO invoice_items (invoice_id, product_id, product_name, qty, unit_price, total)
+        SELECT (SELECT id FROM invoices WHERE inv_no = ?),
+               (SELECT id FROM products WHERE name = ?), ?, ?, ?, ?
+    """, params)
+
+def _migrate_payments(c, rows):
+    # A payment nobody can see (no invoice, no customer) is a rejected row
+    for inv_no, customer in {((r.get('inv_no') or '').strip(), (r.get('customer') or '').strip()) for r in rows}:
+        if inv_no:
+            c.execute("SELECT 1 FROM invoices WHERE inv_no = ?", (inv_no,))
+            if not c.fetchone():
+                raise ValueError(f"Unknown invoice {inv_no!r}")
+        else:
+            c.execute("SELECT 1 FROM customers WHERE name = ?", (customer,))
+            if not c.fetchone():
+                raise ValueError(f"Unknown customer {customer!r}")
+    params = []
+    for r in rows:
+        inv_no = (r.get('inv_no') or '').strip()
+        description = f"Payment #{r.get('pay_id', '').strip()} ({r.get('method') or 'Cash'})"
+        if r.get('note'):
+            description += f" - {r['note']}"
+        params.append((parse_legacy_date(r.get('date')), inv_no, (r.get('customer') or '').strip(),
+                       inv_no, parse_legacy_number(r.get('amount')), description))
+    c.executemany("""
+        INSERT INTO transactions (date, customer_id, invoice_id, type, amount, balance, description)
+        VALUES (?, COALESCE((SELECT customer_id FROM invoices WHERE inv_no = ?),
+                            (SELECT id FROM customers WHERE name = ? LIMIT 1)),
+                (SELECT id FROM invoices WHERE inv_no = ?), 'payment', ?, 0, ?)
+    """, params)
+
+def _migrate_expenses(c, rows):
+    c.executemany("INSERT INTO expenses (date, category, amount, description) VALUES (?, ?, ?, ?)",
+                  [(parse_legacy_date(r.get('date')), 'General', parse_legacy_number(r.get('amount')),
+                    r.get('description')) for r in rows])
+
+def _migrate_other_expenses(c, rows):
+    c.executemany("INSERT INTO expenses (date, category, amount, description) VALUES (?, ?, ?, ?)",
+                  [(parse_legacy_date(r.get('date')), (r.get('name') or 'Other').strip(),
+                    parse_legacy_number(r.get('amount')), r.get('description')) for r in rows])
+
+def parse_legacy_month(value):
+    value = (value or "").strip()
+    for fmt in ("%Y-%m", "%m-%y", "%m-%Y", "%b-%y", "%b-%Y", "%B %Y", "%Y-%m-%d", "%d-%m-%y"):
+        try:
+            return datetime.datetime.strptime(value, fmt).strftime("%Y-%m")
+        except ValueError:
+            continue
+    raise ValueError(f"Unrecognised month {value!r}")
+
+def _migrate_targets(c, rows):
+    params = [(parse_legacy_month(r.get('month')), (r.get('product') or '').strip(), parse_legacy_number(r.get('qty')))
+              for r in rows]
+    for month, product, qty in params:
+        if not product:
+            raise ValueError("Missing product")
+        c.execute("SELECT id FROM products WHERE name = ?", (product,))
+        if not c.fetchone():
+            raise ValueError(f"Unknown product {product!r}")
+    c.executemany("""
+        INSERT INTO sales_targets (month, product_id, qty)
+        SELECT ?, id, ? FROM products WHERE name = ?
+        ON CONFLICT(month, product_id) DO UPDATE SET qty = excluded.qty
+    """, [(month, qty, product) for month, product, qty in params])
+
+# Order matters: invoices need customers, lines need invoices and products
+LEGACY_SOURCES = [
+    ("customers.csv", _migrate_customers),
+    ("products.csv", _migrate_products),
+    ("invoices.csv", _migrate_invoices),
+    ("invoice_lines.csv", _migrate_invoice_lines),
+    ("payments.csv", _migrate_payments),
+    ("expenses.csv", _migrate_expenses),
+    ("other_expenses.csv", _migrate_other_expenses),
+    ("targets.csv", _migrate_targets),
+]
+
+def _migrate_batch(c, handler, rows, lines, errors):
+    """Apply a batch; if it fails, retry row by row so one bad row is reported, not fatal."""
+    c.execute("SAVEPOINT batch")
+    try:
+        handler(c, rows)
+        c.execute("RELEASE batch")
+        return
+    except (ValueError, KeyError, AttributeError, sqlite3.IntegrityError):
+        c.execute("ROLLBACK TO batch")
+        c.execute("RELEASE batch")
+    
+    for line, row in zip(lines, rows):
+        c.execute("SAVEPOINT row")
+        try:
+            handler(c, [row])
+            c.execute("RELEASE row")
+        except (ValueError, KeyError, AttributeError, sqlite3.IntegrityError) as e:
+            c.execute("ROLLBACK TO row")
+            c.execute("RELEASE row")
+            errors.append({"row": line, "error": str(e) or type(e).__name__})
+
+def _record_migration_errors(c, source, errors):
+    c.executemany("INSERT OR REPLACE INTO migration_errors (source, line, error) VALUES (?, ?, ?)",
+                  [(source, e['row'], e['error']) for e in errors])
+
+def reconcile_legacy_balances(c):
+    """Recompute paid/balance/status of legacy invoices from their payments,
+    then the running ledger balances and customer balances."""
+    c.execute("""
+        UPDATE invoices SET paid = COALESCE((
+            SELECT SUM(amount) FROM transactions t
+            WHERE t.invoice_id = invoices.id AND t.type = 'payment'
+        ), 0)
+        WHERE source = 'legacy'
+    """)
+    c.execute("""
+        UPDATE invoices SET
+            balance = total - paid,
+            status = CASE WHEN total - paid <= 0 THEN 'paid'
+                          WHEN paid > 0 THEN 'partial' ELSE 'pending' END
+        WHERE source = 'legacy'
+    """)
+    c.execute("""
+        UPDATE transactions SET balance = (
+            SELECT i.total - COALESCE(SUM(p.amount), 0)
+            FROM invoices i
+            LEFT JOIN transactions p ON p.invoice_id = i.id AND p.type = 'payment'
+                                    AND p.id <= transactions.id
+            WHERE i.id = transactions.invoice_id
+        )
+        WHERE type = 'payment'
+          AND invoice_id IN (SELECT id FROM invoices WHERE source = 'legacy')
+    """)
+    c.execute("""
+        UPDATE customers SET balance = (
+            SELECT COALESCE(SUM(balance), 0) FROM invoices WHERE customer_id = customers.id
+        )
+        WHERE id IN (SELECT customer_id FROM invoices WHERE source = 'legacy')
+    """)
+
+def migrate_legacy_csv(data_dir=BASE_DATA, batch_size=MIGRATION_BATCH_SIZE, progress=None):
+    """Load the legacy data/*.csv files into the database.
+    
+    Files are streamed in batches; each batch commits together with its
+    checkpoint, so an interrupted run resumes where it stopped and a rerun
+    only picks up rows appended since, plus rows that failed last time (kept
+    in migration_errors). Returns per-file row counts and errors.
+    """
+    data_dir = Path(data_dir)
+    report = {}
+    conn = get_db()
+    c = conn.cursor()
+    
+    for filename, handler in LEGACY_SOURCES:
+        path = data_dir / filename
+        if not path.exists():
+            continue
+        
+        c.execute("SELECT rows_done FROM migration_checkpoints WHERE source = ?", (filename,))
+        row = c.fetchone()
+        done = row['rows_done'] if row else 0
+        c.execute("SELECT line FROM migration_errors WHERE source = ?", (filename,))
+        failed = {row['line'] for row in c.fetchall()}
+        stats = report[filename] = {"migrated": 0, "skipped": done - len(failed), "errors": []}
+        
+        with open(path, newline="", encoding="utf-8-sig") as f:
+            reader = csv.DictReader(f)
+            # Line numbers count the header as line 1
+            retry = [(line, r) for line, r in enumerate(itertools.islice(reader, done), start=2) if line in failed]
+            if retry:
+                errors = []
+                c.execute("BEGIN IMMEDIATE")
+                _migrate_batch(c, handler, [r for _, r in retry], [line for line, _ in retry], errors)
+                c.executemany("DELETE FROM migration_errors WHERE source = ? AND line = ?",
+                              [(filename, line) for line, _ in retry])
+                _record_migration_errors(c, filename, errors)
+                conn.commit()
+                stats["migrated"] += len(retry) - len(errors)
+                stats["errors"] += errors
+            while True:
+                rows = list(itertools.islice(reader, batch_size))
+                if not rows:
+                    break
+                errors = []
+                c.execute("BEGIN IMMEDIATE")
+                _migrate_batch(c, handler, rows, range(done + 2, done + 2 + len(rows)), errors)
+                _record_migration_errors(c, filename, errors)
+                done += len(rows)
+                c.execute("""
+                    INSERT INTO migration_checkpoints (source, rows_done, updated_at)
+                    VALUES (?, ?, CURRENT_TIMESTAMP)
+                    ON CONFLICT(source) DO UPDATE SET
+                        rows_done = excluded.rows_done, updated_at = excluded.updated_at
+                """, (filename, done))
+                conn.commit()
+                stats["migrated"] += len(rows) - len(errors)
+                stats["errors"] += errors
+                if progress:
+                    progress(filename, done)
     
-    return send_file(filepath, as_attachment=True)
+    c.execute("BEGIN IMMEDIATE")
+    sequence_file = data_dir / "sequence.csv"
+    if sequence_file.exists():
+        with open(sequence_file, newline="", encoding="utf-8-sig") as f:
+            sequence = {r['key'].strip(): r['value'] for r in csv.DictReader(f)}
+        if sequence.get('invoice_no'):
+            c.execute("""
+                INSERT INTO sequences (key, value) VALUES ('invoice_no', ?)
+                ON CONFLICT(key) DO UPDATE SET value = MAX(value, excluded.value)
+            """, (int(parse_legacy_number(sequence['invoice_no'])),))
+    reconcile_legacy_balances(c)
+    rebuild_monthly_pnl(c)
+    rebuild_monthly_product_sales(c)
+    conn.commit()
+    conn.close()
+    bump_stamp("invoices")
+    return report
+
+@app.cli.command("migrate-csv")
+@click.option("--data-dir", default=str(BASE_DATA), show_default=True, help="Folder with the legacy CSV files.")
+@click.option("--batch-size", default=MIGRATION_BATCH_SIZE, show_default=True)
+def migrate_csv_command(data_dir, batch_size):
+    """Migrate the legacy CSV storage into the database (safe to rerun)."""
+    report = migrate_legacy_csv(data_dir, batch_size,
+                                progress=lambda name, done: click.echo(f"  {name}: {done} rows"))
+    for filename, stats in report.items():
+        click.echo(f"{filename}: {stats['migrated']} migrated, {stats['skipped']} already done, "
+                   f"{len(stats['errors'])} error(s)")
+        for error in stats["errors"][:20]:
+            click.echo(f"    line {error['row']}: {error['error']}")
 
 # ===================== MAIN ENTRY =====================
+_import_finished = time.perf_counter()
+
 if __name__ == "__main__":
     import webbrowser
+    create_app()
     webbrowser.open("http://127.0.0.1:5000")
     app.run(debug=True, port=5000, host="0.0.0.0")
\ No newline at end of file
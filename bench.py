@@ -0,0 +1,325 @@
+"""
+Benchmark suite for Smart Invoice.
+
+Fills a throw-away data folder with synthetic customers, products, invoices,
+line items and ledger transactions, then drives the main routes through the
+Flask test client and reports throughput and p50/p95/p99 latency per route.
+
+    python bench.py                          # 10k invoices
+    python bench.py --scale 10k --scale 100k --scale 1m
+    python bench.py --save-baseline          # write bench_baseline.json
+    python bench.py --baseline bench_baseline.json --tolerance 0.25
+
+Generated databases are kept under data/bench/<scale>/ and reused by later
+runs (the 1m one takes a while to build); pass --regenerate to rebuild.
+Each scale runs in its own process because the app binds its database path
+at import time. Exits with status 1 when a route regresses past the baseline.
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).parent
+BENCH_DIR = ROOT / "data" / "bench"
+DEFAULT_BASELINE = ROOT / "bench_baseline.json"
+
+SCALES = {"1k": 1_000, "10k": 10_000, "100k": 100_000, "1m": 1_000_000}
+ROUTES = ("dashboard", "invoices", "view_invoice", "ledger", "new_invoice", "print_invoice")
+
+CATEGORIES = ("Stationery", "Hardware", "Grocery", "Electrical", "Cosmetics", "Textile")
+PAYMENT_METHODS = ("cash", "bank", "credit")
+
+
+# ===================== DATA GENERATOR =====================
+def generate(db_file, invoices, seed=42, batch=20_000):
+    """Populate an initialised (empty) database with a reproducible data set."""
+    rng = random.Random(seed)
+    n_customers = max(50, invoices // 20)
+    n_products = max(100, min(5_000, invoices // 50))
+    start = datetime.date.today() - datetime.timedelta(days=3 * 365)
+
+    conn = sqlite3.connect(db_file)
+    c = conn.cursor()
+    c.execute("PRAGMA synchronous=OFF")
+    c.execute("BEGIN")
+
+    c.executemany("""
+        INSERT INTO customers (name, address, phone, credit_limit, balance)
+        VALUES (?, ?, ?, ?, 0)
+    """, ((f"Customer {i:06d}", f"Street {i % 300}, Block {i % 17}",
+           f"03{rng.randrange(10**9):09d}", rng.choice((0, 50_000, 100_000)))
+          for i in range(1, n_customers + 1)))
+
+    products = []
+    for i in range(1, n_products + 1):
+        cost = round(rng.uniform(5, 500), 2)
+        products.append((i, f"Product {i:05d}", round(cost * rng.uniform(1.1, 1.6), 2), cost))
+    # Effectively unlimited stock so new_invoice never trips the shortage policy
+    c.executemany("""
+        INSERT INTO products (id, name, unit_price, purchase_price, stock, min_stock, unit, category)
+        VALUES (?, ?, ?, ?, 1e9, 10, 'pcs', ?)
+    """, ((pid, name, price, cost, rng.choice(CATEGORIES)) for pid, name, price, cost in products))
+    c.execute("""
+        INSERT INTO stock_movements (product_id, date, type, qty, note)
+        SELECT id, ?, 'opening', stock, 'Benchmark opening balance' FROM products
+    """, (start.isoformat(),))
+
+    balances = [0.0] * (n_customers + 1)
+    inv_rows, item_rows, txn_rows = [], [], []
+    item_id = 0
+
+    def flush():
+        c.executemany("""
+            INSERT INTO invoices (id, inv_no, date, customer_id, customer_name, salesman_id, salesman_name,
+                                  subtotal, tax_rate, tax_amount, discount, total, paid, balance,
+                                  status, payment_method)
+            VALUES (?, ?, ?, ?, ?, 1, 'Administrator', ?, ?, ?, 0, ?, ?, ?, ?, ?)
+        """, inv_rows)
+        c.executemany("""
+            INSERT INTO invoice_items (id, invoice_id, product_id, product_name, qty, unit_price, total, unit_cost)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, item_rows)
+        c.executemany("""
+            INSERT INTO transactions (date, customer_id, invoice_id, type, amount, balance, description, created_by)
+            VALUES (?, ?, ?, ?, ?, ?, ?, 1)
+        """, txn_rows)
+        inv_rows.clear(); item_rows.clear(); txn_rows.clear()
+
+    for inv_id in range(1, invoices + 1):
+        # Dates increase with the id, like a real invoice book
+        date = (start + datetime.timedelta(days=inv_id * 3 * 365 // invoices)).isoformat()
+        customer_id = rng.randint(1, n_customers)
+        subtotal = 0.0
+        for _ in range(rng.randint(1, 5)):
+            pid, name, price, cost = products[rng.randrange(n_products)]
+            qty = rng.randint(1, 20)
+            item_id += 1
+            item_rows.append((item_id, inv_id, pid, name, qty, price, round(qty * price, 2), cost))
+            subtotal += qty * price
+        subtotal = round(subtotal, 2)
+        tax = round(subtotal * 0.17, 2)
+        total = round(subtotal + tax, 2)
+        paid = rng.choice((total, total, 0.0, round(total / 2, 2)))
+        status = "paid" if paid >= total else ("partial" if paid else "pending")
+        inv_no = f"BENCH-{inv_id:07d}"
+        inv_rows.append((inv_id, inv_no, date, customer_id, f"Customer {customer_id:06d}",
+                         subtotal, 17, tax, total, paid, round(total - paid, 2), status,
+                         rng.choice(PAYMENT_METHODS)))
+
+        balances[customer_id] += total - paid
+        txn_rows.append((date, customer_id, inv_id, 'invoice', total, round(balances[customer_id], 2),
+                         f"Invoice #{inv_no}"))
+        if paid:
+            txn_rows.append((date, customer_id, inv_id, 'payment', paid, round(balances[customer_id], 2),
+                             f"Payment for #{inv_no}"))
+        if len(inv_rows) >= batch:
+            flush()
+    flush()
+
+    c.executemany("UPDATE customers SET balance = ? WHERE id = ?",
+                  ((round(b, 2), cid) for cid, b in enumerate(balances) if cid))
+    conn.commit()
+    conn.close()
+    return {"customers": n_customers, "products": n_products, "invoices": invoices, "items": item_id}
+
+
+# ===================== BENCHMARK RUNNER =====================
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    k = (len(ordered) - 1) * pct / 100
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+def summarize(samples, wall):
+    return {
+        "requests": len(samples),
+        "throughput_rps": round(len(samples) / wall, 2) if wall else 0,
+        "p50_ms": round(percentile(samples, 50) * 1000, 2),
+        "p95_ms": round(percentile(samples, 95) * 1000, 2),
+        "p99_ms": round(percentile(samples, 99) * 1000, 2),
+        "mean_ms": round(statistics.fmean(samples) * 1000, 2),
+    }
+
+def run_scale(data_dir, invoices, requests_per_route, warmup, regenerate, seed):
+    """Runs inside the per-scale child process; returns the result dict."""
+    os.environ["SMART_INVOICE_DATA"] = str(data_dir)
+    # No background job workers: PDFs are rendered below, inside the timed
+    # print_invoice call, instead of competing with the other routes' timings
+    os.environ["JOB_WORKER_THREADS"] = "0"
+    db_file = data_dir / "db" / "business.db"
+    marker = data_dir / "generated.json"
+    if regenerate and data_dir.exists():
+        for f in (db_file, db_file.with_name("business.db-wal"), db_file.with_name("business.db-shm"), marker):
+            if f.exists():
+                f.unlink()
+
+    sys.path.insert(0, str(ROOT))
+    import app as smart_invoice
+    smart_invoice.create_app()  # creates the schema under data_dir
+
+    if not marker.exists():
+        t0 = time.perf_counter()
+        counts = generate(db_file, invoices, seed=seed)
+        with smart_invoice.get_db() as conn:
+            c = conn.cursor()
+            smart_invoice.rebuild_monthly_pnl(c)
+            smart_invoice.rebuild_monthly_product_sales(c)
+        counts["generate_seconds"] = round(time.perf_counter() - t0, 1)
+        marker.write_text(json.dumps(counts))
+    counts = json.loads(marker.read_text())
+
+    flask_app = smart_invoice.app
+    flask_app.config["TESTING"] = True
+    client = flask_app.test_client()
+    r = client.post("/login", data={"username": "admin", "password": "admin123"})
+    if r.status_code != 302:
+        raise SystemExit("benchmark login failed (was the admin password changed?)")
+
+    rng = random.Random(seed)
+    n_inv, n_cust, n_prod = counts["invoices"], counts["customers"], counts["products"]
+    today = datetime.date.today().isoformat()
+
+    def new_invoice_body():
+        pid = rng.randint(1, n_prod)
+        return {
+            "customer_id": rng.randint(1, n_cust),
+            "date": today,
+            "payment_method": "cash",
+            "paid": 0,
+            "items": [{"product_id": pid, "name": f"Product {pid:05d}", "qty": rng.randint(1, 5), "price": 10}],
+        }
+
+    def print_invoice():
+        id = rng.randint(1, n_inv)
+        resp = client.get(f"/invoice/{id}/print")
+        if resp.mimetype != "application/pdf":
+            # Cache miss: the route queued a PDF job and answered with a wait
+            # page; run the job as a worker would, then fetch the PDF
+            resp.close()
+            smart_invoice.work_jobs("bench", once=True)
+            resp = client.get(f"/invoice/{id}/print")
+        return resp
+
+    calls = {
+        "dashboard": lambda: client.get("/"),
+        "invoices": lambda: client.get("/invoices"),
+        "view_invoice": lambda: client.get(f"/invoice/{rng.randint(1, n_inv)}"),
+        "ledger": lambda: client.get(f"/ledger?customer_id={rng.randint(1, n_cust)}"),
+        "new_invoice": lambda: client.post("/invoice/new", json=new_invoice_body()),
+        "print_invoice": print_invoice,
+    }
+
+    results = {"dataset": counts, "routes": {}}
+    for name in ROUTES:
+        call = calls[name]
+        for _ in range(warmup):
+            call().close()
+        samples = []
+        errors = 0
+        wall_start = time.perf_counter()
+        for _ in range(requests_per_route):
+            t0 = time.perf_counter()
+            resp = call()
+            resp.get_data()  # include streamed/file bodies in the timing
+            samples.append(time.perf_counter() - t0)
+            if resp.status_code >= 400:
+                errors += 1
+            resp.close()
+        results["routes"][name] = dict(summarize(samples, time.perf_counter() - wall_start), errors=errors)
+    return results
+
+
+# ===================== REPORTING =====================
+def print_table(scale, result):
+    ds = result["dataset"]
+    print(f"\n== {scale}: {ds['invoices']:,} invoices, {ds['items']:,} items, "
+          f"{ds['customers']:,} customers, {ds['products']:,} products ==")
+    print(f"{'route':<15}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for name, r in result["routes"].items():
+        print(f"{name:<15}{r['throughput_rps']:>10.1f}{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}"
+              f"{r['p99_ms']:>10.2f}{r['errors']:>8}")
+
+def compare(results, baseline, tolerance):
+    """List of regressions: p95 slower than baseline by more than `tolerance`."""
+    regressions = []
+    for scale, result in results.items():
+        base = baseline.get(scale, {}).get("routes", {})
+        for name, r in result["routes"].items():
+            b = base.get(name)
+            if not b:
+                continue
+            limit = b["p95_ms"] * (1 + tolerance)
+            if r["p95_ms"] > limit:
+                regressions.append(f"{scale} {name}: p95 {r['p95_ms']:.2f} ms > "
+                                   f"{limit:.2f} ms (baseline {b['p95_ms']:.2f} ms)")
+            if r["errors"] > b.get("errors", 0):
+                regressions.append(f"{scale} {name}: {r['errors']} errors (baseline {b.get('errors', 0)})")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the main Smart Invoice routes.")
+    parser.add_argument("--scale", action="append", choices=sorted(SCALES, key=SCALES.get),
+                        help="Dataset size; repeat for several (default: 10k).")
+    parser.add_argument("--requests", type=int, default=200, help="Timed requests per route.")
+    parser.add_argument("--warmup", type=int, default=10, help="Untimed requests per route first.")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--regenerate", action="store_true", help="Rebuild the synthetic databases.")
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE, help="Baseline JSON to compare against.")
+    parser.add_argument("--save-baseline", action="store_true", help="Write this run as the new baseline.")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed p95 slowdown (0.25 = 25%%).")
+    parser.add_argument("--output", type=Path, help="Also write the results JSON here.")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        result = run_scale(BENCH_DIR / args.child, SCALES[args.child], args.requests,
+                           args.warmup, args.regenerate, args.seed)
+        print(json.dumps(result))
+        return
+
+    results = {}
+    for scale in args.scale or ["10k"]:
+        print(f"⏱  Running {scale} ...", flush=True)
+        cmd = [sys.executable, str(Path(__file__).resolve()), "--child", scale,
+               "--requests", str(args.requests), "--warmup", str(args.warmup), "--seed", str(args.seed)]
+        if args.regenerate:
+            cmd.append("--regenerate")
+        proc = subprocess.run(cmd, capture_output=True, text=True)
+        if proc.returncode != 0:
+            sys.stderr.write(proc.stderr)
+            raise SystemExit(f"❌ {scale} run failed")
+        results[scale] = json.loads(proc.stdout.strip().splitlines()[-1])
+        print_table(scale, results[scale])
+
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
+
+    if args.save_baseline:
+        baseline = json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+        baseline.update(results)
+        args.baseline.write_text(json.dumps(baseline, indent=2))
+        print(f"\n✅ Baseline saved to {args.baseline}")
+        return
+
+    if args.baseline.exists():
+        regressions = compare(results, json.loads(args.baseline.read_text()), args.tolerance)
+        if regressions:
+            print("\n❌ Regressions against baseline:")
+            for line in regressions:
+                print(f"   {line}")
+            raise SystemExit(1)
+        print("\n✅ No regressions against baseline")
+    else:
+        print(f"\nℹ️  No baseline at {args.baseline}; run with --save-baseline to create one")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+"""
+Load-testing harness for Smart Invoice under gunicorn.
+
+Starts gunicorn with the requested number of workers and threads against a
+throw-away data folder, then runs concurrent clients that mix `/invoice/new`
+JSON posts with page reads for a fixed duration. Reports throughput, latency
+percentiles per kind of request, lock-contention errors (503 "database
+busy"), duplicate invoice numbers, invoices stored without a date and any
+other failures. A share of the invoices is posted without a date to check
+that the server fills it in.
+
+    python loadtest.py --workers 4 --threads 2 --clients 16 --duration 30
+    python loadtest.py --workers 1 --threads 8 --write-ratio 0.8 --json out.json
+
+The data folder (default data/loadtest/) is recreated on every run and seeded
+with the same synthetic generator bench.py uses.
+"""
+import argparse
+import collections
+import datetime
+import http.cookiejar
+import json
+import os
+import random
+import shutil
+import signal
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from pathlib import Path
+
+from bench import generate, summarize
+
+ROOT = Path(__file__).parent
+DEFAULT_DATA = ROOT / "data" / "loadtest"
+
+READ_PATHS = ("dashboard", "invoices", "view_invoice", "ledger")
+UNDATED_SHARE = 0.1  # invoices posted without a date; the server must default it to today
+
+
+class Client:
+    """One simulated user: its own cookie jar, logged in as admin."""
+
+    def __init__(self, base_url, username, password, timeout):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+        body = urllib.parse.urlencode({"username": username, "password": password}).encode()
+        self.request("/login", body, "application/x-www-form-urlencoded")
+
+    def request(self, path, body=None, content_type=None):
+        """(status, body bytes); HTTP errors are returned, not raised."""
+        req = urllib.request.Request(self.base_url + path, data=body)
+        if content_type:
+            req.add_header("Content-Type", content_type)
+        try:
+            with self.opener.open(req, timeout=self.timeout) as resp:
+                return resp.status, resp.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = collections.defaultdict(list)
+        self.outcomes = collections.Counter()
+        self.inv_nos = collections.Counter()
+
+    def add(self, kind, seconds, outcome, inv_no=None):
+        with self.lock:
+            self.latency[kind].append(seconds)
+            self.outcomes[(kind, outcome)] += 1
+            if inv_no:
+                self.inv_nos[inv_no] += 1
+
+
+def classify(kind, status, body):
+    if status == 200:
+        if kind == "new_invoice":
+            try:
+                data = json.loads(body)
+            except ValueError:
+                return "bad_response", None
+            return ("ok", data.get("inv_no")) if data.get("success") else ("failed", None)
+        return "ok", None
+    if status == 503:
+        return "lock_busy", None
+    if status == 409:
+        return "shortage", None
+    if status >= 500:
+        return "server_error", None
+    return f"http_{status}", None
+
+
+def client_loop(args, base_url, counts, deadline, stats, seed):
+    rng = random.Random(seed)
+    try:
+        client = Client(base_url, args.username, args.password, args.timeout)
+    except OSError as e:
+        stats.add("login", 0.0, f"conn_error:{type(e).__name__}")
+        return
+    n_inv, n_cust, n_prod = max(counts["invoices"], 1), counts["customers"], counts["products"]
+    while time.monotonic() < deadline:
+        if rng.random() < args.write_ratio:
+            kind = "new_invoice"
+            pid = rng.randint(1, n_prod)
+            payload = {
+                "customer_id": rng.randint(1, n_cust),
+                "payment_method": "cash",
+                "paid": 0,
+                "items": [{"product_id": pid, "name": f"Product {pid:05d}",
+                           "qty": rng.randint(1, 5), "price": 10}],
+            }
+            if rng.random() >= UNDATED_SHARE:
+                payload["date"] = datetime.date.today().isoformat()
+            call = ("/invoice/new", json.dumps(payload).encode(), "application/json")
+        else:
+            kind = rng.choice(READ_PATHS)
+            path = {
+                "dashboard": "/",
+                "invoices": "/invoices",
+                "view_invoice": f"/invoice/{rng.randint(1, n_inv)}",
+                "ledger": f"/ledger?customer_id={rng.randint(1, n_cust)}",
+            }[kind]
+            call = (path, None, None)
+        t0 = time.perf_counter()
+        try:
+            status, body = client.request(*call)
+            outcome, inv_no = classify(kind, status, body)
+        except OSError as e:
+            outcome, inv_no = f"conn_error:{type(e).__name__}", None
+        stats.add(kind, time.perf_counter() - t0, outcome, inv_no)
+
+
+def prepare_data(data_dir, seed_invoices):
+    if data_dir.exists():
+        shutil.rmtree(data_dir)
+    env = dict(os.environ, SMART_INVOICE_DATA=str(data_dir))
+    # Create the schema once, before several workers race to do it
+    subprocess.run([sys.executable, "-c", "import app; app.create_app()"], cwd=ROOT, env=env, check=True,
+                   stdout=subprocess.DEVNULL)
+    return generate(data_dir / "db" / "business.db", seed_invoices)
+
+
+def start_gunicorn(args, data_dir, log_file):
+    cmd = [sys.executable, "-m", "gunicorn", "app:app",
+           "--workers", str(args.workers), "--threads", str(args.threads),
+           "--bind", f"127.0.0.1:{args.port}", "--timeout", "120",
+           "--error-logfile", str(log_file), "--log-level", "warning"]
+    env = dict(os.environ, SMART_INVOICE_DATA=str(data_dir))
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{args.port}"
+    for _ in range(100):
+        if proc.poll() is not None:
+            raise SystemExit(f"❌ gunicorn exited early, see {log_file}")
+        try:
+            urllib.request.urlopen(base_url + "/login", timeout=1).close()
+            return proc, base_url
+        except OSError:
+            time.sleep(0.2)
+    proc.terminate()
+    raise SystemExit("❌ gunicorn did not come up")
+
+
+def check_database(db_file, created_before):
+    conn = sqlite3.connect(db_file)
+    duplicates = conn.execute(
+        "SELECT COUNT(*) FROM (SELECT inv_no FROM invoices GROUP BY inv_no HAVING COUNT(*) > 1)").fetchone()[0]
+    created = conn.execute("SELECT COUNT(*) FROM invoices").fetchone()[0] - created_before
+    # Every stored invoice needs a real date, sent or defaulted by the server
+    undated = conn.execute(
+        "SELECT COUNT(*) FROM invoices WHERE date IS NULL "
+        "OR date NOT GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]'").fetchone()[0]
+    conn.close()
+    return duplicates, created, undated
+
+
+def report(args, stats, wall, log_text, db_duplicates, db_created, db_undated):
+    total = sum(len(v) for v in stats.latency.values())
+    ok_creates = stats.outcomes[("new_invoice", "ok")]
+    response_duplicates = sum(1 for n in stats.inv_nos.values() if n > 1)
+    result = {
+        "config": {"workers": args.workers, "threads": args.threads, "clients": args.clients,
+                   "duration": args.duration, "write_ratio": args.write_ratio},
+        "requests": total,
+        "throughput_rps": round(total / wall, 2),
+        "invoices_per_sec": round(ok_creates / wall, 2),
+        "routes": {kind: summarize(samples, wall) for kind, samples in sorted(stats.latency.items())},
+        "outcomes": {f"{kind} {outcome}": n for (kind, outcome), n in sorted(stats.outcomes.items())},
+        "lock_busy": sum(n for (k, o), n in stats.outcomes.items() if o == "lock_busy"),
+        "locked_in_log": log_text.count("database is locked"),
+        "duplicate_numbers": {
+            "in_responses": response_duplicates,
+            "in_database": db_duplicates,
+            "unique_violations_in_log": log_text.count("UNIQUE constraint failed: invoices.inv_no"),
+        },
+        "created_reported": ok_creates,
+        "created_in_database": db_created,
+        "undated_in_database": db_undated,
+    }
+
+    print(f"\n== gunicorn {args.workers} worker(s) x {args.threads} thread(s), "
+          f"{args.clients} clients, {args.duration}s, {args.write_ratio:.0%} writes ==")
+    print(f"requests: {total:,}  throughput: {result['throughput_rps']:.1f} req/s  "
+          f"invoices: {result['invoices_per_sec']:.1f}/s")
+    print(f"{'kind':<15}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for kind, r in result["routes"].items():
+        print(f"{kind:<15}{r['requests']:>8}{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}{r['p99_ms']:>10.2f}")
+    failures = {k: n for k, n in result["outcomes"].items() if not k.endswith(" ok")}
+    print("failures: " + (", ".join(f"{k}={n}" for k, n in failures.items()) or "none"))
+    print(f"lock contention: {result['lock_busy']} busy responses, "
+          f"{result['locked_in_log']} 'database is locked' in the error log")
+    dup = result["duplicate_numbers"]
+    print(f"duplicate numbers: {dup['in_responses']} in responses, {dup['in_database']} in database, "
+          f"{dup['unique_violations_in_log']} UNIQUE violations logged")
+    print(f"undated invoices: {db_undated} in database")
+    if db_created != ok_creates:
+        print(f"⚠️  {ok_creates} creates reported OK but {db_created} invoices were written")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test invoice creation under gunicorn.")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--clients", type=int, default=8, help="Concurrent client threads.")
+    parser.add_argument("--duration", type=float, default=20, help="Seconds to run.")
+    parser.add_argument("--write-ratio", type=float, default=0.3, help="Share of requests that create invoices.")
+    parser.add_argument("--seed-invoices", type=int, default=1000, help="Invoices in the starting dataset.")
+    parser.add_argument("--data-dir", type=Path, default=DEFAULT_DATA, help="Scratch data folder (wiped).")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--timeout", type=float, default=60, help="Per-request client timeout.")
+    parser.add_argument("--username", default="admin")
+    parser.add_argument("--password", default="admin123")
+    parser.add_argument("--json", type=Path, help="Write the results JSON here.")
+    args = parser.parse_args()
+
+    print(f"⏳ Seeding {args.data_dir} with {args.seed_invoices:,} invoices ...", flush=True)
+    counts = prepare_data(args.data_dir, args.seed_invoices)
+    log_file = args.data_dir / "gunicorn.log"
+    proc, base_url = start_gunicorn(args, args.data_dir, log_file)
+    try:
+        stats = Stats()
+        start = time.monotonic()
+        deadline = start + args.duration
+        threads = [threading.Thread(target=client_loop, args=(args, base_url, counts, deadline, stats, i),
+                                    daemon=True)
+                   for i in range(args.clients)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        wall = time.monotonic() - start
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        try:
+            proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+    log_text = log_file.read_text(errors="replace") if log_file.exists() else ""
+    db_duplicates, db_created, db_undated = check_database(args.data_dir / "db" / "business.db",
+                                                           counts["invoices"])
+    result = report(args, stats, wall, log_text, db_duplicates, db_created, db_undated)
+    if args.json:
+        args.json.write_text(json.dumps(result, indent=2))
+    failed = (result["duplicate_numbers"]["in_database"] or result["duplicate_numbers"]["in_responses"]
+              or result["undated_in_database"])
+    raise SystemExit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
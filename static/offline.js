@@ -1,5 +1,7 @@
 function saveOfflineInvoice(invoice) {
   let list = JSON.parse(localStorage.getItem("offline_invoices") || "[]");
+  // Idempotency key for /api/sync
+  invoice.client_uuid = invoice.client_uuid || newLocalUUID();
   list.push(invoice);
   localStorage.setItem("offline_invoices", JSON.stringify(list));
 }
@@ -11,3 +13,43 @@ function getOfflineInvoices() {
 function clearOfflineInvoices() {
   localStorage.removeItem("offline_invoices");
 }
+
+// Largest batch /api/sync accepts (SYNC_MAX_BATCH on the server)
+const LOCAL_SYNC_BATCH_SIZE = 500;
+
+function newLocalUUID() {
+  return window.crypto && crypto.randomUUID ? crypto.randomUUID() : Date.now() + "-" + Math.random().toString(16).slice(2);
+}
+
+// Send the stored invoices in batches the server accepts; keep only the ones it refused
+function syncLocalInvoices() {
+  const invoices = getOfflineInvoices();
+  if (!invoices.length) return Promise.resolve([]);
+  // Invoices saved before client UUIDs existed: fix their key before the first upload
+  if (invoices.some(inv => typeof inv.client_uuid !== "string")) {
+    invoices.forEach(inv => { if (typeof inv.client_uuid !== "string") inv.client_uuid = newLocalUUID(); });
+    localStorage.setItem("offline_invoices", JSON.stringify(invoices));
+  }
+  let results = [];
+  let chain = Promise.resolve();
+  for (let i = 0; i < invoices.length; i += LOCAL_SYNC_BATCH_SIZE) {
+    const batch = invoices.slice(i, i + LOCAL_SYNC_BATCH_SIZE);
+    chain = chain.then(() => fetch("/api/sync", {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      credentials: "same-origin",
+      body: JSON.stringify({ invoices: batch })
+    }))
+      .then(r => r.json())
+      .then(data => {
+        if (!data.success) throw new Error(data.error || "Sync failed");
+        const done = new Set(data.results
+          .filter(r => r.status === "created" || r.status === "duplicate")
+          .map(r => r.client_uuid));
+        localStorage.setItem("offline_invoices",
+          JSON.stringify(getOfflineInvoices().filter(inv => !done.has(inv.client_uuid))));
+        results = results.concat(data.results);
+      });
+  }
+  return chain.then(() => results);
+}
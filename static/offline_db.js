@@ -2,15 +2,27 @@
 
 let db;
 
+// Server entity (from /api/changes) -> local object store
+const CHANGE_STORES = {
+  customers: "customers",
+  products: "products",
+  invoices: "server_invoices",
+  transactions: "transactions"
+};
+
 function openOfflineDB() {
   return new Promise((resolve, reject) => {
-    const request = indexedDB.open("SmartInvoiceDB", 1);
+    const request = indexedDB.open("SmartInvoiceDB", 2);
 
     request.onupgradeneeded = function (e) {
       db = e.target.result;
-      if (!db.objectStoreNames.contains("invoices")) {
-        db.createObjectStore("invoices", { keyPath: "id" });
-      }
+      // "invoices" holds invoices created offline and not yet synced
+      const stores = ["invoices", "meta"].concat(Object.values(CHANGE_STORES));
+      stores.forEach(name => {
+        if (!db.objectStoreNames.contains(name)) {
+          db.createObjectStore(name, { keyPath: name === "meta" ? "key" : "id" });
+        }
+      });
     };
 
     request.onsuccess = function (e) {
@@ -24,7 +36,18 @@ function openOfflineDB() {
   });
 }
 
+function newClientUUID() {
+  if (window.crypto && crypto.randomUUID) return crypto.randomUUID();
+  return "xxxxxxxx-xxxx-4xxx-yxxx-xxxxxxxxxxxx".replace(/[xy]/g, c => {
+    const r = Math.random() * 16 | 0;
+    return (c === "x" ? r : (r & 0x3 | 0x8)).toString(16);
+  });
+}
+
 function saveOfflineInvoice(invoice) {
+  // The UUID is the idempotency key for /api/sync, so it is fixed at save time
+  invoice.client_uuid = invoice.client_uuid || newClientUUID();
+  invoice.id = invoice.id || invoice.client_uuid;
   return openOfflineDB().then(db => {
     const tx = db.transaction("invoices", "readwrite");
     tx.objectStore("invoices").put(invoice);
@@ -47,3 +70,126 @@ function deleteOfflineInvoice(id) {
     tx.objectStore("invoices").delete(id);
   });
 }
+
+function deviceId() {
+  let id = localStorage.getItem("device_id");
+  if (!id) {
+    id = newClientUUID();
+    localStorage.setItem("device_id", id);
+  }
+  return id;
+}
+
+// Largest batch /api/sync accepts (SYNC_MAX_BATCH on the server)
+const SYNC_BATCH_SIZE = 500;
+
+// Rows saved before client UUIDs existed are keyed by a numeric id; give each a
+// UUID and store it first, so a resend after a lost response reuses the same key
+function ensureClientUUIDs(invoices) {
+  const legacy = invoices.filter(inv => typeof inv.client_uuid !== "string");
+  if (!legacy.length) return Promise.resolve(invoices);
+  return openOfflineDB().then(db => new Promise((resolve, reject) => {
+    const tx = db.transaction("invoices", "readwrite");
+    legacy.forEach(inv => {
+      inv.client_uuid = newClientUUID();
+      tx.objectStore("invoices").put(inv);
+    });
+    tx.oncomplete = () => resolve(invoices);
+    tx.onerror = () => reject(tx.error);
+  }));
+}
+
+function uploadBatch(invoices) {
+  return fetch("/api/sync", {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    credentials: "same-origin",
+    body: JSON.stringify({ device_id: deviceId(), invoices: invoices })
+  })
+    .then(r => r.json().then(data => {
+      if (!r.ok || !data.success) throw new Error(data.error || ("Sync failed: " + r.status));
+      return data.results;
+    }))
+    .then(results => {
+      const byUUID = {};
+      invoices.forEach(inv => { byUUID[inv.client_uuid] = inv.id; });
+      return Promise.all(results
+        .filter(r => r.status === "created" || r.status === "duplicate")
+        .map(r => deleteOfflineInvoice(byUUID[r.client_uuid])))
+        .then(() => results);
+    });
+}
+
+// Upload every stored invoice, SYNC_BATCH_SIZE per request, one batch after
+// another. Created and duplicate ones are on the server and get removed;
+// rejected/invalid ones stay for the user to fix. Resolves to the server's
+// per-invoice results.
+function syncOfflineInvoices() {
+  return getAllOfflineInvoices().then(ensureClientUUIDs).then(invoices => {
+    let results = [];
+    let chain = Promise.resolve();
+    for (let i = 0; i < invoices.length; i += SYNC_BATCH_SIZE) {
+      const batch = invoices.slice(i, i + SYNC_BATCH_SIZE);
+      chain = chain.then(() => uploadBatch(batch)).then(r => { results = results.concat(r); });
+    }
+    return chain.then(() => results);
+  });
+}
+
+window.addEventListener("online", () => {
+  syncOfflineInvoices().then(pullChanges).catch(err => console.warn(err));
+});
+
+// ---- Delta sync: keep local copies of server records current ----
+
+function getChangeSeq() {
+  return openOfflineDB().then(db => new Promise(resolve => {
+    const req = db.transaction("meta", "readonly").objectStore("meta").get("change_seq");
+    req.onsuccess = () => resolve(req.result ? req.result.value : 0);
+  }));
+}
+
+// Apply one page of changes and its new seq in a single IndexedDB transaction,
+// so a crash can never store the seq without the rows (or the reverse)
+function applyChanges(page) {
+  return openOfflineDB().then(db => new Promise((resolve, reject) => {
+    const names = Object.values(CHANGE_STORES).concat(["meta"]);
+    const tx = db.transaction(names, "readwrite");
+    if (page.reset) {
+      Object.values(CHANGE_STORES).forEach(name => tx.objectStore(name).clear());
+    }
+    Object.entries(page.changes).forEach(([entity, delta]) => {
+      const store = tx.objectStore(CHANGE_STORES[entity]);
+      delta.upsert.forEach(row => store.put(row));
+      delta.delete.forEach(id => store.delete(id));
+    });
+    tx.objectStore("meta").put({ key: "change_seq", value: page.next });
+    tx.oncomplete = () => resolve(page);
+    tx.onerror = () => reject(tx.error);
+  }));
+}
+
+// Pull everything changed since the last call; resolves to the number of pages applied
+function pullChanges() {
+  let pages = 0;
+  function next(since) {
+    return fetch("/api/changes?since=" + since, { credentials: "same-origin" })
+      .then(r => {
+        if (!r.ok) throw new Error("Change feed failed: " + r.status);
+        return r.json();
+      })
+      .then(applyChanges)
+      .then(page => {
+        pages++;
+        return page.more || page.reset ? next(page.next) : pages;
+      });
+  }
+  return getChangeSeq().then(next);
+}
+
+function getLocalRecords(entity) {
+  return openOfflineDB().then(db => new Promise(resolve => {
+    const req = db.transaction(CHANGE_STORES[entity], "readonly").objectStore(CHANGE_STORES[entity]).getAll();
+    req.onsuccess = () => resolve(req.result);
+  }));
+}
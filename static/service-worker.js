@@ -1,23 +1,109 @@
-const CACHE_NAME = "smart-invoice-cache-v1";
+// Smart Invoice service worker.
+// Served by the app at /service-worker.js, which prepends
+//   self.__PRECACHE = {version: "...", urls: [...], api: [...]};
+// built from the current static files, so any deploy that changes them
+// installs a new worker and drops the old caches.
 
-const FILES_TO_CACHE = [
-  "/",
-  "/login",
-  "/static/manifest.json"
-];
+const PRECACHE = self.__PRECACHE || { version: "dev", urls: [], api: [] };
+const SHELL_CACHE = "smart-invoice-shell-" + PRECACHE.version;
+const API_CACHE = "smart-invoice-api-" + PRECACHE.version;
+const OFFLINE_URL = "/offline";
 
 self.addEventListener("install", function (event) {
   event.waitUntil(
-    caches.open(CACHE_NAME).then(function (cache) {
-      return cache.addAll(FILES_TO_CACHE);
-    })
+    caches.open(SHELL_CACHE)
+      .then(cache => cache.addAll(PRECACHE.urls))
+      // Read APIs need a login, so warming them is best effort
+      .then(() => caches.open(API_CACHE))
+      .then(cache => Promise.all(PRECACHE.api.map(url =>
+        fetch(url, { credentials: "same-origin" })
+          .then(r => r.ok && !r.redirected ? cache.put(url, r) : null)
+          .catch(() => null))))
+      .then(() => self.skipWaiting())
   );
 });
 
-self.addEventListener("fetch", function (event) {
-  event.respondWith(
-    caches.match(event.request).then(function (response) {
-      return response || fetch(event.request);
+self.addEventListener("activate", function (event) {
+  const keep = [SHELL_CACHE, API_CACHE];
+  event.waitUntil(
+    caches.keys()
+      .then(keys => Promise.all(keys
+        .filter(key => key.startsWith("smart-invoice-") && !keep.includes(key))
+        .map(key => caches.delete(key))))
+      .then(() => self.clients.claim())
+  );
+});
+
+// Serve the cached copy at once (if any) and refresh it in the background.
+// Only for the precached reference data (catalog), where a slightly old copy is fine
+function staleWhileRevalidate(event) {
+  return caches.open(API_CACHE).then(cache =>
+    cache.match(event.request).then(cached => {
+      const network = fetch(event.request).then(response => {
+        if (response.ok && !response.redirected) cache.put(event.request, response.clone());
+        return response;
+      });
+      if (cached) {
+        event.waitUntil(network.catch(() => {}));
+        return cached;
+      }
+      return network;
     })
   );
+}
+
+// Always ask the network; the last good copy is only an offline fallback
+function networkFirst(event) {
+  return caches.open(API_CACHE).then(cache =>
+    fetch(event.request)
+      .then(response => {
+        if (response.ok && !response.redirected) cache.put(event.request, response.clone());
+        return response;
+      })
+      .catch(() => cache.match(event.request).then(cached => cached || Promise.reject(new Error("offline"))))
+  );
+}
+
+self.addEventListener("fetch", function (event) {
+  const request = event.request;
+  const url = new URL(request.url);
+
+  // Mutations (invoices, payments, sync) always go to the network
+  if (request.method !== "GET" || url.origin !== self.location.origin) return;
+
+  // Another user may log in next: forget their cached API data
+  if (url.pathname === "/logout") {
+    event.waitUntil(caches.delete(API_CACHE));
+    return;
+  }
+
+  // The change feed is a cursor: a cached page would hide newer changes
+  if (url.pathname === "/api/changes") return;
+
+  // The versioned API is for integrations reading live balances and ledgers:
+  // never store it, so nothing can be answered from an old copy
+  if (url.pathname.startsWith("/api/v1/")) return;
+
+  if (PRECACHE.api.includes(url.pathname)) {
+    event.respondWith(staleWhileRevalidate(event));
+    return;
+  }
+
+  // Anything else under /api/ can carry balances or stock that must be current
+  if (url.pathname.startsWith("/api/")) {
+    event.respondWith(networkFirst(event));
+    return;
+  }
+
+  if (PRECACHE.urls.includes(url.pathname)) {
+    event.respondWith(
+      caches.match(request, { cacheName: SHELL_CACHE }).then(hit => hit || fetch(request))
+    );
+    return;
+  }
+
+  // Pages carry live balances and stock: network only, offline page as fallback
+  if (request.mode === "navigate") {
+    event.respondWith(fetch(request).catch(() => caches.match(OFFLINE_URL)));
+  }
 });
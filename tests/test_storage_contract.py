@@ -0,0 +1,41 @@
+"""The Storage contract, run against every backend.
+
+SQLite always runs; PostgreSQL runs when SMART_INVOICE_PG_DSN points at a
+server the tests may create and drop schemas on.
+"""
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import app  # noqa: E402
+
+PG_DSN = os.environ.get("SMART_INVOICE_PG_DSN")
+
+
+@pytest.fixture(params=[
+    "sqlite",
+    pytest.param("postgres", marks=pytest.mark.skipif(not PG_DSN, reason="SMART_INVOICE_PG_DSN is not set")),
+])
+def store(request, tmp_path):
+    with app.scratch_storage(request.param, PG_DSN, directory=tmp_path) as store:
+        yield store
+
+
+def test_storage_contract(store):
+    steps = app.check_storage_contract(store)
+    assert "recent_activity newest first" in steps
+
+
+def test_contract_reports_a_broken_backend(tmp_path):
+    class Overselling(app.SqliteStorage):
+        def take_stock(self, product_id, qty):
+            return True
+
+    db_file = tmp_path / "broken.db"
+    app.init_db(db_file, shared=False)
+    with pytest.raises(app.StorageContractError, match="take_stock refuses to go negative"):
+        app.check_storage_contract(Overselling(db_file))